@@ -8,6 +8,9 @@ FilePath: \hydromodel\hydromodel\datasets\data_preprocess.py
 Copyright (c) 2021-2022 Wenyu Ouyang. All rights reserved.
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
 import os
 import re
 import numpy as np
@@ -17,6 +20,7 @@ from sklearn.model_selection import KFold
 import xarray as xr
 
 from hydrodataset import Camels
+from hydroutils import hydro_file
 from hydrodatasource.utils.utils import streamflow_unit_conv
 from hydrodatasource.cleaner.dmca_esr import rainfall_runoff_event_identify
 
@@ -24,20 +28,56 @@ from hydromodel import CACHE_DIR, SETTING
 from hydromodel.datasets import *
 
 
-def check_tsdata_format(file_path):
+def parse_time_column(time_values, time_format=None):
     """
-    Checks the time-series data for required and optional columns
-    used in hydrological modeling.
+    Parse the time column with the first matching format in POSSIBLE_TIME_FORMATS.
+
+    Parameters
+    ----------
+    time_values : pd.Series
+        The raw time column read from a csv file.
+    time_format : str, optional
+        A format which is tried before all others, typically the one detected in
+        a previous file of the same folder, by default None
+
+    Returns
+    -------
+    tuple[pd.Series, str]
+        The parsed time column and the format used; (None, None) if no format matches
+    """
+    time_formats = POSSIBLE_TIME_FORMATS
+    if time_format is not None:
+        time_formats = [time_format] + [
+            fmt for fmt in POSSIBLE_TIME_FORMATS if fmt != time_format
+        ]
+    for fmt in time_formats:
+        try:
+            return pd.to_datetime(time_values, format=fmt), fmt
+        except ValueError:
+            continue
+    return None, None
+
+
+def read_tsdata(file_path, time_format=None):
+    """
+    Read the time-series data of one basin and check its format in a single pass.
+
+    The required and optional columns are same as those in check_tsdata_format.
+    The returned DataFrame has its time column parsed, so it can be used directly.
 
     Parameters
     ----------
     file_path : str
         Path to the hydrological data file.
+    time_format : str, optional
+        The time format tried first, for example the one detected in another file
+        of the same folder, by default None
 
     Returns
     -------
-    bool
-        True if the data file format is correct, False otherwise.
+    tuple[pd.DataFrame, str]
+        The data with parsed time column and the detected time format;
+        (None, None) if the data file format is not correct
     """
     # prcp means precipitation, pet means potential evapotranspiration, flow means streamflow
     required_columns = [
@@ -69,7 +109,7 @@ def check_tsdata_format(file_path):
             print(
                 f"Missing required columns in file: {file_path}: {missing_required_columns}"
             )
-            return False
+            return None, None
 
         # Check optional columns
         for column in optional_columns:
@@ -86,36 +126,49 @@ def check_tsdata_format(file_path):
             print(f"No 'node_flow' columns found in file: {file_path}, but it's okay.")
 
         # Check time format and sorting
-        time_parsed = False
-        for time_format in POSSIBLE_TIME_FORMATS:
-            try:
-                data[TIME_NAME] = pd.to_datetime(data[TIME_NAME], format=time_format)
-                time_parsed = True
-                break
-            except ValueError:
-                continue
-
-        if not time_parsed:
+        time_parsed, time_format = parse_time_column(data[TIME_NAME], time_format)
+        if time_parsed is None:
             print(f"Time format is incorrect in file: {file_path}")
-            return False
+            return None, None
+        data[TIME_NAME] = time_parsed
 
         if not data[TIME_NAME].is_monotonic_increasing:
             print(f"Data is not sorted by time in file: {file_path}")
-            return False
+            return None, None
 
         # Check for consistent time intervals
-        time_differences = (
-            data[TIME_NAME].diff().dropna()
-        )  # Calculate differences and remove NaN
-        if not all(time_differences == time_differences.iloc[0]):
+        time_differences = np.diff(data[TIME_NAME].to_numpy())
+        if (
+            time_differences.size > 0
+            and not (time_differences == time_differences[0]).all()
+        ):
             print(f"Time series is not at consistent intervals in file: {file_path}")
-            return False
+            return None, None
 
-        return True
+        return data, time_format
 
     except Exception as e:
         print(f"Error reading file {file_path}: {e}")
-        return False
+        return None, None
+
+
+def check_tsdata_format(file_path):
+    """
+    Checks the time-series data for required and optional columns
+    used in hydrological modeling.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the hydrological data file.
+
+    Returns
+    -------
+    bool
+        True if the data file format is correct, False otherwise.
+    """
+    data, _ = read_tsdata(file_path)
+    return data is not None
 
 
 def check_basin_attr_format(file_path):
@@ -154,9 +207,13 @@ def check_basin_attr_format(file_path):
         return False
 
 
-def check_folder_contents(folder_path, basin_attr_file="basin_attributes.csv"):
+def read_folder_contents(folder_path, basin_attr_file="basin_attributes.csv"):
     """
-    Checks all time series data files in a folder and a single basin attributes file.
+    Read and check all time series data files in a folder and a single basin attributes file.
+
+    Each file is read only once: the time format detected in the first basin's file
+    is tried first for all other files, and the parsed data are returned so that
+    they can be saved without reading the files again.
 
     Parameters
     ----------
@@ -167,32 +224,56 @@ def check_folder_contents(folder_path, basin_attr_file="basin_attributes.csv"):
 
     Returns
     -------
-    bool
-        True if all files in the folder and the basin attributes file are correct, False otherwise.
+    tuple[pd.DataFrame, dict]
+        The basin attributes and a dict of time series data with basin id as key;
+        None if any file in the folder is not correct.
     """
     # 检查流域属性文件
-    if not check_basin_attr_format(os.path.join(folder_path, basin_attr_file)):
-        return False
+    basin_attr_path = os.path.join(folder_path, basin_attr_file)
+    if not check_basin_attr_format(basin_attr_path):
+        return None
 
-    # 获取流域ID列表
-    basin_ids = pd.read_csv(
-        os.path.join(folder_path, basin_attr_file), dtype={ID_NAME: str}
-    )[ID_NAME].tolist()
+    # 获取流域ID列表; id must be str
+    basin_attrs = pd.read_csv(basin_attr_path, dtype={ID_NAME: str})
+    basin_ids = basin_attrs[ID_NAME].tolist()
 
-    # 检查每个流域的时序文件
+    # 检查并读取每个流域的时序文件
+    ts_data = {}
+    time_format = None
     for basin_id in basin_ids:
         file_name = f"basin_{basin_id}.csv"
         file_path = os.path.join(folder_path, file_name)
 
         if not os.path.exists(file_path):
             print(f"Missing time series data file for basin {basin_id}: {file_path}")
-            return False
+            return None
 
-        if not check_tsdata_format(file_path):
+        data, time_format = read_tsdata(file_path, time_format)
+        if data is None:
             print(f"Time series data format check failed for file: {file_path}")
-            return False
+            return None
+        ts_data[basin_id] = data
 
-    return True
+    return basin_attrs, ts_data
+
+
+def check_folder_contents(folder_path, basin_attr_file="basin_attributes.csv"):
+    """
+    Checks all time series data files in a folder and a single basin attributes file.
+
+    Parameters
+    ----------
+    folder_path : str
+        Path to the folder containing the time series data files.
+    basin_attr_file : str
+        Filename of the basin attributes file, default is "basin_attributes.csv".
+
+    Returns
+    -------
+    bool
+        True if all files in the folder and the basin attributes file are correct, False otherwise.
+    """
+    return read_folder_contents(folder_path, basin_attr_file) is not None
 
 
 def process_and_save_data_as_nc(
@@ -201,18 +282,14 @@ def process_and_save_data_as_nc(
     nc_attrs_file="attributes.nc",
     nc_ts_file="timeseries.nc",
 ):
-    # 验证文件夹内容
-    if not check_folder_contents(folder_path):
+    # 验证并读取文件夹内容，每个文件只读取一次
+    folder_contents = read_folder_contents(folder_path)
+    if folder_contents is None:
         print("Folder contents validation failed.")
         return False
-
-    # 读取流域属性
-    basin_attr_file = os.path.join(folder_path, "basin_attributes.csv")
-    # id must be str
-    basin_attrs = pd.read_csv(basin_attr_file, dtype={ID_NAME: str})
+    basin_attrs, ts_data = folder_contents
 
     # 创建属性数据集
-    ds_attrs = xr.Dataset.from_dataframe(basin_attrs.set_index(ID_NAME))
     new_column_names = {}
     units = {}
 
@@ -231,26 +308,13 @@ def process_and_save_data_as_nc(
     # 为有单位的变量添加单位属性
     for var_name, unit in units.items():
         ds_attrs[var_name].attrs["units"] = unit
-    # 初始化时序数据集
-    ds_ts = xr.Dataset()
 
     # 初始化用于保存单位的字典
     units = {}
 
-    # id must be str
-    basin_ids = basin_attrs[ID_NAME].astype(str).tolist()
-
-    # 为每个流域读取并处理时序数据
-    for i, basin_id in enumerate(basin_ids):
-        file_name = f"basin_{basin_id}.csv"
-        file_path = os.path.join(folder_path, file_name)
-        data = pd.read_csv(file_path)
-        for time_format in POSSIBLE_TIME_FORMATS:
-            try:
-                data[TIME_NAME] = pd.to_datetime(data[TIME_NAME], format=time_format)
-                break
-            except ValueError:
-                continue
+    # 为每个流域处理已读取的时序数据
+    ds_basins = []
+    for i, (basin_id, data) in enumerate(ts_data.items()):
         # 在处理第一个流域时构建单位字典
         if i == 0:
             for col in data.columns:
@@ -260,7 +324,7 @@ def process_and_save_data_as_nc(
 
         # 修改列名以移除单位
         renamed_columns = {col: remove_unit_from_name(col) for col in data.columns}
-        data.rename(columns=renamed_columns, inplace=True)
+        data = data.rename(columns=renamed_columns)
 
         # 将 DataFrame 转换为 xarray Dataset
         ds_basin = xr.Dataset.from_dataframe(data.set_index(TIME_NAME))
@@ -270,9 +334,10 @@ def process_and_save_data_as_nc(
             if var in units:
                 ds_basin[var].attrs["units"] = units[var]
         # 添加 basin 坐标
-        ds_basin = ds_basin.expand_dims({"basin": [basin_id]})
-        # 合并到主数据集
-        ds_ts = xr.merge([ds_ts, ds_basin], compat="no_conflicts")
+        ds_basins.append(ds_basin.expand_dims({"basin": [basin_id]}))
+
+    # 一次性合并所有流域，避免逐个 merge 带来的重复拷贝
+    ds_ts = xr.concat(ds_basins, dim="basin", join="outer")
 
     # 保存为 NetCDF 文件
     ds_attrs.to_netcdf(os.path.join(save_folder, nc_attrs_file))
@@ -335,14 +400,68 @@ def validate_freq(freq):
         return False
 
 
-def cross_valid_data(ts_data, period, warmup, cv_fold, freq="1D"):
-    """
-    Split all data to train and test parts with same format for cross validation.
+def _idx_to_windows(idx):
+    """Compress sorted integer indices to slices, one slice for each evenly spaced run"""
+    windows = []
+    start = 0
+    n = len(idx)
+    while start < n:
+        end = start
+        step = int(idx[start + 1] - idx[start]) if start + 1 < n else 1
+        while end + 1 < n and idx[end + 1] - idx[end] == step:
+            end += 1
+        windows.append(
+            slice(int(idx[start]), int(idx[end]) + 1, None if step == 1 else step)
+        )
+        start = end + 1
+    return windows
+
+
+def _dates_to_windows(times, dates):
+    """Find the positions of dates in times and compress them to slices"""
+    idx = times.get_indexer(dates)
+    if (idx < 0).any():
+        raise KeyError(f"{dates[idx < 0][:5].tolist()} are not in the time index")
+    return _idx_to_windows(np.sort(idx))
+
+
+def select_by_windows(ts_data, windows, dim="time"):
+    """Select data by index windows from cross_valid_idx or split_tsdata_windows
+
+    Each window is a slice, so the selection of one window is a view of ts_data;
+    only when there are several windows, the data is copied into one contiguous dataset.
 
     Parameters
     ----------
     ts_data : xr.Dataset
-        time series data.
+        time series data
+    windows : list of slice
+        index windows along dim
+    dim : str, optional
+        the dimension to select, by default "time"
+
+    Returns
+    -------
+    xr.Dataset
+        the selected data
+    """
+    parts = [ts_data.isel({dim: window}) for window in windows]
+    if len(parts) == 1:
+        return parts[0]
+    return xr.concat(parts, dim=dim, data_vars="minimal")
+
+
+def cross_valid_idx(times, period, warmup, cv_fold, freq="1D"):
+    """
+    Split all time steps to train and test index windows for cross validation.
+
+    The folds are the same as cross_valid_data, but represented as positions in times,
+    so no data is selected or copied here.
+
+    Parameters
+    ----------
+    times : array-like
+        the time coordinate of the time series data.
     period : tuple of str
         The whole period in the format ("start_date", "end_date").
     warmup : int
@@ -355,20 +474,20 @@ def cross_valid_data(ts_data, period, warmup, cv_fold, freq="1D"):
     Returns
     -------
     list of tuples
-        Each tuple contains training and testing datasets for a fold.
+        Each tuple contains training and testing index windows (lists of slices) for a fold.
     """
     if not validate_freq(freq):
         raise ValueError(
             "Time unit must be number with either 'Y','M','W','D','h','m' or 's', such as 3D."
         )
+    times = pd.DatetimeIndex(times)
 
     # Convert the whole period to pandas datetime
     start_date, end_date = pd.to_datetime(period[0]), pd.to_datetime(period[1])
     date_lst = pd.date_range(start=start_date, end=end_date, freq=freq)
     date_rm_warmup = date_lst[warmup:]
 
-    # Initialize lists to store train and test datasets for each fold
-    train_test_data = []
+    fold_windows = []
 
     # KFold split
     kf = KFold(n_splits=cv_fold, shuffle=False)
@@ -382,15 +501,48 @@ def cross_valid_data(ts_data, period, warmup, cv_fold, freq="1D"):
         test_period_warmup = pd.date_range(
             end=test_period[0], periods=warmup + 1, freq=freq
         )[:-1]
+        fold_windows.append(
+            (
+                _dates_to_windows(times, train_period.union(train_period_warmup)),
+                _dates_to_windows(times, test_period.union(test_period_warmup)),
+            )
+        )
+
+    return fold_windows
 
-        # Select data from ts_data based on train and test periods
-        train_data = ts_data.sel(time=train_period.union(train_period_warmup))
-        test_data = ts_data.sel(time=test_period.union(test_period_warmup))
 
-        # Add the datasets to the list
-        train_test_data.append((train_data, test_data))
+def cross_valid_data(ts_data, period, warmup, cv_fold, freq="1D"):
+    """
+    Split all data to train and test parts with same format for cross validation.
+
+    Contiguous parts are views of ts_data (see select_by_windows);
+    to avoid holding the data of all folds at once,
+    use cross_valid_idx and select one fold at a time.
+
+    Parameters
+    ----------
+    ts_data : xr.Dataset
+        time series data.
+    period : tuple of str
+        The whole period in the format ("start_date", "end_date").
+    warmup : int
+        Warmup period length in days.
+    cv_fold : int
+        Number of folds for cross-validation.
+    freq : str
+        len of one period.
 
-    return train_test_data
+    Returns
+    -------
+    list of tuples
+        Each tuple contains training and testing datasets for a fold.
+    """
+    return [
+        (select_by_windows(ts_data, train), select_by_windows(ts_data, test))
+        for train, test in cross_valid_idx(
+            ts_data["time"].values, period, warmup, cv_fold, freq
+        )
+    ]
 
 
 def get_basin_area(basin_ids, data_type, data_dir, **kwargs) -> xr.Dataset:
@@ -478,13 +630,7 @@ def get_ts_from_diffsource(data_type, data_dir, periods, basin_ids):
         )
     elif data_type == "owndata":
         ts_data = xr.open_dataset(os.path.join(data_dir, "timeseries.nc"))
-        target_unit = ts_data[prcp_name].attrs.get("units", "unknown")
-        qobs_ = ts_data[[flow_name]]
-        if qobs_[flow_name].attrs.get("units", "unknown") != target_unit:
-            r_mmd = streamflow_unit_conv(qobs_, basin_area, target_unit=target_unit)
-            ts_data[flow_name] = r_mmd[flow_name]
-            ts_data[flow_name].attrs["units"] = target_unit
-        ts_data = ts_data.sel(time=slice(periods[0], periods[1]))
+        ts_data = _unify_owndata_ts(ts_data, basin_area, periods)
     else:
         raise NotImplementedError(
             "You should set the data type as 'camels' or 'owndata'"
@@ -493,13 +639,174 @@ def get_ts_from_diffsource(data_type, data_dir, periods, basin_ids):
     return ts_data
 
 
-def _get_pe_q_from_ts(ts_xr_dataset):
+def _unify_owndata_ts(ts_data, basin_area, periods):
+    """Convert the streamflow of owndata to the unit of precipitation and select the periods"""
+    prcp_name = remove_unit_from_name(PRCP_NAME)
+    flow_name = remove_unit_from_name(FLOW_NAME)
+    target_unit = ts_data[prcp_name].attrs.get("units", "unknown")
+    qobs_ = ts_data[[flow_name]]
+    if qobs_[flow_name].attrs.get("units", "unknown") != target_unit:
+        r_mmd = streamflow_unit_conv(qobs_, basin_area, target_unit=target_unit)
+        ts_data[flow_name] = r_mmd[flow_name]
+        ts_data[flow_name].attrs["units"] = target_unit
+    return ts_data.sel(time=slice(periods[0], periods[1]))
+
+
+def get_ts_store_dir(data_dir):
+    """The directory in CACHE_DIR for the chunked time series store of one owndata directory
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory of owndata, where timeseries.nc is
+
+    Returns
+    -------
+    str
+        the directory of the store
+    """
+    data_dir = os.path.abspath(data_dir)
+    dir_hash = hashlib.sha1(data_dir.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(
+        CACHE_DIR, "timeseries_store", f"{os.path.basename(data_dir)}_{dir_hash}"
+    )
+
+
+def save_tsdata_as_store(
+    data_dir, store_dir=None, basin_chunk_size=100, nc_ts_file="timeseries.nc"
+):
+    """Split the time series data of owndata to basin-major chunks saved in CACHE_DIR
+
+    Each chunk is a NetCDF file with all time steps of at most basin_chunk_size basins.
+    Chunks are written one by one, and timeseries.nc is opened lazily,
+    so only one chunk is in memory at a time.
+    A store.json file records the basins of each chunk and the source file's status,
+    so that the store is rebuilt when timeseries.nc changes.
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory of owndata
+    store_dir : str, optional
+        The directory of the store, by default get_ts_store_dir(data_dir)
+    basin_chunk_size : int, optional
+        The number of basins in each chunk, by default 100
+    nc_ts_file : str, optional
+        The file name of the time series data, by default "timeseries.nc"
+
+    Returns
+    -------
+    dict
+        the manifest of the store
+    """
+    if store_dir is None:
+        store_dir = get_ts_store_dir(data_dir)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    ts_file = os.path.join(data_dir, nc_ts_file)
+    ts_stat = os.stat(ts_file)
+    chunks = []
+    with xr.open_dataset(ts_file) as ts_data:
+        basins = ts_data["basin"].values.astype(str).tolist()
+        for i, start in enumerate(range(0, len(basins), basin_chunk_size)):
+            chunk_file = f"chunk_{i:05d}.nc"
+            # isel on a lazily opened dataset only reads this chunk from disk
+            ts_data.isel(basin=slice(start, start + basin_chunk_size)).load().to_netcdf(
+                os.path.join(store_dir, chunk_file)
+            )
+            chunks.append(
+                {"file": chunk_file, "basins": basins[start : start + basin_chunk_size]}
+            )
+    manifest = {
+        "source": os.path.abspath(ts_file),
+        "source_mtime": ts_stat.st_mtime,
+        "source_size": ts_stat.st_size,
+        "basin_chunk_size": basin_chunk_size,
+        "chunks": chunks,
+    }
+    hydro_file.serialize_json(manifest, os.path.join(store_dir, "store.json"))
+    return manifest
+
+
+def _read_ts_store(data_dir, basin_chunk_size, nc_ts_file="timeseries.nc"):
+    """Read the manifest of the store, and build (or rebuild) the store when needed"""
+    store_dir = get_ts_store_dir(data_dir)
+    manifest_file = os.path.join(store_dir, "store.json")
+    if os.path.exists(manifest_file):
+        manifest = hydro_file.unserialize_json(manifest_file)
+        ts_stat = os.stat(os.path.join(data_dir, nc_ts_file))
+        if (
+            manifest["basin_chunk_size"] == basin_chunk_size
+            and manifest["source_mtime"] == ts_stat.st_mtime
+            and manifest["source_size"] == ts_stat.st_size
+        ):
+            return store_dir, manifest
+    manifest = save_tsdata_as_store(
+        data_dir, store_dir, basin_chunk_size=basin_chunk_size, nc_ts_file=nc_ts_file
+    )
+    return store_dir, manifest
+
+
+def iter_ts_blocks(data_type, data_dir, periods, basin_ids, basin_chunk_size=100):
+    """Yield the time series data of basins block by block
+
+    It is the out-of-core version of get_ts_from_diffsource: only one block of basins
+    is loaded in memory at a time. For owndata, blocks come from the chunked store
+    in CACHE_DIR (see save_tsdata_as_store), so a block is in the order of the store;
+    for other data sources, the data source reads the basins of each block.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of the data source, type in datasource_dict.keys() or 'owndata'
+    data_dir : str
+        The directory of the data source
+    periods : list of str
+        The periods of the time series data, [start_date, end_date]
+    basin_ids : list of str
+        The ids of the basins
+    basin_chunk_size : int, optional
+        The number of basins in one block, by default 100
+
+    Yields
+    ------
+    xr.Dataset
+        The time series data of a block of basins, with same format as get_ts_from_diffsource
+    """
+    if data_type != "owndata":
+        for start in range(0, len(basin_ids), basin_chunk_size):
+            yield get_ts_from_diffsource(
+                data_type,
+                data_dir,
+                periods,
+                basin_ids[start : start + basin_chunk_size],
+            )
+        return
+    store_dir, manifest = _read_ts_store(data_dir, basin_chunk_size)
+    basin_area = get_basin_area(basin_ids, data_type, data_dir)
+    wanted_basins = set(basin_ids)
+    for chunk in manifest["chunks"]:
+        chunk_basins = [basin for basin in chunk["basins"] if basin in wanted_basins]
+        if not chunk_basins:
+            continue
+        with xr.open_dataset(os.path.join(store_dir, chunk["file"])) as chunk_data:
+            ts_data = chunk_data.sel(basin=chunk_basins)
+            ts_data = _unify_owndata_ts(
+                ts_data, basin_area.sel(basin=chunk_basins), periods
+            )
+            yield ts_data.load()
+
+
+def _get_pe_q_from_ts(ts_xr_dataset, dtype=None):
     """Transform the time series data to the format that can be used in the calibration process
 
     Parameters
     ----------
     ts_xr_dataset : xr.Dataset
         The time series data
+    dtype : str, optional
+        The float precision of the arrays, such as "float32" for models run with dtype;
+        by default None, which keeps the precision of the data
 
     Returns
     -------
@@ -513,10 +820,240 @@ def _get_pe_q_from_ts(ts_xr_dataset):
         ts_xr_dataset[[prcp_name, pet_name]].to_array().to_numpy().transpose(2, 1, 0)
     )
     qobs = np.expand_dims(ts_xr_dataset[flow_name].to_numpy().transpose(1, 0), axis=2)
+    if dtype is not None:
+        p_and_e = p_and_e.astype(dtype, copy=False)
+        qobs = qobs.astype(dtype, copy=False)
 
     return p_and_e, qobs
 
 
+def get_pe_q_cache_dir(data_type, data_dir, periods, basin_ids, unit=None):
+    """The directory in CACHE_DIR for the model-ready arrays of one data setting
+
+    The name of the directory is the hash of all things that decide the arrays,
+    so different settings never share a cache and the same setting always hits it.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of the data source
+    data_dir : str
+        The directory of the data source
+    periods : list of str
+        The periods of the time series data, [start_date, end_date]
+    basin_ids : list of str
+        The ids of the basins
+    unit : str, optional
+        The unit of the cached streamflow; by default None,
+        which means the unit of precipitation as in get_ts_from_diffsource
+
+    Returns
+    -------
+    str
+        the directory of the cache
+    """
+    key = json.dumps(
+        {
+            "data_type": data_type,
+            "data_dir": os.path.abspath(data_dir),
+            "periods": [str(p) for p in periods],
+            "basin_ids": [str(b) for b in basin_ids],
+            "unit": unit,
+        },
+        sort_keys=True,
+    )
+    key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "pe_q_cache", f"{data_type}_{key_hash}")
+
+
+def _source_status(data_type, data_dir):
+    """The mtime and size of the owndata source, used to find stale caches"""
+    if data_type != "owndata":
+        # datasets from hydrodataset/hydrodatasource are not changed in place
+        return None
+    ts_stat = os.stat(os.path.join(data_dir, "timeseries.nc"))
+    return [ts_stat.st_mtime, ts_stat.st_size]
+
+
+def save_pe_q_cache(data_type, data_dir, periods, basin_ids, unit=None, cache_dir=None):
+    """Read the time series data and save model-ready arrays as .npy files
+
+    p_and_e is saved with shape [time, basin, 2] and qobs with shape [time, basin, 1],
+    as _get_pe_q_from_ts gives, together with the time and basin coordinates
+    and a meta.json file recording the setting and units.
+    Files are written to temporary names first and renamed at the end,
+    so an interrupted run never leaves a half-written cache.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of the data source
+    data_dir : str
+        The directory of the data source
+    periods : list of str
+        The periods of the time series data, [start_date, end_date]
+    basin_ids : list of str
+        The ids of the basins
+    unit : str, optional
+        The unit of the cached streamflow, by default None (the unit of precipitation)
+    cache_dir : str, optional
+        The directory of the cache, by default get_pe_q_cache_dir(...)
+
+    Returns
+    -------
+    str
+        the directory of the cache
+    """
+    if cache_dir is None:
+        cache_dir = get_pe_q_cache_dir(data_type, data_dir, periods, basin_ids, unit)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    ts_data = get_ts_from_diffsource(data_type, data_dir, periods, basin_ids)
+    flow_name = remove_unit_from_name(FLOW_NAME)
+    if unit is not None and ts_data[flow_name].attrs.get("units", "unknown") != unit:
+        basin_area = get_basin_area(basin_ids, data_type, data_dir)
+        q_conv = streamflow_unit_conv(
+            ts_data[[flow_name]], basin_area, target_unit=unit
+        )
+        ts_data[flow_name] = q_conv[flow_name]
+        ts_data[flow_name].attrs["units"] = unit
+    p_and_e, qobs = _get_pe_q_from_ts(ts_data)
+    arrays = {
+        "p_and_e": np.ascontiguousarray(p_and_e),
+        "qobs": np.ascontiguousarray(qobs),
+        "time": ts_data["time"].values,
+        "basin": ts_data["basin"].values.astype(str),
+    }
+    units = {
+        name: ts_data[name].attrs.get("units", "unknown")
+        for name in [
+            remove_unit_from_name(PRCP_NAME),
+            remove_unit_from_name(PET_NAME),
+            flow_name,
+        ]
+    }
+    for name, arr in arrays.items():
+        tmp_file = os.path.join(cache_dir, f"{name}.tmp.npy")
+        np.save(tmp_file, arr)
+        os.replace(tmp_file, os.path.join(cache_dir, f"{name}.npy"))
+    meta = {
+        "data_type": data_type,
+        "data_dir": os.path.abspath(data_dir),
+        "periods": [str(p) for p in periods],
+        "basin_ids": [str(b) for b in basin_ids],
+        "unit": unit,
+        "units": units,
+        "source_status": _source_status(data_type, data_dir),
+    }
+    # meta.json is written last, so it marks a complete cache
+    hydro_file.serialize_json(meta, os.path.join(cache_dir, "meta.json"))
+    return cache_dir
+
+
+def load_pe_q_cache(data_type, data_dir, periods, basin_ids, unit=None):
+    """Open the model-ready arrays from the cache, building the cache when needed
+
+    The arrays are opened as read-only memory maps, so nothing is read until it is used
+    and slicing them, for example by time for cross-validation, does not copy data.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of the data source
+    data_dir : str
+        The directory of the data source
+    periods : list of str
+        The periods of the time series data, [start_date, end_date]
+    basin_ids : list of str
+        The ids of the basins
+    unit : str, optional
+        The unit of the cached streamflow, by default None (the unit of precipitation)
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, dict]
+        p_and_e [time, basin, 2], qobs [time, basin, 1], times, basins and the meta info
+    """
+    cache_dir = get_pe_q_cache_dir(data_type, data_dir, periods, basin_ids, unit)
+    meta_file = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_file) or hydro_file.unserialize_json(meta_file)[
+        "source_status"
+    ] != _source_status(data_type, data_dir):
+        save_pe_q_cache(data_type, data_dir, periods, basin_ids, unit, cache_dir)
+    return open_pe_q_cache(cache_dir)
+
+
+def open_pe_q_cache(cache_dir):
+    """Open the arrays of an existing cache directory as read-only memory maps
+
+    Only the directory name is needed, so other processes can open the same cache
+    and share its pages instead of receiving copies of the arrays.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory of the cache, see get_pe_q_cache_dir
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, dict]
+        p_and_e [time, basin, 2], qobs [time, basin, 1], times, basins and the meta info
+    """
+    meta = hydro_file.unserialize_json(os.path.join(cache_dir, "meta.json"))
+    p_and_e, qobs, times, basins = (
+        np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r")
+        for name in ["p_and_e", "qobs", "time", "basin"]
+    )
+    return p_and_e, qobs, times, basins, meta
+
+
+def get_ts_from_cache(data_type, data_dir, periods, basin_ids, unit=None):
+    """Get the time series data as get_ts_from_diffsource, but backed by the cache
+
+    The variables of the returned dataset are views of the memory-mapped arrays
+    from load_pe_q_cache, so split_tsdata etc. can be used as usual
+    while the source data is only read and converted once for one setting.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of the data source
+    data_dir : str
+        The directory of the data source
+    periods : list of str
+        The periods of the time series data, [start_date, end_date]
+    basin_ids : list of str
+        The ids of the basins
+    unit : str, optional
+        The unit of the cached streamflow, by default None (the unit of precipitation)
+
+    Returns
+    -------
+    xr.Dataset
+        The time series data with prcp, pet and flow variables
+    """
+    p_and_e, qobs, times, basins, meta = load_pe_q_cache(
+        data_type, data_dir, periods, basin_ids, unit
+    )
+    prcp_name = remove_unit_from_name(PRCP_NAME)
+    pet_name = remove_unit_from_name(PET_NAME)
+    flow_name = remove_unit_from_name(FLOW_NAME)
+    coords = {"time": times, "basin": basins}
+    return xr.Dataset(
+        {
+            name: xr.DataArray(
+                arr, dims=["time", "basin"], attrs={"units": meta["units"][name]}
+            )
+            for name, arr in [
+                (prcp_name, p_and_e[:, :, 0]),
+                (pet_name, p_and_e[:, :, 1]),
+                (flow_name, qobs[:, :, 0]),
+            ]
+        },
+        coords=coords,
+    )
+
+
 def cross_val_split_tsdata(
     data_type, data_dir, cv_fold, train_period, test_period, periods, warmup, basin_ids
 ):
@@ -547,22 +1084,88 @@ def cross_val_split_tsdata(
         A tuple of xr.Dataset for training and testing data
     """
     ts_data = get_ts_from_diffsource(data_type, data_dir, periods, basin_ids)
+    return split_tsdata(ts_data, cv_fold, train_period, test_period, periods, warmup)
+
+
+def split_tsdata_windows(times, cv_fold, train_period, test_period, periods, warmup):
+    """Split time steps to index windows for cross-validation or no cross-validation
+
+    Parameters
+    ----------
+    times : array-like
+        The time coordinate of the time series data
+    cv_fold : int
+        The number of folds for cross-validation
+    train_period : list of str
+        The training period in the format ["start_date", "end_date"]
+    test_period : list of str
+        The testing period in the format ["start_date", "end_date"]
+    periods : list of str
+        The whole period in the format ["start_date", "end_date"]
+    warmup : int
+        The warmup period length in days
+
+    Returns
+    -------
+    list of tuples
+        training and testing index windows of each fold (only one fold for no cross-validation),
+        use select_by_windows to get the data of one fold
+    """
+    if cv_fold > 1:
+        # cross validation
+        return cross_valid_idx(times, periods, warmup, cv_fold)
+    # no cross validation, the same as split_train_test
+    times = pd.DatetimeIndex(times)
+    return [
+        tuple(
+            [
+                slice(
+                    times.searchsorted(pd.to_datetime(a_period[0]), side="left"),
+                    times.searchsorted(pd.to_datetime(a_period[1]), side="right"),
+                )
+            ]
+            for a_period in [train_period, test_period]
+        )
+    ]
+
+
+def split_tsdata(ts_data, cv_fold, train_period, test_period, periods, warmup):
+    """Split loaded time series data for cross-validation or no cross-validation
+
+    Parameters
+    ----------
+    ts_data : xr.Dataset
+        The time series data, for example from get_ts_from_diffsource or iter_ts_blocks
+    cv_fold : int
+        The number of folds for cross-validation
+    train_period : list of str
+        The training period in the format ["start_date", "end_date"]
+    test_period : list of str
+        The testing period in the format ["start_date", "end_date"]
+    periods : list of str
+        The whole period in the format ["start_date", "end_date"]
+    warmup : int
+        The warmup period length in days
+
+    Returns
+    -------
+    tuple of xr.Dataset
+        A tuple of xr.Dataset for training and testing data
+    """
     if cv_fold > 1:
         # cross validation
         return cross_valid_data(ts_data, periods, warmup, cv_fold)
     # no cross validation
-    periods = np.sort(
-        [train_period[0], train_period[1], test_period[0], test_period[1]]
-    )
     return split_train_test(ts_data, train_period, test_period)
 
 
-def get_rr_events(rain, flow, basin_area):
+def _rr_event_settings(flow, basin_area):
+    """The multiple converting flow's time interval to hours and the flow threshold of each basin"""
     ureg = UnitRegistry()
-    # trans unit to mm/time_interval
+    # trans unit to mm/time_interval, 100 m^3/s with the area of each basin
     flow_threshold = streamflow_unit_conv(
-        np.array([100]) * ureg.m**3 / ureg.s,
-        basin_area.isel(basin=0).to_array().to_numpy() * ureg.km**2,
+        np.full(basin_area.basin.size, 100) * ureg.m**3 / ureg.s,
+        basin_area.to_array().to_numpy()[0] * ureg.km**2,
         target_unit=flow.units,
     )
     if not (match := re.match(r"mm/(\d+)(h|d)", flow.units)):
@@ -576,15 +1179,221 @@ def get_rr_events(rain, flow, basin_area):
         multiple = num * 24
     else:
         raise ValueError(f"Unsupported unit: {unit}")
+    return multiple, np.asarray(flow_threshold)
+
+
+def _identify_basin_rr_events(rain_series, flow_series, multiple, flow_threshold):
+    """Identify the rainfall-runoff events of one basin, run in worker processes"""
+    return rainfall_runoff_event_identify(
+        rain_series,
+        flow_series,
+        multiple=multiple,
+        flow_threshold=flow_threshold,
+        rain_min=0.02 * multiple,
+    )
+
+
+def _rr_event_inputs(rain, flow, basins):
+    """The time index and [time, basin] arrays of rain and flow for event identification"""
+    # one transpose for all basins instead of to_series for each basin
+    return (
+        rain["time"].to_index(),
+        rain.sel(basin=basins).transpose("time", "basin").values,
+        flow.sel(basin=basins).transpose("time", "basin").values,
+    )
+
+
+def _iter_basin_rr_events(
+    times, rain_values, flow_values, multiple, flow_threshold, n_workers
+):
+    """Yield the index of each basin (column) and its events as soon as the basin is done"""
+    n_basin = rain_values.shape[1]
+    args = [
+        (
+            pd.Series(rain_values[:, i], index=times),
+            pd.Series(flow_values[:, i], index=times),
+            multiple,
+            flow_threshold[i],
+        )
+        for i in range(n_basin)
+    ]
+    if n_workers <= 1:
+        for i in range(n_basin):
+            yield i, _identify_basin_rr_events(*args[i])
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(_identify_basin_rr_events, *args[i]): i
+            for i in range(n_basin)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def get_rr_events(rain, flow, basin_area, n_workers=1):
+    """Identify rainfall-runoff events of all basins by the DMCA-ESR method
+
+    Parameters
+    ----------
+    rain : xr.DataArray
+        the rainfall data
+    flow : xr.DataArray
+        the streamflow data, its unit should be like mm/h, mm/3h or mm/1d
+    basin_area : xr.Dataset
+        the area of each basin, from get_basin_area
+    n_workers : int, optional
+        the number of processes for identifying basins' events concurrently, by default 1
+
+    Returns
+    -------
+    dict
+        the rainfall-runoff events (a pd.DataFrame) for each basin
+    """
+    multiple, flow_threshold = _rr_event_settings(flow, basin_area)
     print(f"flow.units = { flow.units}, multiple = {multiple}")
-    rr_events = {}
-    for basin in basin_area.basin.values:
-        rr_event = rainfall_runoff_event_identify(
-            rain.sel(basin=basin).to_series(),
-            flow.sel(basin=basin).to_series(),
-            multiple=multiple,
-            flow_threshold=flow_threshold[0],
-            rain_min=0.02 * multiple,
+    basins = basin_area.basin.values
+    events = dict(
+        _iter_basin_rr_events(
+            *_rr_event_inputs(rain, flow, basins),
+            multiple,
+            flow_threshold,
+            n_workers,
         )
-        rr_events[basin] = rr_event
-    return rr_events
+    )
+    return {basin: events[i] for i, basin in enumerate(basins)}
+
+
+def get_rr_event_cache_file(data_type, data_dir, times, basin_ids, settings):
+    """The file in CACHE_DIR for the event table of one data setting
+
+    Like get_pe_q_cache_dir, the name is the hash of all things that decide the table
+    rather than of the data, so finding the cache never reads the data.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of the data source
+    data_dir : str
+        The directory of the data source
+    times : pd.DatetimeIndex
+        The time coordinate of the data
+    basin_ids : list of str
+        The ids of the basins
+    settings : dict
+        The settings of identification, such as units and thresholds
+
+    Returns
+    -------
+    str
+        the path of the cached csv file
+    """
+    key = json.dumps(
+        {
+            "data_type": data_type,
+            "data_dir": os.path.abspath(data_dir),
+            # an owndata source changed in place gets a new cache
+            "source_status": _source_status(data_type, data_dir),
+            "periods": [str(times[0]), str(times[-1]), len(times)],
+            "basin_ids": [str(b) for b in basin_ids],
+            "settings": settings,
+        },
+        sort_keys=True,
+    )
+    key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "rr_events", f"{data_type}_{key_hash}.csv")
+
+
+def _basin_rr_event_rows(basin, events, times, flow_series):
+    """The rows of the event table for the events of one basin"""
+    start = times.get_indexer(events["BEGINNING_RAIN"])
+    end = times.get_indexer(events["END_FLOW"])
+    return pd.DataFrame(
+        {
+            "basin": str(basin),
+            "start": start,
+            "end": end,
+            "peak": [np.nanmax(flow_series[s : e + 1]) for s, e in zip(start, end)],
+        }
+    )
+
+
+def get_rr_event_table(
+    rain,
+    flow,
+    basin_area,
+    n_workers=1,
+    use_cache=True,
+    data_type=None,
+    data_dir=None,
+):
+    """Get a compact table of rainfall-runoff events of all basins
+
+    Each row is one event with its basin, the index of its start (the beginning of rain),
+    the index of its end (the end of flow) in the time coordinate and its peak flow.
+    When the data source is given, the table is cached in CACHE_DIR (see
+    get_rr_event_cache_file), and the rows of each basin are appended to the file
+    as soon as the basin is done, so the slow identification is only run once.
+
+    Parameters
+    ----------
+    rain : xr.DataArray
+        the rainfall data
+    flow : xr.DataArray
+        the streamflow data, its unit should be like mm/h, mm/3h or mm/1d
+    basin_area : xr.Dataset
+        the area of each basin, from get_basin_area
+    n_workers : int, optional
+        the number of processes for identifying basins' events concurrently, by default 1
+    use_cache : bool, optional
+        if False, identify events again even if there is a cache, by default True
+    data_type : str, optional
+        the type of the data source of rain and flow; None means no cache
+    data_dir : str, optional
+        the directory of the data source; None means no cache
+
+    Returns
+    -------
+    pd.DataFrame
+        the events with columns basin, start, end and peak, in the order of basins
+    """
+    multiple, flow_threshold = _rr_event_settings(flow, basin_area)
+    basins = basin_area.basin.values
+    times = rain["time"].to_index()
+    cache_file = None
+    if data_type is not None and data_dir is not None:
+        settings = {
+            "units": flow.units,
+            "multiple": multiple,
+            "flow_threshold": flow_threshold.tolist(),
+        }
+        cache_file = get_rr_event_cache_file(
+            data_type, data_dir, times, basins, settings
+        )
+        if use_cache and os.path.exists(cache_file):
+            return _read_rr_event_table(cache_file, basins)
+    times, rain_values, flow_values = _rr_event_inputs(rain, flow, basins)
+    basin_rows = (
+        (i, _basin_rr_event_rows(basins[i], events, times, flow_values[:, i]))
+        for i, events in _iter_basin_rr_events(
+            times, rain_values, flow_values, multiple, flow_threshold, n_workers
+        )
+    )
+    if cache_file is None:
+        tables = dict(basin_rows)
+        return pd.concat([tables[i] for i in range(len(basins))], ignore_index=True)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # a partly written table is never taken as the cache
+    part_file = f"{cache_file}.part"
+    for n, (_, rows) in enumerate(basin_rows):
+        rows.to_csv(part_file, mode="a" if n else "w", header=n == 0, index=False)
+    os.replace(part_file, cache_file)
+    return _read_rr_event_table(cache_file, basins)
+
+
+def _read_rr_event_table(cache_file, basins):
+    """Read a cached event table, whose basins are in the order they were done"""
+    table = pd.read_csv(cache_file, dtype={"basin": str})
+    order = table["basin"].map({str(basin): i for i, basin in enumerate(basins)})
+    return table.iloc[np.argsort(order.to_numpy(), kind="stable")].reset_index(
+        drop=True
+    )
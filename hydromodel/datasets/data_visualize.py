@@ -131,6 +131,8 @@ def plot_rr_events(rr_events, rain, flow, save_dir=None):
                 os.makedirs(save_dir)
             save_fig = os.path.join(save_dir, f"rr_event_{i}.png")
             plt.savefig(save_fig, bbox_inches="tight")
+            # release the figure, otherwise figures of all events are kept in memory
+            plt.close()
 
 
 # TODO: Following functions are not used in the current version of the code, maybe useful in the future
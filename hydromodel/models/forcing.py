@@ -0,0 +1,133 @@
+"""
+Inputs of models prepared once, with their parameter-free transforms
+"""
+
+import numpy as np
+
+# series which do not depend on parameters, computed from p_and_e [time, basin, feature]
+FORCING_SERIES = {
+    # precipitation, negative values of some data taken as 0, and potential evaporation,
+    # contiguous [time, basin]
+    "prcp": lambda p_and_e: np.maximum(p_and_e[:, :, 0], 0.0),
+    "pet": lambda p_and_e: np.ascontiguousarray(p_and_e[:, :, 1]),
+    # net precipitation and net evaporation of GR4J
+    "precip_net": lambda p_and_e: np.maximum(p_and_e[:, :, 0] - p_and_e[:, :, 1], 0.0),
+    "evap_net": lambda p_and_e: np.maximum(-(p_and_e[:, :, 0] - p_and_e[:, :, 1]), 0.0),
+    # indices of periods with precipitation in any basin, whose dry spells XAJ skips
+    "wet_periods": lambda p_and_e: np.flatnonzero(
+        ~(p_and_e[:, :, 0] <= 0.0).all(axis=1)
+    ),
+}
+
+
+class PreparedForcing:
+    """
+    Inputs of models prepared once and shared by all runs of a calibration
+
+    The inputs are kept contiguous in the float precision of the model, so each run neither
+    casts nor copies them, and series in FORCING_SERIES are computed on first use and kept,
+    so thousands of runs with different parameters do not repeat them.
+    Models accept it in place of p_and_e; slicing it on time, such as forcing[:warmup_length],
+    gives a view which shares the inputs and series.
+
+    Arrays are time-major ([time, basin]) as models read all basins of one period at a time.
+    """
+
+    __slots__ = ("p_and_e", "_whole", "_series", "_start")
+
+    def __init__(self, p_and_e, dtype=None):
+        """
+        Parameters
+        ----------
+        p_and_e
+            inputs of models, [time, basin, feature=2]: precipitation and potential evaporation
+        dtype
+            the float precision of models; None means that of p_and_e, float64 for other types
+        """
+        if dtype is None:
+            dtype = getattr(p_and_e, "dtype", None)
+            if dtype is None or not np.issubdtype(dtype, np.floating):
+                dtype = np.float64
+        self.p_and_e = np.ascontiguousarray(p_and_e, dtype=dtype)
+        # inputs and series of the whole period, shared by all slices
+        self._whole = self.p_and_e
+        self._series = {}
+        self._start = 0
+
+    @property
+    def shape(self):
+        return self.p_and_e.shape
+
+    @property
+    def dtype(self):
+        return self.p_and_e.dtype
+
+    def __len__(self):
+        return self.p_and_e.shape[0]
+
+    def __getitem__(self, index):
+        """Periods of the inputs, such as forcing[start:end] or forcing[start:end, :, :]"""
+        if isinstance(index, tuple):
+            index, *others = index
+            if any(other != slice(None) for other in others):
+                raise IndexError("PreparedForcing can only be sliced on time")
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise IndexError("PreparedForcing can only be sliced on time with step 1")
+        start, stop, _ = index.indices(len(self))
+        sliced = object.__new__(PreparedForcing)
+        sliced.p_and_e = self.p_and_e[start : max(start, stop)]
+        sliced._whole = self._whole
+        sliced._series = self._series
+        sliced._start = self._start + start
+        return sliced
+
+    def series(self, name):
+        """
+        A series in FORCING_SERIES of the periods of this forcing
+
+        Parameters
+        ----------
+        name
+            name of the series
+
+        Returns
+        -------
+        np.array
+            the series, [time, basin]; for "wet_periods", indices of the periods
+        """
+        if name not in self._series:
+            # computed for the whole period, so that all slices share it
+            self._series[name] = FORCING_SERIES[name](self._whole)
+        values = self._series[name]
+        end = self._start + len(self)
+        if name == "wet_periods":
+            first, last = np.searchsorted(values, [self._start, end])
+            return values[first:last] - self._start
+        return values[self._start : end]
+
+    def __repr__(self):
+        n_time, n_basin, _ = self.shape
+        return f"PreparedForcing({n_time} periods, {n_basin} basins, {self.dtype})"
+
+
+def prepare_forcing(p_and_e, dtype=None):
+    """
+    The PreparedForcing of inputs, which is p_and_e itself if it is prepared already
+
+    Parameters
+    ----------
+    p_and_e
+        inputs, [time, basin, feature], or a PreparedForcing
+    dtype
+        the float precision of the model
+
+    Returns
+    -------
+    PreparedForcing
+        the prepared inputs
+    """
+    if isinstance(p_and_e, PreparedForcing):
+        if dtype is None or p_and_e.dtype == dtype:
+            return p_and_e
+        p_and_e = p_and_e.p_and_e
+    return PreparedForcing(p_and_e, dtype)
@@ -3,8 +3,14 @@ from typing import Optional, Tuple
 import numpy as np
 from numba import jit
 
+from hydromodel.models.forcing import prepare_forcing
 from hydromodel.models.model_config import MODEL_PARAM_DICT
-from hydromodel.models.xaj import uh_conv
+from hydromodel.models.xaj import uh_conv_with_memory
+
+# variables which can be chosen with the outputs kwarg: streamflow [time, basin, 1];
+# evaporation, runoff of the production store, outflow of UH1 and UH2
+# and the series of the two stores, all [time, basin]
+GR4J_OUTPUTS = ("q_sim", "ets", "pr", "q9", "q1", "s", "r")
 
 
 # @jit
@@ -58,7 +64,37 @@ def production(
     precip_difference = p_and_e[:, 0] - p_and_e[:, 1]
     precip_net = np.maximum(precip_difference, 0.0)
     evap_net = np.maximum(-precip_difference, 0.0)
+    return production_net(precip_net, evap_net, x1, s_level)
+
+
+def production_net(
+    precip_net: np.array,
+    evap_net: np.array,
+    x1: np.array,
+    s_level: Optional[np.array] = None,
+) -> Tuple[np.array, np.array]:
+    """
+    the same as production, but from net precipitation and evaporation of the step
+
+    They do not depend on parameters, so they can be computed once for all periods,
+    see "precip_net" and "evap_net" of PreparedForcing
+
+    Parameters
+    ----------
+    precip_net
+        max(P - E, 0) of basins
+    evap_net
+        max(E - P, 0) of basins
+    x1
+        Storage reservoir parameter
+    s_level
+        S in the GR4J Model at the beginning of the step
 
+    Returns
+    -------
+    tuple
+        contains the Pr, evaporation from the store and updated S
+    """
     if s_level is None:
         s_level = 0.6 * x1
 
@@ -183,27 +219,40 @@ def routing(q9: np.array, q1: np.array, x2, x3, r_level: Optional[np.array] = No
     return q, r_updated
 
 
-def gr4j(p_and_e, parameters, warmup_length: int, return_state=False, **kwargs):
+def gr4j_step(p_and_e, parameters, states=None, memory=None, **kwargs):
     """
-    run GR4J model
+    run GR4J model from given states without warmup
 
     Parameters
     ----------
     p_and_e: ndarray
-        3-dim input -- [time, basin, variable]: precipitation and potential evaporation
+        3-dim input -- [time, basin, variable]: precipitation and potential evaporation,
+        or a PreparedForcing of them, see hydromodel.models.forcing
     parameters
         2-dim variable -- [basin, parameter]:
         the parameters are x1, x2, x3 and x4
-    warmup_length
-        length of warmup period
-    return_state
-        if True, return state values, mainly for warmup periods
+    states
+        (s, r) at the beginning of p_and_e; None means half of x1 and x3
+    memory
+        ring buffers and their slots of the two unit hydrographs at the beginning of p_and_e,
+        as returned by this function; None means the unit hydrographs start with no earlier runoff
+    kwargs
+        outputs, dtype and the model's parameter dict, see gr4j
 
     Returns
     -------
-    Union[np.array, tuple]
-        streamflow or (streamflow, states)
+    tuple
+        a dict of the chosen outputs, states and routing memory at the end of p_and_e
     """
+    outputs = kwargs.get("outputs", ("q_sim", "ets"))
+    if unknown := set(outputs) - set(GR4J_OUTPUTS):
+        raise ValueError(
+            f"No outputs {unknown} in GR4J, please choose from {GR4J_OUTPUTS}"
+        )
+    # all inputs, states and series are in one float precision
+    dtype = np.dtype(kwargs.get("dtype", "float64"))
+    forcing = prepare_forcing(p_and_e, dtype)
+    parameters = np.asarray(parameters, dtype=dtype)
     model_param_dict = kwargs.get("gr4j", None)
     if model_param_dict is None:
         model_param_dict = MODEL_PARAM_DICT["gr4j"]
@@ -218,42 +267,101 @@ def gr4j(p_and_e, parameters, warmup_length: int, return_state=False, **kwargs):
     x3 = x3_scale[0] + parameters[:, 2] * (x3_scale[1] - x3_scale[0])
     x4 = x4_scale[0] + parameters[:, 3] * (x4_scale[1] - x4_scale[0])
 
-    if warmup_length > 0:
-        # set no_grad for warmup periods
-        p_and_e_warmup = p_and_e[0:warmup_length, :, :]
-        _, _, s0, r0 = gr4j(
-            p_and_e_warmup, parameters, warmup_length=0, return_state=True, **kwargs
-        )
+    if states is None:
+        s = 0.5 * x1
+        r = 0.5 * x3
     else:
-        s0 = 0.5 * x1
-        r0 = 0.5 * x3
-    inputs = p_and_e[warmup_length:, :, :]
-    streamflow_ = np.full(inputs.shape[:2], 0.0)
-    prs = np.full(inputs.shape[:2], 0.0)
-    ets = np.full(inputs.shape[:2], 0.0)
+        s, r = states
+    inputs = forcing.p_and_e
+    # net precipitation and evaporation are parameter-free, computed once per forcing
+    precip_net = forcing.series("precip_net")
+    evap_net = forcing.series("evap_net")
+    streamflow_ = np.full(inputs.shape[:2], 0.0, dtype=dtype)
+    prs = np.full(inputs.shape[:2], 0.0, dtype=dtype)
+    # other series are only kept when they are chosen
+    series = {
+        name: np.full(inputs.shape[:2], 0.0, dtype=dtype)
+        for name in outputs
+        if name in ("ets", "s", "r")
+    }
     for i in range(inputs.shape[0]):
-        if i == 0:
-            pr, et, s = production(inputs[i, :, :], x1, s0)
-        else:
-            pr, et, s = production(inputs[i, :, :], x1, s)
+        pr, et, s = production_net(precip_net[i], evap_net[i], x1, s)
         prs[i, :] = pr
-        ets[i, :] = et
-    prs_x = np.expand_dims(prs, axis=2)
+        for name, value in (("ets", et), ("s", s)):
+            if name in series:
+                series[name][i, :] = value
     conv_q9, conv_q1 = uh_gr4j(x4)
-    q9 = np.full([inputs.shape[0], inputs.shape[1], 1], 0.0)
-    q1 = np.full([inputs.shape[0], inputs.shape[1], 1], 0.0)
+    # unit hydrographs of basins have different lengths, so they are padded with zeros
+    uh9 = np.zeros((max(map(len, conv_q9)), inputs.shape[1]))
+    uh1 = np.zeros((max(map(len, conv_q1)), inputs.shape[1]))
     for j in range(inputs.shape[1]):
-        q9[:, j : j + 1, :] = uh_conv(
-            prs_x[:, j : j + 1, :], conv_q9[j].reshape(-1, 1, 1)
-        )
-        q1[:, j : j + 1, :] = uh_conv(
-            prs_x[:, j : j + 1, :], conv_q1[j].reshape(-1, 1, 1)
-        )
+        uh9[: len(conv_q9[j]), j] = conv_q9[j]
+        uh1[: len(conv_q1[j]), j] = conv_q1[j]
+    memory9, memory1 = (None, None) if memory is None else (memory[:2], memory[2:])
+    q9, memory9 = uh_conv_with_memory(prs, uh9, memory9)
+    q1, memory1 = uh_conv_with_memory(prs, uh1, memory1)
     for i in range(inputs.shape[0]):
-        if i == 0:
-            q, r = routing(q9[i, :, 0], q1[i, :, 0], x2, x3, r0)
-        else:
-            q, r = routing(q9[i, :, 0], q1[i, :, 0], x2, x3, r)
+        q, r = routing(q9[i], q1[i], x2, x3, r)
         streamflow_[i, :] = q
-    streamflow = np.expand_dims(streamflow_, axis=2)
-    return (streamflow, ets, s, r) if return_state else (streamflow, ets)
+        if "r" in series:
+            series["r"][i, :] = r
+    series.update(
+        {"q_sim": np.expand_dims(streamflow_, axis=2), "pr": prs, "q9": q9, "q1": q1}
+    )
+    chosen = {name: series[name] for name in outputs}
+    # compiled stores compute in float64, so states are cast back
+    return (
+        chosen,
+        (s.astype(dtype, copy=False), r.astype(dtype, copy=False)),
+        (*memory9, *memory1),
+    )
+
+
+def gr4j(p_and_e, parameters, warmup_length: int, return_state=False, **kwargs):
+    """
+    run GR4J model
+
+    Parameters
+    ----------
+    p_and_e: ndarray
+        3-dim input -- [time, basin, variable]: precipitation and potential evaporation,
+        or a PreparedForcing of them, see hydromodel.models.forcing
+    parameters
+        2-dim variable -- [basin, parameter]:
+        the parameters are x1, x2, x3 and x4
+    warmup_length
+        length of warmup period
+    return_state
+        if True, return state values, mainly for warmup periods
+    kwargs
+        initial_states
+            (s, r) at the beginning of p_and_e, as returned with return_state;
+            if not given, they are half of x1 and x3
+        outputs
+            names of the returned variables, chosen from GR4J_OUTPUTS,
+            default is ("q_sim", "ets"); only chosen series are kept
+        dtype
+            the float precision of inputs, states and outputs, default is "float64"
+
+    Returns
+    -------
+    Union[np.array, tuple]
+        the chosen outputs, followed by states if return_state
+    """
+    outputs = kwargs.get("outputs", ("q_sim", "ets"))
+    if warmup_length > 0:
+        # set no_grad for warmup periods
+        p_and_e_warmup = p_and_e[0:warmup_length]
+        # no output is kept in the warmup period
+        states = gr4j(
+            p_and_e_warmup,
+            parameters,
+            warmup_length=0,
+            return_state=True,
+            **{**kwargs, "outputs": ()},
+        )
+    else:
+        states = kwargs.get("initial_states")
+    series, states, _ = gr4j_step(p_and_e[warmup_length:], parameters, states, **kwargs)
+    results = tuple(series[name] for name in outputs)
+    return (*results, *states) if return_state else results
@@ -2,34 +2,47 @@
 import numpy as np
 from numba import jit
 
+from hydromodel.models.forcing import prepare_forcing
 from hydromodel.models.model_config import MODEL_PARAM_DICT
 
+# variables which can be chosen with the outputs kwarg: streamflow [time, basin, 1];
+# effective rainfall of the last period [basin]; effective rainfall, slow flow, quick flow
+# and the series of the slow tank and the soil moisture, all [time, basin]
+HYMOD_OUTPUTS = ("q_sim", "et", "er", "qs", "qq", "x_slow", "x_loss")
 
-def hymod(p_and_e, parameters, warmup_length=30, return_state=False, **kwargs):
-    """
-    Run Hymod model
 
-    See https://www.proc-iahs.net/368/180/2015/piahs-368-180-2015.pdf for a scientific paper:
-    Quan, Z.; Teng, J.; Sun, W.; Cheng, T. & Zhang, J. (2015): Evaluation of the HYMOD model
-    for rainfall–runoff simulation using the GLUE method. Remote Sensing and GIS for Hydrology
-    and Water Resources, 180 - 185, IAHS Publ. 368. DOI: 10.5194/piahs-368-180-2015.
+def hymod_step(p_and_e, parameters, states=None, memory=None, **kwargs):
+    """
+    Run Hymod model from given states without warmup
 
     Parameters
     ----------
     p_and_e
-        precipitation and potential evapotranspiration, 3-dim variable: [time, basin, feature=1]
+        precipitation and potential evapotranspiration, 3-dim variable: [time, basin, feature=1],
+        or a PreparedForcing of them, see hydromodel.models.forcing
     parameters
          five parameters: cmax, bexp, alpha, ks, kq
-    warmup_length
-        the length of warmup period
-    return_state
-        if True, return x_slow, x_quick, x_loss, else only return streamflow
+    states
+        (x_slow, x_quick, x_loss) at the beginning of p_and_e; None means all tanks are empty
+    memory
+        not used, as all of Hymod's memory is in its tanks
+    kwargs
+        outputs, dtype and the model's parameter dict, see hymod
 
     Returns
     -------
-    Union[list, np.array]
-        streamflow, x_slow, x_quick, x_loss or streamflow
+    tuple
+        a dict of the chosen outputs, states and (empty) routing memory at the end of p_and_e
     """
+    outputs = kwargs.get("outputs", ("q_sim", "et"))
+    if unknown := set(outputs) - set(HYMOD_OUTPUTS):
+        raise ValueError(
+            f"No outputs {unknown} in Hymod, please choose from {HYMOD_OUTPUTS}"
+        )
+    # all inputs, states and series are in one float precision
+    dtype = np.dtype(kwargs.get("dtype", "float64"))
+    forcing = prepare_forcing(p_and_e, dtype)
+    parameters = np.asarray(parameters, dtype=dtype)
     model_param_dict = kwargs.get("hymod", None)
     if model_param_dict is None:
         model_param_dict = MODEL_PARAM_DICT["hymod"]
@@ -46,30 +59,32 @@ def hymod(p_and_e, parameters, warmup_length=30, return_state=False, **kwargs):
     alpha = alpha_scale[0] + parameters[:, 2] * (alpha_scale[1] - alpha_scale[0])
     ks = ks_scale[0] + parameters[:, 3] * (ks_scale[1] - ks_scale[0])
     kq = kq_scale[0] + parameters[:, 4] * (kq_scale[1] - kq_scale[0])
-    if warmup_length > 0:
-        # set no_grad for warmup periods
-        p_and_e_warmup = p_and_e[0:warmup_length, :, :]
-        _, _, x_slow, x_quick, x_loss = hymod(
-            p_and_e_warmup,
-            parameters,
-            warmup_length=0,
-            return_state=True,
-            **kwargs,
-        )
+    if states is not None:
+        # x_quick is updated in place, so the given states are copied
+        x_slow, x_quick, x_loss = (np.array(x, dtype=dtype) for x in states)
     else:
         # Initialize slow tank state
         # x_slow = 2.3503 / (ks * 22.5)
+        # states are [basin] arrays, so that they work with [basin] parameters
         x_slow = np.full(
-            (p_and_e.shape[1], 1), 0.0
+            forcing.shape[1], 0.0, dtype=dtype
         )  # --> works ok if calibration data starts with low discharge
         # Initialize state(s) of quick tank(s)
-        x_quick = np.full((p_and_e.shape[1], 3), 0.0)
+        x_quick = np.full((forcing.shape[1], 3), 0.0, dtype=dtype)
         # HYMOD PROGRAM IS SIMPLE RAINFALL RUNOFF MODEL
-        x_loss = np.full((p_and_e.shape[1], 1), 0.0)
-    precip = p_and_e[warmup_length:, :, 0]
-    pet = p_and_e[warmup_length:, :, 1]
+        x_loss = np.full(forcing.shape[1], 0.0, dtype=dtype)
+    # contiguous series, so the basins of a period are read together
+    precip = forcing.series("prcp")
+    pet = forcing.series("pet")
     t = 0
-    output = np.full(precip.shape, 0.0)
+    output = np.full(precip.shape, 0.0, dtype=dtype)
+    # other series are only kept when they are chosen
+    series = {
+        name: np.full(precip.shape, 0.0, dtype=dtype)
+        for name in outputs
+        if name not in ("q_sim", "et")
+    }
+    et = np.full(precip.shape[1], 0.0, dtype=dtype)
     # START PROGRAMMING LOOP WITH DETERMINING RAINFALL - RUNOFF AMOUNTS
     while t <= precip.shape[0] - 1:
         pval = precip[t, :]
@@ -93,11 +108,83 @@ def hymod(p_and_e, parameters, warmup_length=30, return_state=False, **kwargs):
 
         # Compute total flow for timestep
         output[t, :] = qs + outflow
+        for name, value in (
+            ("er", et),
+            ("qs", qs),
+            ("qq", outflow),
+            ("x_slow", x_slow),
+            ("x_loss", x_loss),
+        ):
+            if name in series:
+                series[name][t, :] = value
         t += 1
-    streamflow = np.expand_dims(output, axis=2)
-    if return_state:
-        return streamflow, et, x_slow, x_quick, x_loss
-    return streamflow, et
+    series.update(
+        {"q_sim": np.expand_dims(output, axis=2), "et": et.astype(dtype, copy=False)}
+    )
+    chosen = {name: series[name] for name in outputs}
+    # compiled tanks compute in float64, so states are cast back
+    states = (
+        x_slow.astype(dtype, copy=False),
+        x_quick,
+        x_loss.astype(dtype, copy=False),
+    )
+    return chosen, states, ()
+
+
+def hymod(p_and_e, parameters, warmup_length=30, return_state=False, **kwargs):
+    """
+    Run Hymod model
+
+    See https://www.proc-iahs.net/368/180/2015/piahs-368-180-2015.pdf for a scientific paper:
+    Quan, Z.; Teng, J.; Sun, W.; Cheng, T. & Zhang, J. (2015): Evaluation of the HYMOD model
+    for rainfall–runoff simulation using the GLUE method. Remote Sensing and GIS for Hydrology
+    and Water Resources, 180 - 185, IAHS Publ. 368. DOI: 10.5194/piahs-368-180-2015.
+
+    Parameters
+    ----------
+    p_and_e
+        precipitation and potential evapotranspiration, 3-dim variable: [time, basin, feature=1],
+        or a PreparedForcing of them, see hydromodel.models.forcing
+    parameters
+         five parameters: cmax, bexp, alpha, ks, kq
+    warmup_length
+        the length of warmup period
+    return_state
+        if True, return x_slow, x_quick, x_loss, else only return streamflow
+    kwargs
+        initial_states
+            (x_slow, x_quick, x_loss) at the beginning of p_and_e, as returned with
+            return_state; if not given, all tanks are empty
+        outputs
+            names of the returned variables, chosen from HYMOD_OUTPUTS,
+            default is ("q_sim", "et"); only chosen series are kept
+        dtype
+            the float precision of inputs, states and outputs, default is "float64"
+
+    Returns
+    -------
+    Union[list, np.array]
+        the chosen outputs, followed by x_slow, x_quick, x_loss if return_state
+    """
+    outputs = kwargs.get("outputs", ("q_sim", "et"))
+    if warmup_length > 0:
+        # set no_grad for warmup periods
+        p_and_e_warmup = p_and_e[0:warmup_length]
+        # no output is kept in the warmup period
+        states = hymod(
+            p_and_e_warmup,
+            parameters,
+            warmup_length=0,
+            return_state=True,
+            **{**kwargs, "outputs": ()},
+        )
+    else:
+        states = kwargs.get("initial_states")
+    series, states, _ = hymod_step(
+        p_and_e[warmup_length:], parameters, states, **kwargs
+    )
+    results = tuple(series[name] for name in outputs)
+    return (*results, *states) if return_state else results
 
 
 # @jit
@@ -0,0 +1,367 @@
+"""
+loss functions for calibration, computed by compiled kernels
+"""
+
+from functools import partial
+import numpy as np
+import pandas as pd
+from numba import jit
+
+# metrics computed by one pass of _metric_sums over the data
+METRIC_NAMES = ["RMSE", "NSE", "KGE", "logNSE", "peak_error"]
+# losses which only grow with time, so a bad simulation can be rejected early
+BOUNDED_LOSSES = ["RMSE", "NSE"]
+
+
+def _as_float(x):
+    """x as an array of its own float precision (such as float32), float64 for others"""
+    x = np.asarray(x)
+    return x if np.issubdtype(x.dtype, np.floating) else x.astype(np.float64)
+
+
+@jit(nopython=True, cache=True)
+def _metric_sums(obs, sim, valid, cols, obs_mean, log_eps):
+    """Sums needed by all metrics, accumulated in one pass over time
+
+    Parameters
+    ----------
+    obs : np.ndarray
+        observation, [time, basin]
+    sim : np.ndarray
+        simulation, [time, n_sets]; the n-th set is compared with basin cols[n]
+    valid : np.ndarray
+        bool mask of non-nan observation, [time, basin]
+    cols : np.ndarray
+        the basin of each simulation set
+    obs_mean : np.ndarray
+        mean of valid observation of each basin
+    log_eps : np.ndarray
+        the small value added before taking log of each basin
+
+    Returns
+    -------
+    np.ndarray
+        [n_sets, 7]: squared error, sum and squared sum of (sim - obs_mean),
+        sum of (obs - obs_mean) * (sim - obs_mean), squared error of log values,
+        max of sim and number of nan sim values
+    """
+    n_time, n_sets = sim.shape
+    sums = np.zeros((n_sets, 7))
+    sums[:, 5] = -np.inf
+    for t in range(n_time):
+        for j in range(n_sets):
+            s = sim[t, j]
+            if np.isnan(s):
+                sums[j, 6] += 1
+                continue
+            b = cols[j]
+            if not valid[t, b]:
+                continue
+            o = obs[t, b]
+            # deviations from the observed mean keep the sums numerically stable
+            d = s - obs_mean[b]
+            sums[j, 0] += (s - o) ** 2
+            sums[j, 1] += d
+            sums[j, 2] += d * d
+            sums[j, 3] += (o - obs_mean[b]) * d
+            log_err = np.log(max(s, 0.0) + log_eps[b]) - np.log(o + log_eps[b])
+            sums[j, 4] += log_err * log_err
+            if s > sums[j, 5]:
+                sums[j, 5] = s
+    return sums
+
+
+class MetricCalculator(object):
+    def __init__(self, obs):
+        """
+        Precompute everything of observation for metrics, once for a calibration
+
+        NOTE: the missing-value mask and statistics of observation are computed here,
+        so each call only makes one compiled pass over the simulation.
+        float32 observation and simulation are read as they are, without copies,
+        while all sums and statistics are accumulated in float64.
+
+        Parameters
+        ----------
+        obs
+            observation, [time, basin, 1], [time, basin] or [time]
+        """
+        obs = _as_float(obs)
+        self.n_time = obs.shape[0]
+        self.obs = np.ascontiguousarray(obs.reshape(self.n_time, -1))
+        self.n_basin = self.obs.shape[1]
+        self.valid = ~np.isnan(self.obs)
+        self.n_valid = self.valid.sum(axis=0)
+        if (self.n_valid == 0).any():
+            raise ValueError("There is a basin without any observation.")
+        obs_valid = np.where(self.valid, self.obs, 0.0).astype(np.float64)
+        self.obs_mean = obs_valid.sum(axis=0) / self.n_valid
+        self.obs_ss = (np.where(self.valid, obs_valid - self.obs_mean, 0.0) ** 2).sum(
+            axis=0
+        )
+        self.obs_max = np.where(self.valid, obs_valid, -np.inf).max(axis=0)
+        # 1/100 of mean flow avoids log(0) for dry periods
+        self.log_eps = np.maximum(self.obs_mean / 100, 1e-6)
+        log_obs = np.where(self.valid, np.log(obs_valid + self.log_eps), 0.0)
+        log_mean = log_obs.sum(axis=0) / self.n_valid
+        self.log_obs_ss = (np.where(self.valid, log_obs - log_mean, 0.0) ** 2).sum(
+            axis=0
+        )
+
+    def __call__(self, sim):
+        """
+        Calculate all metrics in METRIC_NAMES
+
+        Parameters
+        ----------
+        sim
+            simulation with the same shape as observation;
+            for one basin, batched simulations [time, n_sets] are also supported
+
+        Returns
+        -------
+        dict
+            metric name -> array with one value for each basin (or each set for batches)
+
+        Raises
+        ------
+        ValueError
+            there are nan values in the simulation
+        """
+        sim, cols, sums = self._sums(sim)
+        if sums[:, 6].any():
+            raise ValueError(
+                "There are nan values in the simulation data, please check the input data."
+            )
+        n = self.n_valid[cols]
+        obs_mean, obs_ss = self.obs_mean[cols], self.obs_ss[cols]
+        sim_mean_dev = sums[:, 1] / n
+        sim_std = np.sqrt(np.maximum(sums[:, 2] / n - sim_mean_dev**2, 0.0))
+        obs_std = np.sqrt(obs_ss / n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r = (sums[:, 3] / n) / (obs_std * sim_std)
+            alpha = sim_std / obs_std
+            beta = (obs_mean + sim_mean_dev) / obs_mean
+            return {
+                "RMSE": np.sqrt(sums[:, 0] / n),
+                "NSE": 1 - sums[:, 0] / obs_ss,
+                "KGE": 1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2),
+                "logNSE": 1 - sums[:, 4] / self.log_obs_ss[cols],
+                "peak_error": np.abs(sums[:, 5] - self.obs_max[cols])
+                / self.obs_max[cols],
+            }
+
+    def _sums(self, sim):
+        """Simulation as [time, n_sets], the basin of each set and the sums of _metric_sums"""
+        sim = _as_float(sim)
+        # the simulation may be shorter than observation, see loss_lower_bound
+        n_time = sim.shape[0]
+        sim = sim.reshape(n_time, -1)
+        if self.n_basin == 1:
+            cols = np.zeros(sim.shape[1], dtype=np.int64)
+        elif sim.shape[1] == self.n_basin:
+            cols = np.arange(self.n_basin)
+        else:
+            raise ValueError(
+                "The simulation should have the same basins as the observation."
+            )
+        sums = _metric_sums(
+            self.obs[:n_time],
+            np.ascontiguousarray(sim),
+            self.valid[:n_time],
+            cols,
+            self.obs_mean,
+            self.log_eps,
+        )
+        return sim, cols, sums
+
+    def loss_lower_bound(self, sim_prefix, obj_func="RMSE"):
+        """
+        A lower bound of the loss computed from the simulation of the first time steps only
+
+        Squared errors only accumulate with time, so for RMSE and 1 - NSE,
+        the loss of the whole series is never smaller than this bound.
+
+        Parameters
+        ----------
+        sim_prefix
+            simulation of the first time steps, [time_prefix, basin(, 1)]
+        obj_func
+            one of BOUNDED_LOSSES
+
+        Returns
+        -------
+        float
+            the lower bound of the mean loss of all basins
+        """
+        _, cols, sums = self._sums(sim_prefix)
+        if obj_func == "RMSE":
+            bound = np.sqrt(sums[:, 0] / self.n_valid[cols])
+        elif obj_func == "NSE":
+            bound = sums[:, 0] / self.obs_ss[cols]
+        else:
+            raise ValueError(
+                f"No lower bound for {obj_func}, use one of {BOUNDED_LOSSES}"
+            )
+        # nan simulation is not rejected here, so its error is raised by the full evaluation
+        return -np.inf if sums[:, 6].any() else bound.mean().tolist()
+
+    def loss(self, sim, obj_func="RMSE"):
+        """
+        The loss to minimize for calibration: RMSE, peak_error, or 1 - NSE/KGE/logNSE
+
+        Parameters
+        ----------
+        sim
+            simulation, see __call__
+        obj_func
+            one of METRIC_NAMES
+
+        Returns
+        -------
+        float or np.ndarray
+            the mean loss of all basins, or the loss of each set for batched simulations
+        """
+        metric = self(sim)[obj_func]
+        if obj_func in ["NSE", "KGE", "logNSE"]:
+            metric = 1 - metric
+        if self.n_basin > 1:
+            metric = metric.mean(keepdims=True)
+        if np.isnan(metric).any():
+            raise ValueError(f"{obj_func} is nan, please check the input data.")
+        # tolist is necessary for spotpy to get the value
+        # otherwise the print will incur to an issue https://github.com/thouska/spotpy/issues/319
+        return metric[0].tolist() if metric.size == 1 else metric
+
+
+def metric_loss(obj_func):
+    """
+    A loss of LOSS_DICT for one of METRIC_NAMES: obs -> (sim -> loss)
+
+    The observation is bound once, so its mask and statistics are computed once
+    for all simulations compared with it, rather than in every call of the loss.
+    """
+
+    def _bind(obs):
+        return partial(MetricCalculator(obs).loss, obj_func=obj_func)
+
+    return _bind
+
+
+def plain_loss(loss):
+    """A loss of LOSS_DICT from a function (obs, sim) -> loss with nothing to precompute"""
+
+    def _bind(obs):
+        return partial(loss, obs)
+
+    return _bind
+
+
+def get_event_windows(events, n_time, warmup_length=0):
+    """Convert events to integer windows once, so that event losses need no date math
+
+    Parameters
+    ----------
+    events : pd.DataFrame or array-like
+        a table with "start" and "end" columns (such as from get_rr_event_table)
+        or an array with shape [n_event, 2]; the indices are inclusive
+        and counted on the time axis of model inputs, i.e. warmup period included
+    n_time : int
+        the length of the time series after warmup
+    warmup_length : int, optional
+        the length of warmup period, by default 0
+
+    Returns
+    -------
+    dict
+        "start" and "end" (exclusive) of each event after warmup,
+        "flat_idx" of all events' time steps concatenated and "offsets" of each event in it
+
+    Raises
+    ------
+    ValueError
+        no event is in the period after warmup
+    """
+    if isinstance(events, pd.DataFrame):
+        events = events[["start", "end"]].to_numpy()
+    events = np.asarray(events, dtype=int).reshape(-1, 2)
+    # events partly in warmup period or out of the data are cut
+    start = np.clip(events[:, 0] - warmup_length, 0, n_time)
+    end = np.clip(events[:, 1] + 1 - warmup_length, 0, n_time)
+    in_period = end > start
+    if not in_period.any():
+        raise ValueError("There is no event in the period after warmup.")
+    start, end = start[in_period], end[in_period]
+    lengths = end - start
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    flat_idx = np.repeat(start - offsets, lengths) + np.arange(lengths.sum())
+    return {"start": start, "end": end, "flat_idx": flat_idx, "offsets": offsets}
+
+
+def event_rmse(obs, sim, event_windows):
+    """Mean of RMSEs of all events, computed from cumulative sums in one pass
+
+    Parameters
+    ----------
+    obs : np.ndarray
+        observation data, [time, basin, 1]
+    sim : np.ndarray
+        simulation data, [time, basin, 1]
+    event_windows : dict
+        from get_event_windows
+
+    Returns
+    -------
+    float
+        the mean RMSE of events
+    """
+    sq_err = (sim - obs) ** 2
+    valid = ~np.isnan(sq_err)
+    # zero at first, so the sum of [start, end) is cum[end] - cum[start]
+    cum_sq_err = np.concatenate(
+        [np.zeros_like(sq_err[:1]), np.cumsum(np.where(valid, sq_err, 0), axis=0)]
+    )
+    cum_valid = np.concatenate(
+        [np.zeros_like(valid[:1], dtype=int), np.cumsum(valid, 0)]
+    )
+    start, end = event_windows["start"], event_windows["end"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rmses = np.sqrt(
+            (cum_sq_err[end] - cum_sq_err[start]) / (cum_valid[end] - cum_valid[start])
+        )
+    rmse = np.nanmean(rmses)
+    if np.isnan(rmse) or np.isnan(sim).any():
+        raise ValueError(
+            "RMSE is nan or there are nan values in the simulation data, please check the input data."
+        )
+    return rmse.tolist()
+
+
+def event_peak_error(obs, sim, event_windows):
+    """Mean of relative errors of all events' peak flows
+
+    Parameters
+    ----------
+    obs : np.ndarray
+        observation data, [time, basin, 1]
+    sim : np.ndarray
+        simulation data, [time, basin, 1]
+    event_windows : dict
+        from get_event_windows
+
+    Returns
+    -------
+    float
+        the mean absolute relative peak error of events
+    """
+    flat_idx, offsets = event_windows["flat_idx"], event_windows["offsets"]
+    # fmax ignores nan values of observation
+    peak_obs = np.fmax.reduceat(obs[flat_idx], offsets, axis=0)
+    peak_sim = np.fmax.reduceat(sim[flat_idx], offsets, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        peak_error = np.nanmean(np.abs(peak_sim - peak_obs) / peak_obs)
+    if np.isnan(peak_error) or np.isnan(sim).any():
+        raise ValueError(
+            "Peak error is nan or there are nan values in the simulation data, please check the input data."
+        )
+    return peak_error.tolist()
@@ -8,11 +8,17 @@ FilePath: \hydro-model-xaj\hydromodel\models\model_dict.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
-import numpy as np
 from spotpy.objectivefunctions import rmse
-from hydromodel.models.xaj import xaj
-from hydromodel.models.gr4j import gr4j
-from hydromodel.models.hymod import hymod
+from hydromodel.models.losses import (
+    MetricCalculator,
+    event_peak_error,
+    event_rmse,
+    metric_loss,
+    plain_loss,
+)
+from hydromodel.models.xaj import xaj, xaj_step
+from hydromodel.models.gr4j import gr4j, gr4j_step
+from hydromodel.models.hymod import hymod, hymod_step
 
 
 def rmse43darr(obs, sim):
@@ -21,34 +27,36 @@ def rmse43darr(obs, sim):
     Parameters
     ----------
     obs : np.ndarray
-        observation data
+        observation data, [time, basin, 1]
     sim : np.ndarray
-        simulation data
+        simulation data, [time, basin, 1]
 
     Returns
     -------
-    _type_
-        _description_
+    float
+        the mean RMSE of all basins
 
     Raises
     ------
     ValueError
-        _description_
+        RMSE is nan or there are nan values in the simulation data
     """
-    rmses = np.sqrt(np.nanmean((sim - obs) ** 2, axis=0))
-    rmse = rmses.mean(axis=0)
-    if np.isnan(rmse) or any(np.isnan(sim)):
-        raise ValueError(
-            "RMSE is nan or there are nan values in the simulation data, please check the input data."
-        )
-    # tolist is necessary for spotpy to get the value
-    # otherwise the print will incur to an issue https://github.com/thouska/spotpy/issues/319
-    return rmse.tolist()
+    return MetricCalculator(obs).loss(sim, "RMSE")
 
 
+# obj_func -> loss bound once to observation: LOSS_DICT[obj_func](obs)(sim) is the loss
 LOSS_DICT = {
-    "RMSE": rmse43darr,
-    "spotpy_rmse": rmse,
+    "RMSE": metric_loss("RMSE"),
+    "spotpy_rmse": plain_loss(rmse),
+    "NSE": metric_loss("NSE"),
+    "KGE": metric_loss("KGE"),
+    "logNSE": metric_loss("logNSE"),
+    "peak_error": metric_loss("peak_error"),
+}
+
+EVENT_LOSS_DICT = {
+    "RMSE": event_rmse,
+    "peak_error": event_peak_error,
 }
 
 MODEL_DICT = {
@@ -57,3 +65,11 @@ MODEL_DICT = {
     "gr4j": gr4j,
     "hymod": hymod,
 }
+
+# models which run from given states and routing memory, see model_state.step
+STEP_DICT = {
+    "xaj_mz": xaj_step,
+    "xaj": xaj_step,
+    "gr4j": gr4j_step,
+    "hymod": hymod_step,
+}
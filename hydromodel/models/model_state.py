@@ -0,0 +1,263 @@
+"""
+States of models and stepwise simulation
+"""
+
+import numpy as np
+
+from hydromodel.models.model_dict import STEP_DICT
+
+# state variables of each model and their number of rows, in the order of return_state
+XAJ_STATE_VARIABLES = (
+    ("wu", 1),
+    ("wl", 1),
+    ("wd", 1),
+    ("s", 1),
+    ("fr", 1),
+    ("qi", 1),
+    ("qg", 1),
+)
+STATE_VARIABLES = {
+    "xaj": XAJ_STATE_VARIABLES,
+    "xaj_mz": XAJ_STATE_VARIABLES,
+    "gr4j": (("s", 1), ("r", 1)),
+    "hymod": (("x_slow", 1), ("x_quick", 3), ("x_loss", 1)),
+}
+# outputs of step if not chosen: series of streamflow and evaporation (effective rainfall)
+STEP_OUTPUTS = {
+    "xaj": ("q_sim", "es"),
+    "xaj_mz": ("q_sim", "es"),
+    "gr4j": ("q_sim", "ets"),
+    "hymod": ("q_sim", "er"),
+}
+
+
+class ModelState:
+    """
+    States of a model for a batch of basins
+
+    All state variables are rows of one [row, basin] array, so each variable is contiguous,
+    and the routing memory is kept as returned by the model's step function,
+    so a state is all a model needs to continue a simulation.
+    """
+
+    __slots__ = ("name", "values", "memory")
+
+    def __init__(self, name, values, memory=None):
+        """
+        Parameters
+        ----------
+        name
+            model's name, a key of STATE_VARIABLES
+        values
+            state variables, [row, basin]
+        memory
+            routing memory; None means the routing has no earlier runoff
+        """
+        self.name = name
+        self.values = values
+        self.memory = memory
+
+    @classmethod
+    def from_tuple(cls, name, states, memory=None):
+        """
+        Build a state from states of a model, such as those returned with return_state
+
+        Parameters
+        ----------
+        name
+            model's name
+        states
+            state variables in the order of STATE_VARIABLES[name], each [basin] or [basin, row]
+        memory
+            routing memory
+
+        Returns
+        -------
+        ModelState
+            the state
+        """
+        rows = [np.reshape(state, (np.shape(state)[0], -1)).T for state in states]
+        values = np.concatenate(rows)
+        # float states keep their precision, such as float32 of models run with dtype
+        if not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(float)
+        return cls(name, values, memory)
+
+    @property
+    def n_basin(self):
+        return self.values.shape[1]
+
+    def to_tuple(self):
+        """
+        State variables in the order of return_state, which can be used as initial_states of models
+
+        Returns
+        -------
+        tuple
+            views of the rows, [basin] or [basin, row]
+        """
+        return tuple(self[variable] for variable, _ in STATE_VARIABLES[self.name])
+
+    def __getitem__(self, variable):
+        start = 0
+        for name, n_row in STATE_VARIABLES[self.name]:
+            if name == variable:
+                if n_row == 1:
+                    return self.values[start]
+                return self.values[start : start + n_row].T
+            start += n_row
+        raise KeyError(f"{self.name} has no state variable {variable}")
+
+    def copy(self):
+        memory = self.memory
+        if isinstance(memory, tuple):
+            memory = tuple(np.array(x) for x in memory)
+        elif memory is not None:
+            memory = np.array(memory)
+        return ModelState(self.name, self.values.copy(), memory)
+
+    def save(self, file, **metadata):
+        """
+        Save the state, with its routing memory, in a small binary (npz) file
+
+        Parameters
+        ----------
+        file
+            path of the file; ".npz" is appended if missing
+        metadata
+            arrays saved together, such as basin ids and the time of the state
+        """
+        arrays = {"name": np.array(self.name), "values": self.values}
+        if isinstance(self.memory, tuple):
+            arrays["n_memory"] = np.array(len(self.memory))
+            for i, memory in enumerate(self.memory):
+                arrays[f"memory_{i}"] = memory
+        elif self.memory is not None:
+            arrays["memory"] = self.memory
+        np.savez(file, **arrays, **{f"meta_{k}": v for k, v in metadata.items()})
+
+    @classmethod
+    def load(cls, file):
+        """
+        Load a state saved by save
+
+        Parameters
+        ----------
+        file
+            path of the file
+
+        Returns
+        -------
+        tuple
+            the ModelState and a dict of its metadata
+        """
+        with np.load(file, allow_pickle=False) as data:
+            if "n_memory" in data:
+                memory = tuple(data[f"memory_{i}"] for i in range(data["n_memory"]))
+            else:
+                memory = data["memory"] if "memory" in data else None
+            metadata = {k[5:]: data[k] for k in data.files if k.startswith("meta_")}
+            return cls(str(data["name"]), data["values"], memory), metadata
+
+    def __repr__(self):
+        variables = ", ".join(name for name, _ in STATE_VARIABLES[self.name])
+        return f"ModelState({self.name}: {self.n_basin} basins; {variables})"
+
+
+def step(state, p_and_e_chunk, params, model, param_range=None, outputs=None):
+    """
+    Advance a model from a state over a chunk of inputs
+
+    Stepping over chunks one after another gives the same result as one simulation of
+    the whole period, as routing memory is carried in the state; history is never re-run.
+
+    Parameters
+    ----------
+    state
+        ModelState at the beginning of the chunk; None means the model's default states
+    p_and_e_chunk
+        inputs of any number of periods, [time, basin, feature]
+    params
+        normalized parameters, [basin, n_params]
+    model
+        model's config, such as {"name": "xaj_mz", ...}
+    param_range
+        the dict of model's parameters, see read_model_param_dict;
+        None means the default ranges
+    outputs
+        names of the returned variables, see the outputs kwarg of the model;
+        None means STEP_OUTPUTS of the model
+
+    Returns
+    -------
+    tuple
+        the chosen outputs of the chunk, by default streamflow [time, basin, 1] and
+        evaporation, followed by the new ModelState at the end of the chunk;
+        the given state is not changed
+    """
+    if param_range is None:
+        param_range = {}
+    if outputs is None:
+        outputs = STEP_OUTPUTS[model["name"]]
+    states, memory = (None, None) if state is None else (state.to_tuple(), state.memory)
+    series, states, memory = STEP_DICT[model["name"]](
+        p_and_e_chunk,
+        params,
+        states,
+        memory,
+        **{**model, **param_range, "outputs": outputs},
+    )
+    new_state = ModelState.from_tuple(model["name"], states, memory)
+    return *(series[name] for name in outputs), new_state
+
+
+def warmup_state(
+    p_and_e_warmup,
+    params,
+    model,
+    param_range=None,
+    initial_state=None,
+    chunk_length=None,
+):
+    """
+    The state at the end of a warmup period, the same as in a model's own warmup
+
+    Models keep the states of warmup but not the runoff still being routed, so the routing
+    memory of the state is dropped and routing after warmup starts with no earlier runoff.
+
+    Parameters
+    ----------
+    p_and_e_warmup
+        inputs of the warmup period, [time, basin, feature]; it may be empty
+    params
+        normalized parameters, [basin, n_params]
+    model
+        model's config
+    param_range
+        the dict of model's parameters; None means the default ranges
+    initial_state
+        ModelState at the beginning of warmup; None means the model's default states
+    chunk_length
+        the number of time steps of each step call; None means the whole period at once
+
+    Returns
+    -------
+    ModelState
+        the state after warmup, without routing memory
+    """
+    n_time = p_and_e_warmup.shape[0]
+    if chunk_length is None:
+        chunk_length = max(n_time, 1)
+    state = initial_state
+    # an empty period still gives the default states
+    for start in range(0, max(n_time, 1), chunk_length):
+        (state,) = step(
+            state,
+            p_and_e_warmup[start : start + chunk_length],
+            params,
+            model,
+            param_range,
+            outputs=(),
+        )
+    state.memory = None
+    return state
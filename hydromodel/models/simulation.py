@@ -0,0 +1,313 @@
+"""
+Batched, ensemble and chunked simulations
+"""
+
+import os
+
+import numpy as np
+
+from hydromodel.models.model_dict import MODEL_DICT
+from hydromodel.models.model_state import step, warmup_state
+
+
+def simulate_param_sets(
+    p_and_e, params, warmup_length, model, param_range, batch_size=256
+):
+    """
+    Simulate many parameter sets of one basin, batch by batch
+
+    All models are vectorized over the basin dimension, so a batch of parameter sets
+    is run in one model call with the basin's inputs broadcast to every set;
+    only one batch of simulations is in memory at a time.
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of one basin, [time, 1, feature]
+    params
+        normalized parameter sets, [n_sets, n_params]
+    warmup_length
+        the length of warmup period
+    model
+        model's config, such as {"name": "xaj_mz", ...}
+    param_range
+        the dict of model's parameters, see read_model_param_dict
+    batch_size
+        the number of parameter sets in one model call
+
+    Yields
+    ------
+    tuple
+        the index of the first set in the batch and streamflow of the batch,
+        [time - warmup_length, n_batch, 1]
+    """
+    n_time, _, n_feature = p_and_e.shape
+    for start in range(0, params.shape[0], batch_size):
+        batch = params[start : start + batch_size]
+        inputs = np.broadcast_to(p_and_e, (n_time, batch.shape[0], n_feature))
+        (q_sim,) = MODEL_DICT[model["name"]](
+            inputs,
+            batch,
+            warmup_length=warmup_length,
+            outputs=("q_sim",),
+            **model,
+            **param_range,
+        )
+        yield start, q_sim
+
+
+def run_warmup(p_and_e, params, model, param_range, initial_states=None):
+    """
+    Run a model over a warmup period and return its final states
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of the warmup period, [time, basin, feature]
+    params
+        normalized parameters, [basin, n_params]
+    model
+        model's config
+    param_range
+        the dict of model's parameters, see read_model_param_dict
+    initial_states
+        states at the beginning of the warmup period; None means the model's defaults
+
+    Returns
+    -------
+    tuple
+        states of the model, each with basin as the first dimension
+    """
+    states = MODEL_DICT[model["name"]](
+        p_and_e,
+        params,
+        warmup_length=0,
+        return_state=True,
+        initial_states=initial_states,
+        outputs=(),
+        **model,
+        **param_range,
+    )
+    return tuple(states)
+
+
+def ensemble_simulate(
+    p_and_e_ens,
+    params,
+    model,
+    param_range,
+    initial_states=None,
+    p_and_e_warmup=None,
+    probs=None,
+):
+    """
+    Simulate all members of a forcing ensemble in one model call
+
+    All members start from the same states, which are given or computed once from
+    the shared warmup forcing; members are stacked on the basin dimension of the model,
+    so parameters and states are repeated for each member.
+
+    Parameters
+    ----------
+    p_and_e_ens
+        ensemble forcing, [time, member, basin, feature]
+    params
+        normalized parameters shared by all members, [basin, n_params]
+    model
+        model's config
+    param_range
+        the dict of model's parameters, see read_model_param_dict
+    initial_states
+        states at the beginning of p_and_e_warmup (or p_and_e_ens if no warmup forcing),
+        as returned by run_warmup; None means the model's defaults
+    p_and_e_warmup
+        observed forcing before the ensemble, [time, basin, feature]; None means no warmup
+    probs
+        if given, quantiles of these probabilities over members are returned
+        instead of every member
+
+    Returns
+    -------
+    np.array
+        streamflow of members [time, member, basin],
+        or its quantiles [n_probs, time, basin] when probs is given
+    """
+    n_time, n_member, n_basin, n_feature = p_and_e_ens.shape
+    if p_and_e_warmup is not None:
+        initial_states = run_warmup(
+            p_and_e_warmup, params, model, param_range, initial_states
+        )
+    if initial_states is not None:
+        initial_states = tuple(
+            np.concatenate([np.asarray(state)] * n_member, axis=0)
+            for state in initial_states
+        )
+    (q_sim,) = MODEL_DICT[model["name"]](
+        p_and_e_ens.reshape(n_time, n_member * n_basin, n_feature),
+        np.tile(params, (n_member, 1)),
+        warmup_length=0,
+        initial_states=initial_states,
+        outputs=("q_sim",),
+        **model,
+        **param_range,
+    )
+    q_sim = q_sim.reshape(n_time, n_member, n_basin)
+    if probs is None:
+        return q_sim
+    return np.quantile(q_sim, probs, axis=1)
+
+
+def simulate_in_chunks(
+    p_and_e,
+    params,
+    warmup_length,
+    model,
+    param_range=None,
+    chunk_length=8760,
+    sink=None,
+    initial_state=None,
+):
+    """
+    Run a model over a long record block by block, carrying states over block boundaries
+
+    Only one block of inputs and model intermediates is in memory at a time, so the peak
+    memory is bounded by chunk_length, not by the record length; the result is the same as
+    one run of the whole record with the same warmup.
+
+    Parameters
+    ----------
+    p_and_e
+        inputs [time, basin, feature]; any array which can be sliced on time, such as np.memmap
+    params
+        normalized parameters, [basin, n_params]
+    warmup_length
+        the length of warmup period
+    model
+        model's config
+    param_range
+        the dict of model's parameters, see read_model_param_dict; None means the default ranges
+    chunk_length
+        the number of time steps in a block
+    sink
+        where streamflow of each block is written: an array (or np.memmap) of
+        [time - warmup_length, basin, 1], the path of a .npy file to be created as a memmap,
+        or a callable sink(start, q_sim, e_sim) with the index of the first step of the block;
+        None means a new array; new arrays and files have the dtype of the model's config
+    initial_state
+        ModelState at the beginning of p_and_e; None means the model's defaults
+
+    Returns
+    -------
+    tuple
+        the sink (streamflow unless a callable is given) and the ModelState at the end
+    """
+    n_time, n_basin = p_and_e.shape[:2]
+    shape = (n_time - warmup_length, n_basin, 1)
+    dtype = model.get("dtype", "float64")
+    if sink is None:
+        sink = np.full(shape, np.nan, dtype=dtype)
+    elif isinstance(sink, (str, os.PathLike)):
+        sink = np.lib.format.open_memmap(sink, mode="w+", dtype=dtype, shape=shape)
+    state = initial_state
+    if warmup_length > 0:
+        state = warmup_state(
+            p_and_e[:warmup_length],
+            params,
+            model,
+            param_range,
+            initial_state,
+            chunk_length,
+        )
+    for start in range(warmup_length, n_time, chunk_length):
+        end = min(start + chunk_length, n_time)
+        q_sim, e_sim, state = step(
+            state, np.asarray(p_and_e[start:end]), params, model, param_range
+        )
+        if callable(sink):
+            sink(start - warmup_length, q_sim, e_sim)
+        else:
+            sink[start - warmup_length : end - warmup_length] = q_sim
+    if isinstance(sink, np.memmap):
+        sink.flush()
+    return sink, state
+
+
+def screen_simulation(
+    p_and_e,
+    params,
+    warmup_length,
+    model,
+    param_range,
+    metric_calculator=None,
+    obj_func="RMSE",
+    threshold=None,
+    screen_length=0,
+):
+    """
+    Run a model, but stop early when the parameters are surely worse than threshold
+
+    All models are causal, so the simulation of the first warmup_length + screen_length
+    time steps is the same as in the full run. The loss of this prefix is a lower bound
+    of the full loss for BOUNDED_LOSSES; if it is already larger than threshold,
+    the full simulation is not run; otherwise, the rest of the simulation continues from
+    the states at the end of the prefix, so no time step is simulated twice.
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of model, [time, basin, feature], or a PreparedForcing of them
+    params
+        parameters of model, [basin, parameter]
+    warmup_length
+        the length of warmup period
+    model
+        model's config
+    param_range
+        the dict of model's parameters
+    metric_calculator
+        MetricCalculator of observation after warmup; None means no screening
+    obj_func
+        one of BOUNDED_LOSSES
+    threshold
+        the rejection threshold; None means no screening
+    screen_length
+        the number of time steps after warmup in the screening run
+
+    Returns
+    -------
+    tuple
+        (simulation, None) when the full simulation is run,
+        otherwise (None, lower bound of the loss)
+    """
+    if (
+        metric_calculator is None
+        or threshold is None
+        or not 0 < screen_length < p_and_e.shape[0] - warmup_length
+    ):
+        (sim,) = MODEL_DICT[model["name"]](
+            p_and_e,
+            params,
+            warmup_length=warmup_length,
+            outputs=("q_sim",),
+            **model,
+            **param_range,
+        )
+        return sim, None
+    state = warmup_state(p_and_e[:warmup_length], params, model, param_range)
+    screen_end = warmup_length + screen_length
+    sim_prefix, state = step(
+        state,
+        p_and_e[warmup_length:screen_end],
+        params,
+        model,
+        param_range,
+        outputs=("q_sim",),
+    )
+    bound = metric_calculator.loss_lower_bound(sim_prefix, obj_func)
+    if bound > threshold:
+        return None, bound
+    # the rest continues from the states at the end of the prefix
+    sim_rest, _ = step(
+        state, p_and_e[screen_end:], params, model, param_range, outputs=("q_sim",)
+    )
+    return np.concatenate([sim_prefix, sim_rest]), None
@@ -14,9 +14,28 @@ import numpy as np
 from numba import jit
 from scipy.special import gamma
 
+from hydromodel.models.forcing import prepare_forcing
 from hydromodel.models.model_config import MODEL_PARAM_DICT
 
 PRECISION = 1e-5
+# variables which can be chosen with the outputs kwarg, all [time, basin, 1]:
+# streamflow, evaporation, impervious/surface/interflow/groundwater runoff,
+# routed interflow/groundwater and the series of storages
+XAJ_OUTPUTS = (
+    "q_sim",
+    "es",
+    "rim",
+    "rs",
+    "ri",
+    "rg",
+    "qi",
+    "qg",
+    "wu",
+    "wl",
+    "wd",
+    "s",
+    "fr",
+)
 
 
 # @jit
@@ -101,7 +120,7 @@ def calculate_prcp_runoff(b, im, wm, w0, pe) -> tuple[np.array, np.array]:
             pe - (wm - w0) + wm * (1.0 - np.minimum(a + pe, wmm) / wmm) ** (1.0 + b),
             pe - (wm - w0),
         ),
-        np.full(pe.shape, 0.0),
+        np.full_like(pe, 0.0),
     )
     r = np.maximum(r_cal, 0.0)
     # separate impervious part with the other
@@ -174,10 +193,38 @@ def calculate_w_storage(
     return wu_, wl_, wd_
 
 
+def calculate_w_storage_dry(um, lm, dm, wu0, wl0, wd0, el, ed, pe):
+    """
+    Update the soil moisture values of the three layers when no basin has net precipitation
+
+    It is calculate_w_storage with pe <= 0.0 and r = 0.0 for all basins,
+    so only evaporation is removed from the layers.
+
+    Parameters
+    ----------
+    um, lm, dm, wu0, wl0, wd0, el, ed
+        see calculate_w_storage
+    pe
+        net precipitation, which is not positive in any basin
+
+    Returns
+    -------
+    tuple[np.array,np.array,np.array]
+        wu,wl,wd -- soil moisture in upper, lower and deep layer
+    """
+    wu = np.maximum(wu0 + pe, 0.0)
+    wu_ = np.minimum(wu, um)
+    wl_ = np.clip(wl0 - el, a_min=0.0, a_max=lm)
+    wd_ = np.clip(wd0 - ed, a_min=0.0, a_max=dm)
+    return wu_, wl_, wd_
+
+
 def generation(p_and_e, k, b, im, um, lm, dm, c, wu0=None, wl0=None, wd0=None) -> tuple:
     """
     Single-step runoff generation in XAJ.
 
+    Negative precipitation, as in some data, is taken as 0.
+
     Parameters
     ----------
     p_and_e
@@ -210,8 +257,13 @@ def generation(p_and_e, k, b, im, um, lm, dm, c, wu0=None, wl0=None, wd0=None) -
     """
     # make sure physical variables' value ranges are correct
     prcp = np.maximum(p_and_e[:, 0], 0.0)
+    return _generation(prcp, p_and_e[:, 1], k, b, im, um, lm, dm, c, wu0, wl0, wd0)
+
+
+def _generation(prcp, pet, k, b, im, um, lm, dm, c, wu0, wl0, wd0) -> tuple:
+    """generation of a period whose precipitation prcp is not negative, [basin]"""
     # get potential evapotranspiration
-    pet = np.maximum(p_and_e[:, 1] * k, 0.0)
+    pet = np.maximum(pet * k, 0.0)
     # wm
     wm = um + lm + dm
     if wu0 is None:
@@ -234,6 +286,12 @@ def generation(p_and_e, k, b, im, um, lm, dm, c, wu0=None, wl0=None, wd0=None) -
     # Calculate the runoff generated by net precipitation
     prcp_difference = prcp - e
     pe = np.maximum(prcp_difference, 0.0)
+    if not (pe > 0.0).any():
+        # a dry period of all basins, such as most hours of hourly records:
+        # no runoff is generated, so only evaporation is removed from the storages
+        no_runoff = np.zeros_like(pe)
+        w = calculate_w_storage_dry(um, lm, dm, wu0, wl0, wd0, el, ed, prcp_difference)
+        return (no_runoff, no_runoff, e, pe), w
     r, rim = calculate_prcp_runoff(b, im, wm, w0, pe)
     # Update wu, wl, wd
     wu, wl, wd = calculate_w_storage(
@@ -313,6 +371,8 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
         )
     # r=0, then r/pe must be 0
     fr_mask = r > 0.0
+    if not fr_mask.any():
+        return free_water_recession(s0, fr, sm, ex, ki, kg, book=book)
     fr[fr_mask] = r[fr_mask] / pe[fr_mask]
     if np.isnan(fr).any():
         raise ArithmeticError("Please check pe's data! there may be 0.0")
@@ -333,7 +393,7 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
             )
         # the first condition should be r > 0.0, when r=0, rs must be 0, fig 6-12 in EH or fig 5-4 in HF
         # so we have to use "pe" carefully!!! when r>0.0, we use pe, otherwise we don't use it!!!
-        rs = np.full(r.shape, 0.0)
+        rs = np.full_like(r, 0.0)
         rs[fr_mask] = np.where(
             pe[fr_mask] + au[fr_mask] < ms[fr_mask],
             # equation 2-85 in HF
@@ -379,7 +439,7 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
             )
 
         # rs's mask is keep with fr_mask
-        rs = np.full(r.shape, 0.0)
+        rs = np.full_like(r, 0.0)
         rs[fr_mask] = np.where(
             pe[fr_mask] + au[fr_mask] < smmf[fr_mask],
             (
@@ -417,6 +477,103 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
     return (rs, ri, rg), (s1, fr)
 
 
+def free_water_capacity(fr, sm, ex, book="HF"):
+    """
+    The upper limit of the free water storage in a period without runoff
+
+    Parameters
+    ----------
+    fr
+        runoff area
+    sm, ex
+        see sources
+    book
+        "HF": sm is fixed; "EH": the capacity of the runoff area, see sources
+
+    Returns
+    -------
+    np.array
+        the capacity
+    """
+    if book == "HF":
+        return sm
+    if book == "EH":
+        smmf = sm * (1.0 + ex) * (1 - (1 - fr) ** (1 / ex))
+        return smmf / (1 + ex)
+    raise ValueError("Please set book as 'HF' or 'EH'!")
+
+
+def free_water_recession(s0, fr, sm, ex, ki, kg, book="HF"):
+    """
+    Divide the runoff to different sources when no basin has runoff in a period
+
+    It gives the same result as sources (and sources5mm, with its ki and kg of one piece)
+    with r = 0.0 for all basins: the runoff area is not changed, there is no surface runoff
+    and the free water storage only releases interflow and groundwater,
+    so the masked computation of surface runoff is skipped.
+
+    Parameters
+    ----------
+    s0
+        free water capacity of last period
+    fr
+        runoff area of last period
+    sm, ex, ki, kg
+        see sources
+    book
+        "HF" or "EH", see sources
+
+    Returns
+    -------
+    tuple[tuple, tuple]
+        (rs, ri, rg), (s1, fr), see sources
+    """
+    s = np.minimum(s0, free_water_capacity(fr, sm, ex, book))
+    ri = ki * s * fr
+    rg = kg * s * fr
+    s1 = s * (1 - ki - kg)
+    return (np.zeros_like(s1), ri, rg), (s1, fr)
+
+
+def piece_coefficients(ki, kg, time_interval_hours, n_pieces):
+    """
+    Outflow coefficients of the free water storage for a piece of a period, see sources5mm
+
+    Parameters
+    ----------
+    ki
+        outflow coefficients of the free water storage to interflow relationships, daily
+    kg
+        outflow coefficients of the free water storage to groundwater relationships, daily
+    time_interval_hours
+        the time interval of the model
+    n_pieces
+        the number of pieces which the runoff of a period is divided into
+
+    Returns
+    -------
+    tuple
+        kss_d and kg_d of a piece
+    """
+    # Convert Ki and Kg according to the time interval, as they are defined based on a 24-hour time interval
+    hours_per_day = 24
+    # Non-divisible case, add 1 to the period
+    residue_temp = hours_per_day % time_interval_hours
+    if residue_temp != 0:
+        residue_temp = 1
+    period_num_1d = int(hours_per_day / time_interval_hours) + residue_temp
+    # When kss+kg>1, the square root becomes a complex number during even root calculation, which will cause an error here.
+    # Also, be aware that the denominator may be 0, kss cannot be 0.
+    # Restrict the value of kss+kg.
+    kss_period = (1 - (1 - (ki + kg)) ** (1 / period_num_1d)) / (1 + kg / ki)
+    kg_period = kss_period * kg / ki
+    kss_d = (1 - (1 - (kss_period + kg_period)) ** (1 / n_pieces)) / (
+        1 + kg_period / kss_period
+    )
+    kg_d = kss_d * kg_period / kss_period
+    return kss_d, kg_d
+
+
 def sources5mm(
     pe,
     runoff,
@@ -464,19 +621,6 @@ def sources5mm(
         (fr_ds[-1], s_ds[-1]): state variables' final value;
         all variables are numpy array
     """
-    # Convert Ki and Kg according to the time interval, as they are defined based on a 24-hour time interval
-    hours_per_day = 24
-    # Non-divisible case, add 1 to the period
-    residue_temp = hours_per_day % time_interval_hours
-    if residue_temp != 0:
-        residue_temp = 1
-    period_num_1d = int(hours_per_day / time_interval_hours) + residue_temp
-    # When kss+kg>1, the square root becomes a complex number during even root calculation, which will cause an error here.
-    # Also, be aware that the denominator may be 0, kss cannot be 0.
-    # Restrict the value of kss+kg.
-    kss_period = (1 - (1 - (ki + kg)) ** (1 / period_num_1d)) / (1 + kg / ki)
-    kg_period = kss_period * kg / ki
-
     # Maximum free water storage capacity depth of the basin
     smm = sm * (1 + ex)
     if s0 is None:
@@ -487,26 +631,22 @@ def sources5mm(
     fr = np.copy(fr0)
     fr_mask = runoff > 0.0
     fr[fr_mask] = runoff[fr_mask] / pe[fr_mask]
-    if np.all(runoff < 5):
-        n = 1
-    else:
-        # when modeling multiple basins, the number of divides is not the same, so we use the maximum number
-        r_max = np.max(runoff)
-        residue_temp = r_max % 5
-        if residue_temp != 0:
-            residue_temp = 1
-        n = int(r_max / 5) + residue_temp
-    rn = runoff / n
-    pen = pe / n
-    kss_d = (1 - (1 - (kss_period + kg_period)) ** (1 / n)) / (
-        1 + kg_period / kss_period
-    )
-    kg_d = kss_d * kg_period / kss_period
+    # each basin's runoff is divided into its own number of <5mm pieces, so that
+    # a basin's result does not depend on other basins modeled together;
+    # the loop runs to the maximum number, and a basin is not updated after its last piece
+    n_basin = np.maximum(np.ceil(runoff / 5), 1.0)
+    n = int(np.max(n_basin))
+    rn = runoff / n_basin
+    pen = pe / n_basin
+    kss_d, kg_d = piece_coefficients(ki, kg, time_interval_hours, n_basin)
+    if not fr_mask.any():
+        # no runoff in any basin, so there is only one piece
+        return free_water_recession(s0, fr, sm, ex, kss_d, kg_d, book=book)
     # kss_d = kss_period
     # kg_d = kg_period
-    rs = np.full(runoff.shape, 0.0)
-    rss = np.full(runoff.shape, 0.0)
-    rg = np.full(runoff.shape, 0.0)
+    rs = np.full_like(runoff, 0.0)
+    rss = np.full_like(runoff, 0.0)
+    rg = np.full_like(runoff, 0.0)
 
     s_ds = []
     fr_ds = []
@@ -534,7 +674,7 @@ def sources5mm(
                 raise ValueError(
                     "Error: NaN values detected. Try set clip function or check your data!!!"
                 )
-            rs_j = np.full(rn.shape, 0.0)
+            rs_j = np.full_like(rn, 0.0)
             rs_j[fr_mask] = np.where(
                 pen[fr_mask] + au[fr_mask] < smm[fr_mask],
                 # equation 5-26 in HF
@@ -569,7 +709,7 @@ def sources5mm(
                 raise ValueError(
                     "Error: NaN values detected. Try set clip function or check your data!!!"
                 )
-            rs_j = np.full(rn.shape, 0.0)
+            rs_j = np.full_like(rn, 0.0)
             rs_j[fr_mask] = np.where(
                 pen[fr_mask] + au[fr_mask] < smmf[fr_mask],
                 (
@@ -599,16 +739,104 @@ def sources5mm(
         rg_j = s_d * kg_d * fr_d
         s1_d = s_d * (1 - kss_d - kg_d)
 
-        rs = rs + rs_j
-        rss = rss + rss_j
-        rg = rg + rg_j
+        active = j < n_basin
+        rs = rs + np.where(active, rs_j, 0.0)
+        rss = rss + np.where(active, rss_j, 0.0)
+        rg = rg + np.where(active, rg_j, 0.0)
         # Assign s_d and fr_d to the arrays as initial values for the next segment
-        s_ds.append(s1_d)
+        s_ds.append(np.where(active, s1_d, s0_d))
         fr_ds.append(fr_d)
 
     return (rs, rss, rg), (s_ds[-1], fr_ds[-1])
 
 
+@jit(nopython=True)
+def _dry_periods(pet, k, um, lm, dm, c, cap, fr, ki, kg, wu, wl, wd, s):
+    """Evaporation and recession of each basin in periods without precipitation, see dry_periods"""
+    n_time, n_basin = pet.shape
+    e = np.empty_like(pet)
+    ri = np.empty_like(pet)
+    rg = np.empty_like(pet)
+    wus = np.empty_like(pet)
+    wls = np.empty_like(pet)
+    wds = np.empty_like(pet)
+    ss = np.empty_like(pet)
+    for j in range(n_basin):
+        wu0, wl0, wd0, s0 = wu[j], wl[j], wd[j], s[j]
+        for t in range(n_time):
+            # the same operations as generation and sources with prcp = 0 and r = 0
+            ep = pet[t, j] * k[j]
+            if ep < 0.0:
+                ep = 0.0
+            eu = ep if wu0 >= ep else wu0
+            ed = 0.0
+            if wl0 < c[j] * lm[j] and wl0 < c[j] * (ep - eu):
+                ed = c[j] * (ep - eu) - wl0
+            if wu0 >= ep:
+                el = 0.0
+            elif wl0 >= c[j] * lm[j]:
+                el = (ep - eu) * wl0 / lm[j]
+            elif wl0 >= c[j] * (ep - eu):
+                el = c[j] * (ep - eu)
+            else:
+                el = wl0
+            e_t = eu + el + ed
+            wu0 = wu0 + (0.0 - e_t)
+            wu0 = min(wu0 if wu0 > 0.0 else 0.0, um[j])
+            wl0 = min(max(wl0 - el, 0.0), lm[j])
+            wd0 = min(max(wd0 - ed, 0.0), dm[j])
+            s_t = cap[j] if s0 > cap[j] else s0
+            ri[t, j] = ki[j] * s_t * fr[j]
+            rg[t, j] = kg[j] * s_t * fr[j]
+            s0 = s_t * (1 - ki[j] - kg[j])
+            e[t, j] = e_t
+            wus[t, j], wls[t, j], wds[t, j], ss[t, j] = wu0, wl0, wd0, s0
+    return e, ri, rg, wus, wls, wds, ss
+
+
+def dry_periods(p_and_e, k, um, lm, dm, c, sm, ex, ki, kg, w, s, fr, book="HF"):
+    """
+    Runoff generation and sources of periods without precipitation in any basin
+
+    Without precipitation there is no runoff, so a period only removes evaporation from
+    the soil moisture and releases interflow and groundwater from the free water storage;
+    all periods of a dry spell are run in one compiled loop, with the same result as
+    generation and sources period by period.
+
+    Parameters
+    ----------
+    p_and_e
+        precipitation (zero or less) and potential evapotranspiration, [time, basin, feature=2]
+    k, um, lm, dm, c
+        see generation
+    sm, ex
+        see sources
+    ki, kg
+        outflow coefficients of the free water storage of a period, see free_water_recession
+    w
+        (wu, wl, wd) at the beginning
+    s
+        free water storage at the beginning
+    fr
+        runoff area, which does not change without runoff
+    book
+        "HF" or "EH", see sources
+
+    Returns
+    -------
+    tuple[tuple, tuple]
+        (e, ri, rg), (wu, wl, wd, s): series of all periods, [time, basin]
+    """
+    cap = np.broadcast_to(free_water_capacity(fr, sm, ex, book), fr.shape)
+    pet = np.ascontiguousarray(p_and_e[:, :, 1])
+    arrays = [
+        np.ascontiguousarray(np.broadcast_to(x, fr.shape), dtype=pet.dtype)
+        for x in (k, um, lm, dm, c, cap, fr, ki, kg, *w, s)
+    ]
+    e, ri, rg, *states = _dry_periods(pet, *arrays)
+    return (e, ri, rg), tuple(states)
+
+
 # @jit
 # @jit(nopython=True)
 def linear_reservoir(x, weight, last_y=None) -> np.array:
@@ -631,7 +859,7 @@ def linear_reservoir(x, weight, last_y=None) -> np.array:
     """
     weight1 = 1 - weight
     if last_y is None:
-        last_y = np.full(weight.shape, 0.001)
+        last_y = np.full_like(weight, 0.001)
     return weight * last_y + weight1 * x
 
 
@@ -653,15 +881,11 @@ def uh_conv(x, uh_from_gamma):
     np.array
         convolution
     """
-    outputs = np.full(x.shape, 0.0)
-    time_length, batch_size, feature_size = x.shape
+    feature_size = x.shape[2]
     if feature_size > 1:
         logging.error("We only support one-dim convolution now!!!")
-    for i in range(batch_size):
-        uh = uh_from_gamma[:, i, 0]
-        inputs = x[:, i, 0]
-        outputs[:, i, 0] = np.convolve(inputs, uh)[:time_length]
-    return outputs
+    outputs, _ = uh_conv_with_memory(x[:, :, 0], uh_from_gamma[:, :, 0])
+    return np.expand_dims(outputs, axis=2)
 
 
 def uh_gamma(a, theta, len_uh=15):
@@ -703,50 +927,148 @@ def uh_gamma(a, theta, len_uh=15):
     return w
 
 
-def xaj(
-    p_and_e,
-    params: np.ndarray,
-    return_state=False,
-    warmup_length=365,
-    **kwargs,
-) -> Union[tuple, np.ndarray]:
+@jit(nopython=True)
+def _ring_conv(x, uh, ring, head):
+    """Convolution of x [seq, batch] with uh [len_uh, batch], keeping inputs in ring buffers in place"""
+    time_length, batch_size = x.shape
+    len_uh = uh.shape[0]
+    outputs = np.zeros_like(x)
+    for i in range(batch_size):
+        h = head[i]
+        for t in range(time_length):
+            ring[i, h] = x[t, i]
+            # the newest input with the first ordinate, then backwards
+            k = h
+            acc = 0.0
+            for j in range(len_uh):
+                acc += uh[j, i] * ring[i, k]
+                k = k - 1 if k > 0 else len_uh - 1
+            outputs[t, i] = acc
+            h = h + 1 if h < len_uh - 1 else 0
+        head[i] = h
+    return outputs
+
+
+def uh_conv_with_memory(x, uh, memory=None):
     """
-    run XAJ model
+    Streaming 1d-convolution which continues from the inputs of earlier periods
+
+    The last len_uh inputs of each basin are kept in a fixed-size ring buffer, so inputs
+    can be given one period or one chunk at a time and the result is the same as
+    convolving the whole sequence at once.
+
+    Parameters
+    ----------
+    x
+        the input of the convolution, [seq, batch]
+    uh
+        unit hydrograph, [len_uh, batch]; shorter ones are padded with zeros
+    memory
+        (ring buffers [batch, len_uh], slots of the next inputs [batch]) as returned
+        by this function; None means there is no earlier input
+
+    Returns
+    -------
+    tuple
+        convolution [seq, batch] and memory at the end of the sequence
+    """
+    batch_size = x.shape[1]
+    len_uh = uh.shape[0]
+    # the convolution runs in the float precision of x, float64 for other inputs
+    dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+    if memory is None:
+        ring = np.zeros((batch_size, len_uh), dtype=dtype)
+        head = np.zeros(batch_size, dtype=np.int64)
+    else:
+        # the given memory is not changed
+        ring = np.array(memory[0], dtype=dtype)
+        head = np.array(memory[1], dtype=np.int64)
+    outputs = _ring_conv(
+        np.ascontiguousarray(x, dtype=dtype),
+        np.ascontiguousarray(uh, dtype=dtype),
+        ring,
+        head,
+    )
+    return outputs, (ring, head)
+
+
+def lag_routing(qt, cs, l, memory=None):
+    """
+    Routing with the lag-and-route method: qs(t) = cs * qs(t-1) + (1 - cs) * qt(t - l)
+
+    At the very beginning, qs is qt in the first l periods
+
+    Parameters
+    ----------
+    qt
+        inflow of the river network, [seq, batch]
+    cs
+        recession constant of the river network, [batch]
+    l
+        lag time, [batch]
+    memory
+        (the last qs [batch], qt of the last periods [batch, max lag]) before the sequence;
+        NaN in the latter means periods before the beginning; None means the beginning
+
+    Returns
+    -------
+    tuple
+        qs [seq, batch] and memory at the end of the sequence
+    """
+    time_length, batch_size = qt.shape
+    if memory is None:
+        memory = (
+            np.full(batch_size, 0.0, dtype=qt.dtype),
+            np.full((batch_size, 0), np.nan, dtype=qt.dtype),
+        )
+    qs_last, qt_last = memory
+    n_last = qt_last.shape[1]
+    # time-first qt with the periods before the sequence
+    qt_all = np.concatenate([qt_last.T, qt], axis=0)
+    qs = np.full_like(qt, 0.0)
+    for j in range(batch_size):
+        lag = int(l[j])
+        qs_ = qs_last[j]
+        for i in range(time_length):
+            if i + n_last - lag < 0 or np.isnan(qt_all[i + n_last - lag, j]):
+                qs_ = qt[i, j]
+            else:
+                qs_ = cs[j] * qs_ + (1 - cs[j]) * qt_all[i + n_last - lag, j]
+            qs[i, j] = qs_
+    n_keep = int(np.max(l))
+    qt_keep = np.full((n_keep, batch_size), np.nan, dtype=qt.dtype)
+    n_have = min(n_keep, qt_all.shape[0])
+    if n_have > 0:
+        qt_keep[n_keep - n_have :] = qt_all[qt_all.shape[0] - n_have :]
+    qs_end = qs[-1] if time_length > 0 else qs_last
+    return qs, (qs_end, qt_keep.T)
+
+
+def xaj_step(p_and_e, params: np.ndarray, states=None, memory=None, **kwargs):
+    """
+    run XAJ model from given states without warmup
 
     Parameters
     ----------
     p_and_e
-        prcp and pet; sequence-first (time is the first dim) 3-d np array: [time, basin, feature=2]
+        prcp and pet; sequence-first (time is the first dim) 3-d np array: [time, basin, feature=2],
+        or a PreparedForcing of them, see hydromodel.models.forcing
     params
-        parameters of XAJ model for basin(s);
-        2-dim variable -- [basin, parameter]:
-        the parameters are B IM UM LM DM C SM EX KI KG A THETA CI CG (notice the sequence)
-    return_state
-        if True, return state values, mainly for warmup periods
-    warmup_length
-        hydro models need a warm-up period to get good initial state values
+        parameters of XAJ model for basin(s), [basin, parameter], see xaj
+    states
+        (wu, wl, wd, s, fr, qi, qg) at the beginning of p_and_e;
+        None means default values
+    memory
+        routing memory at the beginning of p_and_e as returned by this function;
+        None means the routing starts with no earlier runoff
     kwargs
-        name
-            now we provide two ways: "xaj" (route:recession constant + lag time) and "xaj_mz" (route:method from mizuRoute)
-        source_type
-            default is "sources" and it will call "sources" function; the other is "sources5mm",
-            and we will divide the runoff to some <5mm pieces according to the books in this case
-        source_book
-            When source_type is "sources5mm" there are two implementions for dividing sources,
-            as the methods in "ShuiWenYuBao" and "GongChengShuiWenXue"" are different.
-            Hence, both are provided, and the default is the former.
-        kernel_size
-            the size of the kernel for the convolution operation, default is 15 periods
-            if time_interval_hours is 1, it is 15 hours; if time_interval_hours is 24, it is 15 days
-            It is the length of the unit hydrograph
-        time_interval_hours:
-            the time interval of the model, default is 1 hour, for daily case, it should be 24
-            this is only used when source_type is "sources5mm"
+        name, source_type, source_book, kernel_size, time_interval_hours, outputs, dtype
+        and the model's parameter dict, see xaj
 
     Returns
     -------
-    Union[np.array, tuple]
-        streamflow or (streamflow, states)
+    tuple
+        a dict of the chosen outputs, states and routing memory at the end of p_and_e
     """
     # default values for some function parameters
     model_name = kwargs.get("name", "xaj")
@@ -754,6 +1076,11 @@ def xaj(
     source_book = kwargs.get("source_book", "HF")
     kernel_size = kwargs.get("kernel_size", 15)
     time_interval_hours = kwargs.get("time_interval_hours", 24)
+    outputs = kwargs.get("outputs", ("q_sim", "es"))
+    if unknown := set(outputs) - set(XAJ_OUTPUTS):
+        raise ValueError(
+            f"No outputs {unknown} in XAJ, please choose from {XAJ_OUTPUTS}"
+        )
     model_param_dict = kwargs.get(f"{model_name}", None)
     if model_param_dict is None:
         model_param_dict = MODEL_PARAM_DICT[f"{model_name}"]
@@ -771,6 +1098,10 @@ def xaj(
         raise ValueError(
             "Parameters contain NaN values. Please check your opt algorithm"
         )
+    # all inputs, states and series are in one float precision
+    dtype = np.dtype(kwargs.get("dtype", "float64"))
+    forcing = prepare_forcing(p_and_e, dtype)
+    params = np.asarray(params, dtype=dtype)
     # xaj_params = [
     #     (value[1] - value[0]) * params[:, i] + value[0]
     #     for i, (key, value) in enumerate(param_ranges.items())
@@ -823,126 +1154,212 @@ def xaj(
     cg = cg_scale[0] + params[:, 14] * (cg_scale[1] - cg_scale[0])
 
     # initialize state values
-    if warmup_length > 0:
-        p_and_e_warmup = p_and_e[0:warmup_length, :, :]
-        _q, _e, *w0, s0, fr0, qi0, qg0 = xaj(
-            p_and_e_warmup,
-            params,
-            return_state=True,
-            warmup_length=0,
-            **kwargs,
-        )
+    if states is None:
+        w = (0.5 * um, 0.5 * lm, 0.5 * dm)
+        s = 0.5 * sm
+        fr = np.full_like(ex, 0.1)
+        qi = np.full_like(ci, 0.1)
+        qg = np.full_like(cg, 0.1)
     else:
-        w0 = (0.5 * um, 0.5 * lm, 0.5 * dm)
-        s0 = 0.5 * sm
-        fr0 = np.full(ex.shape, 0.1)
-        qi0 = np.full(ci.shape, 0.1)
-        qg0 = np.full(cg.shape, 0.1)
+        *w, s, fr, qi, qg = (np.asarray(state, dtype=dtype) for state in states)
 
     # state_variables
-    inputs = p_and_e[warmup_length:, :, :]
-    runoff_ims_ = np.full(inputs.shape[:2], 0.0)
-    rss_ = np.full(inputs.shape[:2], 0.0)
-    ris_ = np.full(inputs.shape[:2], 0.0)
-    rgs_ = np.full(inputs.shape[:2], 0.0)
-    es_ = np.full(inputs.shape[:2], 0.0)
-    for i in range(inputs.shape[0]):
-        if i == 0:
-            (r, rim, e, pe), w = generation(
-                inputs[i, :, :], k, b, im, um, lm, dm, c, *w0
+    inputs = forcing.p_and_e
+    # runoff routed by the river network: surface (and impervious for MZ) runoff
+    rss_ = np.full(inputs.shape[:2], 0.0, dtype=dtype)
+    ris_ = np.full(inputs.shape[:2], 0.0, dtype=dtype)
+    rgs_ = np.full(inputs.shape[:2], 0.0, dtype=dtype)
+    # other series are only kept when they are chosen
+    series = {
+        name: np.full(inputs.shape[:2], 0.0, dtype=dtype)
+        for name in outputs
+        if name not in ("q_sim", "ri", "rg")
+    }
+    if source_type == "sources5mm":
+        # runoff of a dry period is not divided, so its coefficients are those of one piece
+        ki_dry, kg_dry = piece_coefficients(
+            ki, kg, time_interval_hours, np.ones_like(ki)
+        )
+    else:
+        ki_dry, kg_dry = ki, kg
+    # periods without precipitation in any basin, whose spells are run by dry_periods;
+    # they do not depend on parameters, so they are found once per forcing
+    wet_periods = forcing.series("wet_periods")
+    # precipitation clipped to be not negative once per forcing, not in each period
+    prcp, pet = forcing.series("prcp"), forcing.series("pet")
+    i = 0
+    while i < inputs.shape[0]:
+        next_wet = np.searchsorted(wet_periods, i)
+        end = wet_periods[next_wet] if next_wet < wet_periods.size else inputs.shape[0]
+        if end > i:
+            (e, ri, rg), (*w, s) = dry_periods(
+                inputs[i:end],
+                k,
+                um,
+                lm,
+                dm,
+                c,
+                sm,
+                ex,
+                ki_dry,
+                kg_dry,
+                w,
+                s,
+                fr,
+                book=source_book,
             )
-            if source_type == "sources":
-                (rs, ri, rg), (s, fr) = sources(
-                    pe, r, sm, ex, ki, kg, s0, fr0, book=source_book
-                )
-            elif source_type == "sources5mm":
-                (rs, ri, rg), (s, fr) = sources5mm(
-                    pe,
-                    r,
-                    sm,
-                    ex,
-                    ki,
-                    kg,
-                    s0,
-                    fr0,
-                    time_interval_hours=time_interval_hours,
-                    book=source_book,
-                )
-            else:
-                raise NotImplementedError("No such divide-sources method")
-        else:
-            (r, rim, e, pe), w = generation(
-                inputs[i, :, :], k, b, im, um, lm, dm, c, *w
+            # no surface (or impervious) runoff in dry periods, as rss_ is initialized
+            ris_[i:end] = ri * (1 - im)
+            rgs_[i:end] = rg * (1 - im)
+            for name, value in zip(("es", "wu", "wl", "wd", "s", "fr"), (e, *w, s, fr)):
+                if name in series:
+                    series[name][i:end] = value
+            w, s = tuple(x[-1] for x in w), s[-1]
+            i = end
+            continue
+        (r, rim, e, pe), w = _generation(prcp[i], pet[i], k, b, im, um, lm, dm, c, *w)
+        if source_type == "sources":
+            (rs, ri, rg), (s, fr) = sources(
+                pe, r, sm, ex, ki, kg, s, fr, book=source_book
             )
-            if source_type == "sources":
-                (rs, ri, rg), (s, fr) = sources(
-                    pe, r, sm, ex, ki, kg, s, fr, book=source_book
-                )
-            elif source_type == "sources5mm":
-                (rs, ri, rg), (s, fr) = sources5mm(
-                    pe,
-                    r,
-                    sm,
-                    ex,
-                    ki,
-                    kg,
-                    s,
-                    fr,
-                    time_interval_hours=time_interval_hours,
-                    book=source_book,
-                )
-            else:
-                raise NotImplementedError("No such divide-sources method")
+        elif source_type == "sources5mm":
+            (rs, ri, rg), (s, fr) = sources5mm(
+                pe,
+                r,
+                sm,
+                ex,
+                ki,
+                kg,
+                s,
+                fr,
+                time_interval_hours=time_interval_hours,
+                book=source_book,
+            )
+        else:
+            raise NotImplementedError("No such divide-sources method")
         # impevious part is pe * im
-        runoff_ims_[i, :] = rim
         # so for non-imprvious part, the result should be corrected
-        rss_[i, :] = rs * (1 - im)
+        rs = rs * (1 - im)
+        rss_[i, :] = rim + rs if route_method == "MZ" else rs
         ris_[i, :] = ri * (1 - im)
         rgs_[i, :] = rg * (1 - im)
-        es_[i, :] = e
-    # seq, batch, feature
-    runoff_im = np.expand_dims(runoff_ims_, axis=2)
-    rss = np.expand_dims(rss_, axis=2)
-    es = np.expand_dims(es_, axis=2)
-
-    qs = np.full(inputs.shape[:2], 0.0)
+        for name, value in zip(
+            ("es", "rim", "rs", "wu", "wl", "wd", "s", "fr"), (e, rim, rs, *w, s, fr)
+        ):
+            if name in series:
+                series[name][i, :] = value
+        i += 1
+    series["ri"], series["rg"] = ris_, rgs_
+
+    qs = np.full(inputs.shape[:2], 0.0, dtype=dtype)
     if route_method == "CSL":
-        qt = np.full(inputs.shape[:2], 0.0)
+        qt = np.full(inputs.shape[:2], 0.0, dtype=dtype)
         for i in range(inputs.shape[0]):
-            if i == 0:
-                qi = linear_reservoir(ris_[i], ci, qi0)
-                qg = linear_reservoir(rgs_[i], cg, qg0)
-            else:
-                qi = linear_reservoir(ris_[i], ci, qi)
-                qg = linear_reservoir(rgs_[i], cg, qg)
+            qi = linear_reservoir(ris_[i], ci, qi)
+            qg = linear_reservoir(rgs_[i], cg, qg)
             qs_ = rss_[i]
             qt[i, :] = qs_ + qi + qg
-        for j in range(len(l)):
-            lag = int(l[j])
-            for i in range(lag):
-                qs[i, j] = qt[i, j]
-            for i in range(lag, inputs.shape[0]):
-                qs[i, j] = cs[j] * qs[i - 1, j] + (1 - cs[j]) * qt[i - lag, j]
+            for name, value in (("qi", qi), ("qg", qg)):
+                if name in series:
+                    series[name][i, :] = value
+        qs, memory = lag_routing(qt, cs, l, memory)
     elif route_method == "MZ":
-        rout_a = a.repeat(rss.shape[0]).reshape(rss.shape)
-        rout_b = theta.repeat(rss.shape[0]).reshape(rss.shape)
-        conv_uh = uh_gamma(rout_a, rout_b, kernel_size)
-        qs_ = uh_conv(runoff_im + rss, conv_uh)
+        # the same parameters for all time steps of a basin: [len_uh, basin, 1]
+        uh_shape = (kernel_size, inputs.shape[1], 1)
+        rout_a = np.broadcast_to(a[np.newaxis, :, np.newaxis], uh_shape)
+        rout_b = np.broadcast_to(theta[np.newaxis, :, np.newaxis], uh_shape)
+        conv_uh = uh_gamma(rout_a, rout_b, kernel_size).astype(dtype)
+        qs_, memory = uh_conv_with_memory(rss_, conv_uh[:, :, 0], memory)
         for i in range(inputs.shape[0]):
-            if i == 0:
-                qi = linear_reservoir(ris_[i], ci, qi0)
-                qg = linear_reservoir(rgs_[i], cg, qg0)
-            else:
-                qi = linear_reservoir(ris_[i], ci, qi)
-                qg = linear_reservoir(rgs_[i], cg, qg)
-            qs[i, :] = qs_[i, :, 0] + qi + qg
+            qi = linear_reservoir(ris_[i], ci, qi)
+            qg = linear_reservoir(rgs_[i], cg, qg)
+            qs[i, :] = qs_[i, :] + qi + qg
+            for name, value in (("qi", qi), ("qg", qg)):
+                if name in series:
+                    series[name][i, :] = value
     else:
         raise NotImplementedError(
             "We don't provide this route method now! Please use 'CS' or 'MZ'!"
         )
 
+    series["q_sim"] = qs
     # seq, batch, feature
-    q_sim = np.expand_dims(qs, axis=2)
+    chosen = {name: np.expand_dims(series[name], axis=2) for name in outputs}
+    return chosen, (*w, s, fr, qi, qg), memory
+
+
+def xaj(
+    p_and_e,
+    params: np.ndarray,
+    return_state=False,
+    warmup_length=365,
+    **kwargs,
+) -> Union[tuple, np.ndarray]:
+    """
+    run XAJ model
+
+    Parameters
+    ----------
+    p_and_e
+        prcp and pet; sequence-first (time is the first dim) 3-d np array: [time, basin, feature=2],
+        or a PreparedForcing of them, see hydromodel.models.forcing
+    params
+        parameters of XAJ model for basin(s);
+        2-dim variable -- [basin, parameter]:
+        the parameters are B IM UM LM DM C SM EX KI KG A THETA CI CG (notice the sequence)
+    return_state
+        if True, return state values, mainly for warmup periods
+    warmup_length
+        hydro models need a warm-up period to get good initial state values
+    kwargs
+        name
+            now we provide two ways: "xaj" (route:recession constant + lag time) and "xaj_mz" (route:method from mizuRoute)
+        source_type
+            default is "sources" and it will call "sources" function; the other is "sources5mm",
+            and we will divide the runoff to some <5mm pieces according to the books in this case
+        source_book
+            When source_type is "sources5mm" there are two implementions for dividing sources,
+            as the methods in "ShuiWenYuBao" and "GongChengShuiWenXue"" are different.
+            Hence, both are provided, and the default is the former.
+        kernel_size
+            the size of the kernel for the convolution operation, default is 15 periods
+            if time_interval_hours is 1, it is 15 hours; if time_interval_hours is 24, it is 15 days
+            It is the length of the unit hydrograph
+        time_interval_hours:
+            the time interval of the model, default is 1 hour, for daily case, it should be 24
+            this is only used when source_type is "sources5mm"
+        initial_states
+            (wu, wl, wd, s, fr, qi, qg) at the beginning of p_and_e, as returned with
+            return_state; if not given, default values are used
+        outputs
+            names of the returned variables, chosen from XAJ_OUTPUTS, default is
+            ("q_sim", "es"); only chosen series are kept, e.g. ("q_sim",) for calibration
+        dtype
+            the float precision of inputs, states and outputs, default is "float64";
+            "float32" halves the memory of the series and is accurate enough for
+            mm-scale storages, e.g. for calibration screening
+
+    Returns
+    -------
+    Union[np.array, tuple]
+        the chosen outputs, each [time, basin, 1], followed by states if return_state
+    """
+    outputs = kwargs.get("outputs", ("q_sim", "es"))
+    # initialize state values
+    if warmup_length > 0:
+        p_and_e_warmup = p_and_e[0:warmup_length]
+        # no output is kept in the warmup period
+        states = xaj(
+            p_and_e_warmup,
+            params,
+            return_state=True,
+            warmup_length=0,
+            **{**kwargs, "outputs": ()},
+        )
+    else:
+        states = kwargs.get("initial_states")
+    series, states, _ = xaj_step(p_and_e[warmup_length:], params, states, **kwargs)
+    results = tuple(series[name] for name in outputs)
     if return_state:
-        return q_sim, es, *w, s, fr, qi, qg
-    return q_sim, es
+        return *results, *states
+    return results
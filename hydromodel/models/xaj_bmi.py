@@ -1,120 +1,214 @@
 from typing import Tuple
 from bmipy import Bmi
 import numpy as np
-
-import datetime
 import pandas as pd
+import yaml
+
 import logging
+import os
+
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.model_state import (
+    STATE_VARIABLES,
+    ModelState,
+    step,
+    warmup_state,
+)
 
 logger = logging.getLogger(__name__)
 
 PRECISION = 1e-5
+# columns of the forcing file, the same as those of the time-series data of a basin
+FORCING_COLUMNS = ("prcp(mm/day)", "pet(mm/day)")
+
+
+def read_bmi_params(config, n_basin):
+    """
+    Normalized parameters of basins from "params" or "params_file" of a BMI config
+
+    Parameters
+    ----------
+    config
+        the BMI config; "params" is one list for all basins or a list for each basin;
+        "params_file" is a csv of basins' normalized parameters such as basins_norm_params.csv,
+        whose rows are chosen by "basin_ids"
+    n_basin
+        the number of basins
+
+    Returns
+    -------
+    np.array
+        parameters, [basin, n_params]
+    """
+    if "params_file" in config:
+        params = pd.read_csv(config["params_file"], index_col=0)
+        params.index = params.index.astype(str)
+        return params.loc[[str(basin) for basin in config["basin_ids"]]].to_numpy(
+            dtype=float
+        )
+    params = np.array(config["params"], dtype=float)
+    return np.broadcast_to(params, (n_basin, params.shape[-1])).copy()
 
 
 class xajBmi(Bmi):
-    """Empty model wrapped in a BMI interface.
-    TODO: not implemented yet
+    """XAJ model of many basins wrapped in a BMI interface
+
+    The model keeps its states and routing memory between calls, so an update
+    only simulates the new periods and never the history. All basins are run
+    together and their values are in buffers allocated once in initialize, which
+    get_value_ptr returns by reference, so coupled models read and write them without copy;
+    state variables (such as wu and s of XAJ) can be set for data assimilation.
+
+    The configuration is a yaml file such as::
+
+        basin_ids: [basin1, basin2]
+        forcing_files: [basin1.csv, basin2.csv]  # columns: time, prcp(mm/day), pet(mm/day)
+        warmup_length: 365
+        time_units: days
+        model:
+          name: xaj_mz
+          source_type: sources5mm
+          source_book: HF
+          kernel_size: 15
+          time_interval_hours: 24
+          dtype: float64  # or float32
+        params: [0.5, 0.5, ...]  # normalized parameters, or a list of them for each basin
+        params_file: null  # or normalized parameters of basins, such as basins_norm_params.csv
+        param_file: null  # the file of the parameter range, see read_model_param_dict
+        checkpoint: null  # a file saved by save_checkpoint; if it exists, no warmup is run
+
+    For a single basin, "forcing_file" can be given instead of "forcing_files".
     """
 
     name = "hydro-model-xaj"
     input_var_names = ("precipitation", "ETp")
     output_var_names = ("ET", "discharge")
-    var_units = {
-        "precipitation": "mm/day",
-        "ETp": "mm/day",
-        "discharge": "mm/day",
-        "ET": "mm/day",
-    }
 
     def __init__(self):
-        """Create a BmiHeat model that is ready for initialization."""
+        """Create a model that is ready for initialization."""
         self.time_step = 0
 
     def initialize(self, config_file):
-        try:
-            logger.info("xaj: initialize_model")
-            config = configuration.read_config(config_file)
-            forcing_data = pd.read_csv(config["forcing_file"])
-            p_and_e_df, p_and_e = configuration.extract_forcing(forcing_data)
-            p_and_e_warmup = p_and_e[0 : config["warmup_length"], :, :]
-            params = np.tile([0.5], (1, 15))
-            (
-                self.q_sim_state,
-                self.es_state,
-                self.w0,
-                self.w1,
-                self.w2,
-                self.s0,
-                self.fr0,
-                self.qi0,
-                self.qg0,
-            ) = configuration.warmup(p_and_e_warmup, params, config["warmup_length"])
-
-            self._start_time_str, self._end_time_str, self._time_units = (
-                configuration.get_time_config(config)
-            )
-
-            self.params = params
-            self.warmup_length = config["warmup_length"]
-            self.p_and_e_df = p_and_e_df
+        logger.info("xaj: initialize_model")
+        with open(config_file, "r") as file:
+            config = yaml.safe_load(file)
+        forcing_files = config.get("forcing_files", [config.get("forcing_file")])
+        # [time, basin, feature=2]
+        p_and_e = np.stack(
+            [
+                pd.read_csv(forcing_file)[list(FORCING_COLUMNS)].to_numpy(dtype=float)
+                for forcing_file in forcing_files
+            ],
+            axis=1,
+        )
+        n_basin = p_and_e.shape[1]
+        self.basin_ids = config.get("basin_ids", list(range(n_basin)))
+        self.warmup_length = config.get("warmup_length", 365)
+        self.model = config.get("model", {"name": "xaj"})
+        self.param_range = read_model_param_dict(config.get("param_file"))
+        self.params = read_bmi_params(config, n_basin)
+        self._time_units = config.get("time_units", "days")
+        p_and_e = p_and_e.astype(self.model.get("dtype", "float64"), copy=False)
+        self.p_and_e = p_and_e[self.warmup_length :]
+        self.state_var_names = tuple(
+            variable for variable, _ in STATE_VARIABLES[self.model["name"]]
+        )
+        self.output_var_names = ("ET", "discharge") + self.state_var_names
+        checkpoint = config.get("checkpoint")
+        if checkpoint is not None and os.path.exists(checkpoint):
+            # hot start: the forcing begins right after the time of the checkpoint
+            self.warmup_length = 0
             self.p_and_e = p_and_e
-            self.config = config
-            self.basin_area = config["basin_area"]
-
-        except:
-            import traceback
-
-            traceback.print_exc()
-            raise
+            state = self._read_checkpoint(checkpoint)
+        else:
+            # default states when there is no warmup period
+            state = warmup_state(
+                p_and_e[: self.warmup_length],
+                self.params,
+                self.model,
+                self.param_range,
+            )
+        # buffers of all variables, [basin] each; they are never reallocated
+        self.state = ModelState(self.model["name"], state.values.copy(), state.memory)
+        self.inputs = self.p_and_e[0].T.copy()
+        # outputs in the float precision of the model, see "dtype" of the model config
+        self.q_sim = np.full(n_basin, 0.0, dtype=state.values.dtype)
+        self.es = np.full(n_basin, 0.0, dtype=state.values.dtype)
+        self.time_step = 0
 
     def update(self):
         """Update model for a single time step."""
+        self._advance(1)
 
-        self.time_step += 1
-        # p_and_e_sim = self.p_and_e[self.warmup_length+1:self.time_step+self.warmup_length+1]
-        p_and_e_sim = self.p_and_e[1 : self.time_step + 1]
-        self.runoff_im, self.rss_, self.ris_, self.rgs_, self.es_runoff, self.rss = (
-            xaj_runoff(
-                p_and_e_sim,
-                w0=self.w0,
-                s0=self.s0,
-                fr0=self.fr0,
-                params_runoff=self.params,
-                return_state=False,
-            )
+    def update_until(self, time):
+        """Update model until a particular time, all periods in one call."""
+        n_steps = int(round(time)) - self.time_step
+        if n_steps > 0:
+            self._advance(n_steps)
+
+    def _advance(self, n_steps):
+        if self.time_step + n_steps > self.p_and_e.shape[0]:
+            raise ValueError("No forcing data after the end time")
+        # inputs of the next period may have been set by a coupled model
+        self.p_and_e[self.time_step] = self.inputs.T
+        q_sim, es, state = step(
+            self.state,
+            self.p_and_e[self.time_step : self.time_step + n_steps],
+            self.params,
+            self.model,
+            self.param_range,
+        )
+        self.time_step += n_steps
+        # values at the current time are those of the last period
+        self.q_sim[:] = q_sim[-1, :, 0]
+        self.es[:] = es[-1, :, 0]
+        self.state.values[:] = state.values
+        self.state.memory = state.memory
+        self.inputs[:] = self.p_and_e[min(self.time_step, self.p_and_e.shape[0] - 1)].T
+
+    def save_checkpoint(self, file):
+        """
+        Save states and routing memory of all basins at the current time in a npz file
+
+        Parameters
+        ----------
+        file
+            path of the checkpoint; set it as "checkpoint" in the config to hot start
+        """
+        self.state.save(
+            file,
+            basin_ids=np.array([str(basin) for basin in self.basin_ids]),
+            time_step=np.array(self.time_step),
         )
-        if self.time_step + self.warmup_length + 1 >= self.p_and_e.shape[0]:
-            q_sim, es = xaj_route(
-                p_and_e_sim,
-                params_route=self.params,
-                model_name="xaj",
-                runoff_im=self.runoff_im,
-                rss_=self.rss_,
-                ris_=self.ris_,
-                rgs_=self.rgs_,
-                rss=self.rss,
-                qi0=self.qi0,
-                qg0=self.qg0,
-                es=self.es_runoff,
-            )
-            self.p_sim = p_and_e_sim[:, :, 0]
-            self.e_sim = p_and_e_sim[:, :, 1]
-            q_sim = convert_unit(
-                q_sim,
-                unit_now="mm/day",
-                unit_final=unit["streamflow"],
-                basin_area=float(self.basin_area),
-            )
-            self.q_sim = q_sim
-            self.es = es
 
-    def update_until(self, time):
-        while self.get_current_time() + 0.001 < time:
-            self.update()
+    def load_checkpoint(self, file):
+        """
+        Replace states and routing memory of all basins with those in a checkpoint
+
+        Parameters
+        ----------
+        file
+            path of the checkpoint
+        """
+        state = self._read_checkpoint(file)
+        self.state.values[:] = state.values
+        self.state.memory = state.memory
+
+    def _read_checkpoint(self, file):
+        state, metadata = ModelState.load(file)
+        basin_ids = [str(basin) for basin in self.basin_ids]
+        if (
+            state.name != self.model["name"]
+            or metadata["basin_ids"].tolist() != basin_ids
+        ):
+            raise ValueError(
+                f"The checkpoint {file} is not for {self.model['name']} of basins {basin_ids}"
+            )
+        return state
 
     def finalize(self) -> None:
         """Finalize model."""
-        self.model = None
+        self.state = None
 
     def get_component_name(self) -> str:
         return "xaj"
@@ -132,13 +226,19 @@ class xajBmi(Bmi):
         return self.output_var_names
 
     def get_var_grid(self, name: str) -> int:
-        raise NotImplementedError()
+        return 0
 
     def get_var_type(self, name: str) -> str:
-        return "float64"
+        return str(self.get_value_ptr(name).dtype)
 
     def get_var_units(self, name: str) -> str:
-        return self.var_units[name]
+        if name == "fr":
+            return "1"
+        if name in self.state_var_names and name not in ("qi", "qg"):
+            # water in storages
+            return "mm"
+        # fluxes are depths in a period of the model
+        return "mm/day" if self._time_units == "days" else "mm/h"
 
     def get_var_itemsize(self, name: str) -> int:
         return np.dtype(self.get_var_type(name)).itemsize
@@ -147,44 +247,48 @@ class xajBmi(Bmi):
         return self.get_value_ptr(name).nbytes
 
     def get_var_location(self, name: str) -> str:
-        raise NotImplementedError()
+        return "node"
 
-    def get_start_time(self):
-        return self.start_Time(self._start_time_str)
+    def get_start_time(self) -> float:
+        return 0.0
 
-    def get_current_time(self):
-        # return self.start_Time(self._start_time_str) + datetime.timedelta(self.time_step+self.warmup_length)
-        if self._time_units == "hours":
-            time_step = datetime.timedelta(hours=self.time_step)
-        elif self._time_units == "days":
-            time_step = datetime.timedelta(days=self.time_step)
-        return self.start_Time(self._start_time_str) + time_step
+    def get_current_time(self) -> float:
+        return float(self.time_step)
 
-    def get_end_time(self):
-        return self.end_Time(self._end_time_str)
+    def get_end_time(self) -> float:
+        return float(self.p_and_e.shape[0])
 
     def get_time_units(self) -> str:
         return self._time_units
 
     def get_time_step(self) -> float:
-        return 1
+        return 1.0
 
-    def get_value(self, name: str) -> None:
-        logger.info("getting value for var %s", name)
-        return self.get_value_ptr(name).flatten()
+    def get_value(self, name: str, dest: np.ndarray) -> np.ndarray:
+        dest[:] = self.get_value_ptr(name)
+        return dest
 
     def get_value_ptr(self, name: str) -> np.ndarray:
         if name == "discharge":
             return self.q_sim
         elif name == "ET":
             return self.es
-
-    def get_value_at_indices(self, name: str, inds: np.ndarray) -> np.ndarray:
-
-        return self.get_value_ptr(name).take(inds)
+        # inputs are those of the next period, so they can be set before an update
+        elif name == "precipitation":
+            return self.inputs[0]
+        elif name == "ETp":
+            return self.inputs[1]
+        elif name in self.state_var_names:
+            return self.state[name]
+        raise KeyError(f"No variable {name}")
+
+    def get_value_at_indices(
+        self, name: str, dest: np.ndarray, inds: np.ndarray
+    ) -> np.ndarray:
+        dest[:] = self.get_value_ptr(name)[inds]
+        return dest
 
     def set_value(self, name: str, src: np.ndarray):
-
         val = self.get_value_ptr(name)
         val[:] = src.reshape(val.shape)
 
@@ -192,17 +296,17 @@ class xajBmi(Bmi):
         self, name: str, inds: np.ndarray, src: np.ndarray
     ) -> None:
         val = self.get_value_ptr(name)
-        val.flat[inds] = src
+        val[inds] = src
 
-    # Grid information
+    # Grid information: basins are points
     def get_grid_rank(self, grid: int) -> int:
-        raise NotImplementedError()
+        return 1
 
     def get_grid_size(self, grid: int) -> int:
-        raise NotImplementedError()
+        return self.q_sim.size
 
     def get_grid_type(self, grid: int) -> str:
-        raise NotImplementedError()
+        return "points"
 
     # Uniform rectilinear
     def get_grid_shape(self, grid: int, shape: np.ndarray) -> np.ndarray:
@@ -225,7 +329,7 @@ class xajBmi(Bmi):
         raise NotImplementedError()
 
     def get_grid_node_count(self, grid: int) -> int:
-        raise NotImplementedError()
+        return self.q_sim.size
 
     def get_grid_edge_count(self, grid: int) -> int:
         raise NotImplementedError()
@@ -246,47 +350,3 @@ class xajBmi(Bmi):
         self, grid: int, nodes_per_face: np.ndarray
     ) -> np.ndarray:
         raise NotImplementedError()
-
-    def start_Time(self, _start_time_str):
-
-        try:
-            if " " in _start_time_str:
-                date, time = _start_time_str.split(" ")
-            else:
-                date = _start_time_str
-                time = None
-            year, month, day = date.split("-")
-            self._startTime = datetime.date(int(year), int(month), int(day))
-
-            if time:
-                hour, minute, second = time.split(":")
-                # self._startTime = self._startTime.replace(hour=int(hour),
-                #                                       minute=int(minute),
-                #                                       second=int(second))
-                self._startTime = datetime.datetime(
-                    int(year), int(month), int(day), int(hour), int(minute), int(second)
-                )
-        except ValueError:
-            raise ValueError("Invalid start date format!")
-
-        return self._startTime
-
-    def end_Time(self, _end_time_str):
-
-        try:
-            if " " in _end_time_str:
-                date, time = _end_time_str.split(" ")
-            else:
-                date = _end_time_str
-                time = None
-            year, month, day = date.split("-")
-            self._endTime = datetime.date(int(year), int(month), int(day))
-
-            if time:
-                hour, minute, second = time.split(":")
-                self._endTime = datetime.datetime(
-                    int(year), int(month), int(day), int(hour), int(minute), int(second)
-                )
-        except ValueError:
-            raise ValueError("Invalid start date format!")
-        return self._endTime
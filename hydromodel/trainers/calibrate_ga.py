@@ -8,6 +8,7 @@ FilePath: \hydromodel\hydromodel\trainers\calibrate_ga.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
+from functools import partial
 import os
 import pickle
 from deap import base, creator
@@ -20,12 +21,26 @@ from tqdm import tqdm
 from hydroutils import hydro_file, hydro_stat
 
 
-from datasets.data_visualize import plot_sim_and_obs, plot_train_iteration
+from hydromodel.datasets.data_visualize import plot_sim_and_obs, plot_train_iteration
+from hydromodel.models.forcing import PreparedForcing
 from hydromodel.models.model_config import MODEL_PARAM_DICT, read_model_param_dict
-from hydromodel.models.model_dict import MODEL_DICT, rmse43darr
+from hydromodel.models.losses import MetricCalculator
+from hydromodel.models.model_dict import MODEL_DICT
+from hydromodel.models.simulation import screen_simulation
+from hydromodel.trainers.warm_start import get_warm_start_params, seed_size
 
 
-def evaluate(individual, x_input, y_true, warmup_length, model, param_range):
+def evaluate(
+    individual,
+    x_input,
+    y_true,
+    warmup_length,
+    model,
+    param_range,
+    metric_calculator=None,
+    threshold=None,
+    screen_length=0,
+):
     """
     Calculate fitness for optimization
 
@@ -34,7 +49,7 @@ def evaluate(individual, x_input, y_true, warmup_length, model, param_range):
     individual
         individual is the params of XAJ (see details in xaj.py); we initialize all parameters in range [0,1]
     x_input
-        input of XAJ
+        input of XAJ, an array or a PreparedForcing
     y_true
         observation data; we use the part after warmup period
     warmup_length
@@ -43,22 +58,43 @@ def evaluate(individual, x_input, y_true, warmup_length, model, param_range):
         model's config
     param_range
         the dict of model's parameters
+    metric_calculator
+        MetricCalculator of y_true after warmup, computed once for all individuals
+    threshold
+        if the RMSE of the first screen_length steps already shows the individual
+        is worse than threshold, its simulation is stopped (see screen_simulation)
+    screen_length
+        the number of time steps after warmup in the screening run
 
     Returns
     -------
-    float
-        fitness
+    tuple
+        fitness; None if the individual is rejected by screening,
+        as its full RMSE is not known
     """
     # print("Calculate fitness:")
     # NOTE: Now only support one basin's calibration for once now
     params = np.array(individual).reshape(1, -1)
+    if metric_calculator is None:
+        metric_calculator = MetricCalculator(y_true[warmup_length:, :, :])
     # model's output include streamflow and evaporation now,
     # but now we only calibrate the model with streamflow
-    sim, _ = MODEL_DICT[model["name"]](
-        x_input, params, warmup_length=warmup_length, **model, **param_range
+    sim, _ = screen_simulation(
+        x_input,
+        params,
+        warmup_length,
+        model,
+        param_range,
+        metric_calculator,
+        "RMSE",
+        threshold,
+        screen_length,
     )
+    if sim is None:
+        # only a lower bound of RMSE is known, which is larger than threshold
+        return None
     # Calculate RMSE for multi-dim arrays
-    return rmse43darr(y_true[warmup_length:, :, :], sim)
+    return (metric_calculator.loss(sim, "RMSE"),)
 
 
 def checkBounds(min, max):
@@ -105,6 +141,7 @@ def calibrate_by_ga(
     warmup_length=30,
     model=None,
     ga_param=None,
+    basin_id=None,
     **kwargs,
 ):
     """
@@ -123,11 +160,25 @@ def calibrate_by_ga(
     model
         the model setting
     ga_param
-        random_seed: 1234
+        random_seed: 1234, seeds both numpy and Python's random module (which deap draws
+        individuals and variations from), so a run is reproducible; results differ from
+        versions which only seeded numpy
         run_counts: int = 40, running counts
         pop_num: int = 50, the number of individuals in the population
         cross_prob: float = 0.5, the probability with which two individuals are crossed
         mut_prob: float=0.5, the probability for mutating an individual
+        mu_plus_lambda: bool, optional, by default False, i.e. the offspring replace the
+        whole population; if True, parents and offspring compete and the best pop_num of
+        them are the next population, the (mu+lambda) scheme
+        screen_fraction: float, optional, such as 0.3, only with mu_plus_lambda; if set,
+        an offspring is screened with the first screen_fraction of the period after warmup,
+        and its simulation is stopped when its RMSE is surely larger than that of every
+        parent; such an offspring could never be kept, so it is discarded without fitness
+        and the search is the same as without screening
+        warm_start: dict, optional, seeds the initial population with earlier results or
+        donor basins' parameters of basin_id, see get_warm_start_params
+    basin_id
+        the id of the calibrated basin; needed when ga_param has warm_start
 
     Returns
     -------
@@ -151,9 +202,24 @@ def calibrate_by_ga(
             "mut_prob": 0.5,
             "save_freq": 1,
         }
+    # inputs and observation are cast once to the float precision of the model
+    dtype = model.get("dtype", "float64")
+    # parameter-free transforms of inputs are also prepared once for all individuals
+    input_data = PreparedForcing(input_data, dtype)
+    observed_output = np.asarray(observed_output, dtype=dtype)
+    if ga_param.get("warm_start") is not None and basin_id is None:
+        raise ValueError("warm_start needs basin_id to find the basin's parameters")
+    mu_plus_lambda = ga_param.get("mu_plus_lambda", False)
+    if ga_param.get("screen_fraction") and not mu_plus_lambda:
+        raise ValueError(
+            "screen_fraction needs mu_plus_lambda, otherwise rejected offspring "
+            "would replace their parents"
+        )
     param_file = kwargs.get("param_file", None)
     param_range = read_model_param_dict(param_file)
     np.random.seed(ga_param["random_seed"])
+    # individuals and their variations are drawn by the random module
+    random.seed(ga_param["random_seed"])
     param_num = len(param_range[model["name"]]["param_name"])
     creator.create("FitnessMin", base.Fitness, weights=(-1.0,))
     creator.create("Individual", list, fitness=creator.FitnessMin)
@@ -179,12 +245,25 @@ def calibrate_by_ga(
         warmup_length=warmup_length,
         model=model,
         param_range=param_range,
+        metric_calculator=MetricCalculator(observed_output[warmup_length:, :, :]),
+    )
+    screen_length = int(
+        ga_param.get("screen_fraction", 0) * (observed_output.shape[0] - warmup_length)
     )
 
     toolbox.decorate("mate", checkBounds(MIN, MAX))
     toolbox.decorate("mutate", checkBounds(MIN, MAX))
 
     pop = toolbox.population(n=ga_param["pop_num"])
+    warm_start = ga_param.get("warm_start")
+    if warm_start is not None:
+        seeds = get_warm_start_params(
+            basin_id,
+            warm_start,
+            seed_size(len(pop), warm_start.get("random_fraction", 0.5)),
+        )
+        for ind, seed in zip(pop, seeds):
+            ind[:] = seed.tolist()
     # cxpb  is the probability with which two individuals are crossed
     # mutpb is the probability for mutating an individual
     cxpb, mutpb = ga_param["cross_prob"], ga_param["mut_prob"]
@@ -236,19 +315,37 @@ def calibrate_by_ga(
 
         # Evaluate the individuals with an invalid fitness
         invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        fitnesses = map(toolbox.evaluate, invalid_ind)
+        # offspring surely worse than all parents could never be kept in (mu+lambda),
+        # so they needn't be fully simulated
+        worst_parent = max(ind.fitness.values[0] for ind in pop)
+        fitnesses = map(
+            partial(
+                toolbox.evaluate,
+                threshold=worst_parent if screen_length > 0 else None,
+                screen_length=screen_length,
+            ),
+            invalid_ind,
+        )
         for ind, fit in tqdm(
             zip(invalid_ind, fitnesses),
             desc=f"{str(gen + 1)} generation fitness calculating",
         ):
-            ind.fitness.values = fit
+            if fit is not None:
+                ind.fitness.values = fit
+        # offspring rejected by screening have no fitness and are discarded
+        offspring = [ind for ind in offspring if ind.fitness.valid]
 
         halloffame.update(offspring)
-        record = stats.compile(offspring)
+        if mu_plus_lambda:
+            # parents and offspring compete for the next population
+            pop[:] = tools.selBest(pop + offspring, len(pop))
+            record = stats.compile(pop)
+        else:
+            record = stats.compile(offspring)
+            # The population is entirely replaced by the offspring
+            pop[:] = offspring
         # +1 means start from 1, 0 means initial generation
         logbook.record(gen=gen + 1, evals=len(invalid_ind), **record)
-        # The population is entirely replaced by the offspring
-        pop[:] = offspring
         print(
             f"Best individual of {str(gen + 1)}"
             + f" generation is: {halloffame[0]}, {halloffame[0].fitness.values}"
@@ -295,10 +392,11 @@ def show_ga_result(
     halloffame = cp["halloffame"]
     print(f"Best individual is: {halloffame[0]}, {halloffame[0].fitness.values}")
     train_test_flag = "train" if train_mode else "test"
-    best_simulation, _ = MODEL_DICT[model_info["name"]](
+    (best_simulation,) = MODEL_DICT[model_info["name"]](
         the_data[:, :, 0:2],
         np.array(list(halloffame[0])).reshape(1, -1),
         warmup_length=warmup_length,
+        outputs=("q_sim",),
         **model_info,
     )
     convert_unit_sim = units.convert_unit(
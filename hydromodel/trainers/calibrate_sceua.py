@@ -1,16 +1,38 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 from typing import Union
 import numpy as np
 import spotpy
 import pandas as pd
+from spotpy.algorithms import _algorithm
 from spotpy.parameter import Uniform, ParameterSet
+from hydromodel.datasets.data_preprocess import open_pe_q_cache
+from hydromodel.models.forcing import PreparedForcing
+from hydromodel.models.losses import (
+    BOUNDED_LOSSES,
+    MetricCalculator,
+    get_event_windows,
+)
 from hydromodel.models.model_config import read_model_param_dict
-from hydromodel.models.model_dict import LOSS_DICT, MODEL_DICT
+from hydromodel.models.model_dict import EVENT_LOSS_DICT, LOSS_DICT
+from hydromodel.models.simulation import screen_simulation
+from hydromodel.trainers.warm_start import (
+    get_warm_start_params,
+    read_best_runs,
+    seed_size,
+)
 
 
 class SpotSetup(object):
     def __init__(
-        self, p_and_e, qobs, warmup_length=365, model=None, param_file=None, loss=None
+        self,
+        p_and_e,
+        qobs,
+        warmup_length=365,
+        model=None,
+        param_file=None,
+        loss=None,
+        screen_fraction=None,
     ):
         """
         Set up for Spotpy
@@ -31,6 +53,10 @@ class SpotSetup(object):
             parameters range of model
         loss
             loss configs including objective function, typically RMSE
+        screen_fraction
+            for bounded evaluation with HydroSceua: the fraction of the period after warmup
+            simulated first to decide if a parameter set is already worse than rejection_threshold;
+            only for time_series loss with obj_func in BOUNDED_LOSSES; None means no screening
         """
         if model is None:
             model = {
@@ -56,11 +82,41 @@ class SpotSetup(object):
         )
         # Just a way to keep this example flexible and applicable to various examples
         self.loss = loss
-        # Load Observation data from file
-        self.p_and_e = p_and_e
+        # Load Observation data from file, cast once to the float precision of the model
+        dtype = model.get("dtype", "float64")
+        # inputs and their parameter-free transforms are prepared once for all runs
+        self.p_and_e = PreparedForcing(p_and_e, dtype)
         # chose observation data after warmup period
-        self.true_obs = qobs[warmup_length:, :, :]
+        self.true_obs = np.asarray(qobs[warmup_length:, :, :], dtype=dtype)
         self.warmup_length = warmup_length
+        if self.loss["type"] == "time_series":
+            # observation is bound once for all runs, see LOSS_DICT
+            self.loss_func = LOSS_DICT[self.loss["obj_func"]](self.true_obs)
+        if self.loss["type"] == "events":
+            if self.loss["events"] is None:
+                raise ValueError(
+                    "events should not be None since you choose events, otherwise choose time_series"
+                )
+            # indices of events are computed once here rather than in every objective call
+            self.event_windows = get_event_windows(
+                self.loss["events"], self.true_obs.shape[0], warmup_length
+            )
+        self.screen_length = 0
+        self.metric_calculator = None
+        if screen_fraction:
+            if (
+                self.loss["type"] != "time_series"
+                or self.loss["obj_func"] not in BOUNDED_LOSSES
+            ):
+                raise ValueError(
+                    f"Bounded evaluation only supports time_series loss of {BOUNDED_LOSSES}"
+                )
+            self.screen_length = int(screen_fraction * self.true_obs.shape[0])
+            # lower bounds of the loss need the statistics of observation as well
+            self.metric_calculator = MetricCalculator(self.true_obs)
+        # set by the sampler before evaluating a point which is rejected if its loss is larger
+        self.rejection_threshold = None
+        self._screened_loss = None
 
     def parameters(self):
         return spotpy.parameter.generate(self.params)
@@ -84,13 +140,21 @@ class SpotSetup(object):
         params = np.array(x).reshape(1, -1)
         # xaj model's output include streamflow and evaporation now,
         # but now we only calibrate the model with streamflow
-        sim, _ = MODEL_DICT[self.model["name"]](
+        sim, screened_loss = screen_simulation(
             self.p_and_e,
             params,
-            warmup_length=self.warmup_length,
-            **self.model,
-            **self.param_range
+            self.warmup_length,
+            self.model,
+            self.param_range,
+            self.metric_calculator,
+            self.loss["obj_func"],
+            self.rejection_threshold,
+            self.screen_length,
         )
+        if sim is None:
+            # rejected early, objectivefunction will return the lower bound of the loss
+            self._screened_loss = screened_loss
+            return np.full(self.true_obs.shape, np.nan)
         return sim
 
     def evaluation(self) -> Union[list, np.array]:
@@ -125,36 +189,107 @@ class SpotSetup(object):
         float
             likelihood
         """
+        if self._screened_loss is not None:
+            screened_loss, self._screened_loss = self._screened_loss, None
+            return screened_loss
         if self.loss["type"] == "time_series":
-            return LOSS_DICT[self.loss["obj_func"]](evaluation, simulation)
+            return self.loss_func(simulation)
         # for events
-        time = self.loss["events"]
-        if time is None:
-            raise ValueError(
-                "time should not be None since you choose events, otherwise choose time_series"
+        return EVENT_LOSS_DICT[self.loss["obj_func"]](
+            evaluation, simulation, self.event_windows
+        )
+
+
+class HydroSceua(spotpy.algorithms.sceua):
+    """
+    SCE-UA of spotpy with bounded evaluation of reflection and contraction points
+
+    In a competitive complex evolution step, a reflection or contraction point is only used
+    when its loss is not larger than the worst point of the simplex, so this worst loss is
+    given to the setup as rejection_threshold and the setup may stop simulating early
+    (see SpotSetup.simulation). The random point is always accepted, so it is fully evaluated.
+    Apart from that, _cceua is the same as spotpy's, so the search is not changed.
+
+    The initial population can also be seeded with known good parameters (initial_params),
+    for example the best runs of a coarse-resolution calibration.
+    """
+
+    def __init__(self, *args, initial_params=None, **kwargs):
+        """
+        Parameters
+        ----------
+        initial_params
+            normalized parameters put in the initial population, [n, n_params];
+            the rest of the population is random; None means a random population
+        """
+        super().__init__(*args, **kwargs)
+        self.initial_params = initial_params
+
+    def _sampleinputmatrix(self, nrows, npars):
+        x = super()._sampleinputmatrix(nrows, npars)
+        if self.initial_params is not None and nrows > 1:
+            # only the initial population is seeded, random points of _cceua are not
+            n_seed = min(len(self.initial_params), nrows)
+            if n_seed > 0:
+                x[:n_seed] = self.initial_params[:n_seed]
+            self.initial_params = None
+        return x
+
+    def _cceua(self, s, sf, discarded_runs):
+        #  This is the subroutine for generating a new point in a simplex,
+        #  see spotpy.algorithms.sceua._cceua for the meaning of variables
+        constant_parameters = np.invert(self.stochastic_parameters)
+        self.nps, self.nopt = s.shape
+        alpha = 1.0
+        beta = 0.5
+
+        # Assign the best and worst points:
+        sw = s[-1, :]
+        fw = sf[-1]
+
+        # Compute the centroid of the simplex excluding the worst point:
+        ce = np.mean(s[:-1, :], axis=0)
+
+        # Attempt a reflection point
+        snew = ce + alpha * (ce - sw)
+        snew[constant_parameters] = sw[constant_parameters]
+        # Check if is outside the bounds:
+        if (snew < self.bl).any() or (snew > self.bu).any():
+            snew = self._sampleinputmatrix(1, self.nopt)[0]
+
+        # points worse than fw are rejected, so they needn't be fully simulated
+        self.setup.rejection_threshold = fw
+        try:
+            _, _, simulations = _algorithm.simulate(self, (1, snew))
+            fnew = self.postprocessing(
+                1, snew, simulations, save_run=False, block_print=True
             )
-        # TODO: not finished for events
-        calibrate_starttime = pd.to_datetime("2012-06-10 0:00:00")
-        calibrate_endtime = pd.to_datetime("2019-12-31 23:00:00")
-        total = 0
-        count = 0
-        for i in range(len(time)):
-            if time.iloc[i, 0] < calibrate_endtime:
-                start_num = (
-                    time.iloc[i, 0] - calibrate_starttime - pd.Timedelta(hours=365)
-                ) / pd.Timedelta(hours=1)
-                end_num = (
-                    time.iloc[i, 1] - calibrate_starttime - pd.Timedelta(hours=365)
-                ) / pd.Timedelta(hours=1)
-                start_num = int(start_num)
-                end_num = int(end_num)
-                like_ = LOSS_DICT[self.loss["obj_func"]](
-                    evaluation[start_num:end_num,], simulation[start_num:end_num,]
+            discarded_runs += 1
+
+            # Reflection failed; now attempt a contraction point:
+            if fnew > fw:
+                snew = sw + beta * (ce - sw)
+                snew[constant_parameters] = sw[constant_parameters]
+
+                _, _, simulations = _algorithm.simulate(self, (2, snew))
+                fnew = self.postprocessing(
+                    2, snew, simulations, save_run=False, block_print=True
                 )
-                count += 1
+                discarded_runs += 1
 
-                total += like_
-        return total / count
+                # Both reflection and contraction have failed, attempt a random point;
+                if fnew > fw:
+                    self.setup.rejection_threshold = None
+                    snew = self._sampleinputmatrix(1, self.nopt)[0]
+                    _, _, simulations = _algorithm.simulate(self, (3, snew))
+                    fnew = self.postprocessing(
+                        3, snew, simulations, save_run=False, block_print=True
+                    )
+                    discarded_runs += 1
+        finally:
+            self.setup.rejection_threshold = None
+        # END OF CCE
+        return snew, fnew, simulations, discarded_runs
 
 
 def calibrate_by_sceua(
@@ -167,6 +302,7 @@ def calibrate_by_sceua(
     algorithm=None,
     loss=None,
     param_file=None,
+    initial_params=None,
 ):
     """
     Function for calibrating model by SCE-UA
@@ -189,13 +325,24 @@ def calibrate_by_sceua(
         we support "gr4j", "hymod", and "xaj", parameters for hydro model
     algorithm
         calibrate algorithm. For example, if you want to calibrate xaj model,
-        and use sce-ua algorithm -- random seed=2000, rep=5000, ngs=7, kstop=3, peps=0.1, pcento=0.1
+        and use sce-ua algorithm -- random seed=2000, rep=5000, ngs=7, kstop=3, peps=0.1, pcento=0.1;
+        an optional "screen_fraction" (such as 0.3) turns on bounded evaluation with HydroSceua;
+        an optional "warm_start" dict seeds initial populations with earlier results or
+        donor basins' parameters (see get_warm_start_params), keeping its "random_fraction"
+        (default 0.5) of the population random
     loss
         loss configs for events calculation or
         just one long time-series calculation
-        with an objective function, typically RMSE
+        with an objective function, typically RMSE;
+        for events, "events" is a table with "start" and "end" indices of events
+        (see get_event_windows), and if it has a "basin" column,
+        each basin is calibrated with its own events
     param_file
         the file of the parameter range, yaml file
+    initial_params
+        a dict from basin id to normalized parameters seeding its initial population,
+        see HydroSceua; it is used instead of algorithm["warm_start"];
+        None means random initial populations
 
     Returns
     -------
@@ -232,30 +379,376 @@ def calibrate_by_sceua(
     kstop = algorithm["kstop"]
     peps = algorithm["peps"]
     pcento = algorithm["pcento"]
+    screen_fraction = algorithm.get("screen_fraction")
+    warm_start = algorithm.get("warm_start")
     np.random.seed(random_seed)  # Makes the results reproduceable
     for i in range(len(basins)):
         # Initialize the xaj example
         # In this case, we tell the setup which algorithm we want to use, so
         # we can use this exmaple for different algorithms
+        basin_loss = loss
+        if isinstance(loss.get("events"), pd.DataFrame) and "basin" in loss["events"]:
+            events = loss["events"]
+            basin_loss = {**loss, "events": events[events["basin"] == basins[i]]}
         spot_setup = SpotSetup(
             p_and_e[:, i : i + 1, :],
             qobs[:, i : i + 1, :],
             warmup_length=warmup_length,
             model=model,
-            loss=loss,
+            loss=basin_loss,
             param_file=param_file,
+            screen_fraction=screen_fraction,
         )
-        if not os.path.exists(dbname):
-            os.makedirs(dbname)
+        # exist_ok as jobs of the same fold may run in parallel
+        os.makedirs(dbname, exist_ok=True)
         db_basin = os.path.join(dbname, basins[i])
+        basin_initial_params = None
+        if initial_params is not None:
+            basin_initial_params = initial_params.get(basins[i])
+        elif warm_start is not None:
+            # the size of the initial population of SCE-UA
+            npt = ngs * (2 * len(spot_setup.parameter_names) + 1)
+            basin_initial_params = get_warm_start_params(
+                basins[i],
+                warm_start,
+                seed_size(npt, warm_start.get("random_fraction", 0.5)),
+            )
         # Select number of maximum allowed repetitions
-        sampler = spotpy.algorithms.sceua(
-            spot_setup,
-            dbname=db_basin,
-            dbformat="csv",
-            random_state=random_seed,
-        )
+        if screen_fraction or basin_initial_params is not None:
+            sampler = HydroSceua(
+                spot_setup,
+                dbname=db_basin,
+                dbformat="csv",
+                random_state=random_seed,
+                initial_params=basin_initial_params,
+            )
+        else:
+            sampler = spotpy.algorithms.sceua(
+                spot_setup,
+                dbname=db_basin,
+                dbformat="csv",
+                random_state=random_seed,
+            )
         # Start the sampler, one can specify ngs, kstop, peps and pcento id desired
         sampler.sample(rep, ngs=ngs, kstop=kstop, peps=peps, pcento=pcento)
         print("Calibrate Finished!")
     return sampler
+
+
+def aggregate_pe_q(p_and_e, qobs, factor):
+    """
+    Sum inputs and observations of every factor time steps
+
+    Precipitation, evaporation and streamflow are all depths of a time step,
+    so their sums are the depths of the coarse time step; the last incomplete
+    coarse step is dropped.
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of model, [time, basin, feature]
+    qobs
+        observation data, [time, basin, 1]
+    factor
+        the number of time steps in a coarse time step
+
+    Returns
+    -------
+    tuple
+        coarse p_and_e and qobs
+    """
+    n_time = p_and_e.shape[0] // factor * factor
+
+    def _sum(arr):
+        arr = np.asarray(arr[:n_time])
+        return arr.reshape(-1, factor, *arr.shape[1:]).sum(axis=1)
+
+    return _sum(p_and_e), _sum(qobs)
+
+
+def calibrate_multifidelity_by_sceua(
+    basins,
+    p_and_e,
+    qobs,
+    dbname,
+    warmup_length=365,
+    model=None,
+    algorithm=None,
+    loss=None,
+    param_file=None,
+):
+    """
+    Calibrate by SCE-UA at a coarse time step first, then at the native one
+
+    The coarse stage runs on inputs aggregated by algorithm["coarse_factor"]
+    (see aggregate_pe_q) and/or the first algorithm["coarse_length"] time steps after
+    warmup; its best runs seed the initial population of the full-resolution stage,
+    which starts near the optimum and converges with a much smaller budget.
+    NOTE: parameters defined per time step (such as CI, CG and the routing parameters
+    of xaj, or x4 of gr4j) mean different things at a coarse time step, so for such models
+    a shortened record ("coarse_length") gives better seeds than aggregation.
+    Results of the coarse stage are saved in dbname/coarse,
+    results of the final stage in dbname as calibrate_by_sceua does.
+
+    Parameters
+    ----------
+    basins
+        basin ids
+    p_and_e
+        inputs of model
+    qobs
+        observation data
+    dbname
+        where save the result file of sampler
+    warmup_length
+        the length of warmup period
+    model
+        parameters for hydro model, see calibrate_by_sceua
+    algorithm
+        parameters of SCE-UA (see calibrate_by_sceua) for the final stage, and
+        "coarse_factor" -- time steps aggregated in the coarse stage, such as 24 for hourly data;
+        "coarse_length" -- time steps after warmup used in the coarse stage, None means all;
+        "coarse_rep" -- rep of the coarse stage, default rep;
+        "random_fraction" -- the fraction of random points in the initial population
+        of the final stage, default 0.5
+    loss
+        loss configs for time_series, see calibrate_by_sceua
+    param_file
+        the file of the parameter range, yaml file
+
+    Returns
+    -------
+    None
+    """
+    if model is None:
+        model = {
+            "name": "xaj_mz",
+            "source_type": "sources5mm",
+            "source_book": "HF",
+            "kernel_size": 15,
+            "time_interval_hours": 24,
+        }
+    if algorithm is None:
+        algorithm = {
+            "name": "SCE_UA_MF",
+            "random_seed": 1234,
+            "rep": 1000,
+            "ngs": 20,
+            "kstop": 5,
+            "peps": 0.1,
+            "pcento": 0.1,
+            "coarse_factor": 24,
+            "coarse_rep": 5000,
+        }
+    if loss is not None and loss["type"] != "time_series":
+        # indices of events are defined on the native time steps
+        raise ValueError("Multi-fidelity calibration only supports time_series loss")
+    factor = algorithm.get("coarse_factor", 1)
+    coarse_length = algorithm.get("coarse_length")
+    end = None if coarse_length is None else warmup_length + coarse_length
+    coarse_p_and_e, coarse_qobs = aggregate_pe_q(p_and_e[:end], qobs[:end], factor)
+    coarse_model = {**model}
+    if "time_interval_hours" in model:
+        coarse_model["time_interval_hours"] = model["time_interval_hours"] * factor
+    if "kernel_size" in model:
+        # the unit hydrograph is defined in time steps
+        coarse_model["kernel_size"] = max(-(-model["kernel_size"] // factor), 1)
+    coarse_algorithm = {
+        **algorithm,
+        "rep": algorithm.get("coarse_rep", algorithm["rep"]),
+    }
+    coarse_dbname = os.path.join(dbname, "coarse")
+    calibrate_by_sceua(
+        basins,
+        coarse_p_and_e,
+        coarse_qobs,
+        coarse_dbname,
+        warmup_length // factor,
+        model=coarse_model,
+        algorithm=coarse_algorithm,
+        loss=loss,
+        param_file=param_file,
+    )
+    n_params = len(read_model_param_dict(param_file)[model["name"]]["param_name"])
+    # the size of the initial population of SCE-UA; a part of it is kept random,
+    # otherwise the seeded population is so concentrated that SCE-UA stops at once
+    npt = algorithm["ngs"] * (2 * n_params + 1)
+    n_seed = seed_size(npt, algorithm.get("random_fraction", 0.5))
+    initial_params = {
+        basin: read_best_runs(os.path.join(coarse_dbname, basin), n_seed)
+        for basin in basins
+    }
+    calibrate_by_sceua(
+        basins,
+        p_and_e,
+        qobs,
+        dbname,
+        warmup_length,
+        model=model,
+        algorithm=algorithm,
+        loss=loss,
+        param_file=param_file,
+        initial_params=initial_params,
+    )
+
+
+def calibrate_cv_by_sceua(
+    cache_dir,
+    basins,
+    fold_windows,
+    where_save,
+    warmup_length=365,
+    model=None,
+    algorithm=None,
+    loss=None,
+    param_file=None,
+    n_workers=1,
+    calibrate_func=None,
+):
+    """
+    Calibrate all basins of all folds by SCE-UA, with fold x basin jobs run concurrently
+
+    The data is loaded once into the memory-mapped cache (see load_pe_q_cache),
+    and every job opens the cache read-only by its directory,
+    so workers share the same pages and only copy the data of their own basin and fold.
+
+    Parameters
+    ----------
+    cache_dir
+        the directory of the cache of p_and_e and qobs
+    basins
+        basin ids
+    fold_windows
+        training and testing index windows of each fold, see split_tsdata_windows
+    where_save
+        the directory of results; a fold's results are saved in "sceua_xaj",
+        or "sceua_xaj_cv{n}" when there are multiple folds
+    warmup_length
+        the length of warmup period
+    model
+        parameters for hydro model, see calibrate_by_sceua
+    algorithm
+        calibrate algorithm, see calibrate_by_sceua
+    loss
+        loss configs, see calibrate_by_sceua; indices of "events" are counted on the
+        whole record of the cache, and each fold only uses the events inside its
+        training windows (see get_fold_events)
+    param_file
+        the file of the parameter range, yaml file
+    n_workers
+        the number of worker processes; 1 means running all jobs in this process
+    calibrate_func
+        the function calibrating basins with the same arguments as calibrate_by_sceua,
+        such as calibrate_by_surrogate; default calibrate_by_sceua
+
+    Returns
+    -------
+    None
+    """
+    if calibrate_func is None:
+        calibrate_func = calibrate_by_sceua
+    jobs = [
+        (
+            calibrate_func,
+            cache_dir,
+            basin,
+            train_windows,
+            os.path.join(
+                where_save,
+                "sceua_xaj" if len(fold_windows) == 1 else f"sceua_xaj_cv{i + 1}",
+            ),
+            warmup_length,
+            model,
+            algorithm,
+            loss,
+            param_file,
+        )
+        for i, (train_windows, _) in enumerate(fold_windows)
+        for basin in basins
+    ]
+    if n_workers <= 1:
+        for job in jobs:
+            _calibrate_job(*job)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_calibrate_job, *job) for job in jobs]
+        for future in as_completed(futures):
+            # raise the exception of a failed job here
+            future.result()
+
+
+def get_fold_events(events, windows, basin=None):
+    """
+    Events inside training windows, with indices on the concatenated data of the windows
+
+    Indices of events are counted on the whole record, but a fold is calibrated with the
+    data of its windows concatenated; only events lying entirely inside one window are kept,
+    as the others would cross the joins of the windows.
+
+    Parameters
+    ----------
+    events
+        a table with "start" and "end" columns, and optionally "basin",
+        or an array with shape [n_event, 2]
+    windows
+        index windows (slices) of the fold, see cross_valid_idx
+    basin
+        if given and events has a "basin" column, only the events of this basin are kept
+
+    Returns
+    -------
+    pd.DataFrame or np.array
+        the kept events in the same form as events, with re-based "start" and "end"
+    """
+    is_table = isinstance(events, pd.DataFrame)
+    if is_table:
+        if basin is not None and "basin" in events:
+            events = events[events["basin"] == basin]
+        start, end = events["start"].to_numpy(), events["end"].to_numpy()
+    else:
+        events = np.asarray(events, dtype=int).reshape(-1, 2)
+        start, end = events[:, 0], events[:, 1]
+    keep = np.zeros(len(start), dtype=bool)
+    new_start, new_end = start.copy(), end.copy()
+    offset = 0
+    for window in windows:
+        # end of an event is inclusive
+        inside = (start >= window.start) & (end < window.stop)
+        new_start[inside] = start[inside] - window.start + offset
+        new_end[inside] = end[inside] - window.start + offset
+        keep |= inside
+        offset += window.stop - window.start
+    if is_table:
+        return events[keep].assign(start=new_start[keep], end=new_end[keep])
+    return np.stack([new_start[keep], new_end[keep]], axis=1)
+
+
+def _calibrate_job(
+    calibrate_func,
+    cache_dir,
+    basin,
+    train_windows,
+    dbname,
+    warmup_length,
+    model,
+    algorithm,
+    loss,
+    param_file,
+):
+    """Calibrate one basin of one fold with its data read from the shared cache"""
+    p_and_e, qobs, _, basins, _ = open_pe_q_cache(cache_dir)
+    i = basins.tolist().index(basin)
+    if loss is not None and loss["type"] == "events":
+        # indices of events refer to the whole record, not to the fold's data
+        loss = {**loss, "events": get_fold_events(loss["events"], train_windows, basin)}
+    calibrate_func(
+        [basin],
+        np.concatenate([p_and_e[window, i : i + 1, :] for window in train_windows]),
+        np.concatenate([qobs[window, i : i + 1, :] for window in train_windows]),
+        dbname,
+        warmup_length,
+        model=model,
+        algorithm=algorithm,
+        loss=loss,
+        param_file=param_file,
+    )
@@ -0,0 +1,263 @@
+"""
+Calibrate a model with a surrogate of the objective function
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial.distance import cdist
+from scipy.stats import qmc
+
+from hydromodel.trainers.calibrate_sceua import SpotSetup
+
+# weights of the surrogate value in the merit of candidates, cycled in the search;
+# a small weight prefers candidates far from evaluated points (exploration)
+SURROGATE_WEIGHTS = [0.3, 0.5, 0.8, 0.95]
+
+
+def latin_hypercube(n, dim, rng):
+    """Latin hypercube samples in the normalized [0, 1] parameter space"""
+    return qmc.LatinHypercube(d=dim, seed=rng).random(n)
+
+
+def fit_surrogate(x, y, smoothing=0.0):
+    """
+    Fit a radial basis function surrogate of the objective function
+
+    Losses of very bad parameter sets are often orders of magnitude larger than others,
+    so values larger than the median are replaced by the median before fitting,
+    which keeps the surface smooth near good points.
+
+    Parameters
+    ----------
+    x
+        evaluated points, [n_points, n_params]
+    y
+        their losses, [n_points]
+    smoothing
+        smoothing of RBFInterpolator; 0 means interpolation
+
+    Returns
+    -------
+    RBFInterpolator
+        the surrogate
+    """
+    y = np.minimum(y, np.median(y))
+    return RBFInterpolator(x, y, kernel="cubic", degree=1, smoothing=smoothing)
+
+
+def generate_candidates(best, n_candidates, n_evals, budget, rng, sigma=0.2):
+    """
+    Generate candidates by perturbing the best point (DYCORS)
+
+    Each coordinate is perturbed with a probability that decreases as the budget is used,
+    so the search is global at the beginning and local at the end.
+
+    Parameters
+    ----------
+    best
+        the best point evaluated, [n_params]
+    n_candidates
+        the number of candidates
+    n_evals
+        the number of evaluations done
+    budget
+        the total number of evaluations
+    rng
+        random generator
+    sigma
+        the standard deviation of perturbations
+
+    Returns
+    -------
+    np.array
+        candidates in [0, 1], [n_candidates, n_params]
+    """
+    dim = best.size
+    prob = min(20.0 / dim, 1.0) * (
+        1.0 - np.log(n_evals + 1.0) / np.log(max(budget, 2) + 1.0)
+    )
+    prob = max(prob, 1.0 / dim)
+    mask = rng.random((n_candidates, dim)) < prob
+    # at least one coordinate is perturbed
+    mask[np.arange(n_candidates), rng.integers(dim, size=n_candidates)] = True
+    cand = best + mask * rng.normal(0.0, sigma, (n_candidates, dim))
+    # reflect into the bounds
+    cand = np.abs(cand)
+    cand = np.where(cand > 1.0, 2.0 - cand, cand)
+    return np.clip(cand, 0.0, 1.0)
+
+
+def select_candidate(candidates, surrogate, x, weight, min_distance=1e-3):
+    """
+    Choose the candidate with the best merit of surrogate value and distance
+
+    Both criteria are scaled to [0, 1]; the merit is
+    weight * surrogate + (1 - weight) * (1 - distance to evaluated points).
+
+    Returns
+    -------
+    np.array or None
+        the chosen point; None if all candidates are too close to evaluated points
+    """
+    dist = cdist(candidates, x).min(axis=1)
+    keep = dist > min_distance
+    if not keep.any():
+        return None
+    candidates, dist = candidates[keep], dist[keep]
+    pred = surrogate(candidates)
+    merit = weight * _unit_scale(pred) + (1.0 - weight) * (1.0 - _unit_scale(dist))
+    return candidates[np.argmin(merit)]
+
+
+def _unit_scale(values):
+    span = values.max() - values.min()
+    if span == 0:
+        return np.zeros_like(values)
+    return (values - values.min()) / span
+
+
+def surrogate_optimize(func, dim, budget, n_initial=None, n_candidates=None, seed=1234):
+    """
+    Minimize func over [0, 1]^dim with at most budget true evaluations
+
+    A Latin hypercube design is evaluated first; then in each iteration an RBF surrogate
+    is fitted to all evaluated points, and only the most promising one of many
+    cheap candidates (see generate_candidates and select_candidate) is evaluated by func.
+
+    Parameters
+    ----------
+    func
+        the objective function of a point in [0, 1]^dim
+    dim
+        the number of parameters
+    budget
+        the number of evaluations of func
+    n_initial
+        the size of the initial design; default 2 * (dim + 1)
+    n_candidates
+        the number of candidates in each iteration; default 100 * dim
+    seed
+        random seed
+
+    Returns
+    -------
+    tuple
+        evaluated points [budget, dim] and their losses [budget]
+    """
+    rng = np.random.default_rng(seed)
+    if n_initial is None:
+        n_initial = 2 * (dim + 1)
+    if n_candidates is None:
+        n_candidates = 100 * dim
+    n_initial = min(n_initial, budget)
+    x = latin_hypercube(n_initial, dim, rng)
+    y = np.array([func(xi) for xi in x], dtype=float)
+    while y.size < budget:
+        finite = np.isfinite(y)
+        surrogate = fit_surrogate(x[finite], y[finite])
+        weight = SURROGATE_WEIGHTS[(y.size - n_initial) % len(SURROGATE_WEIGHTS)]
+        candidates = generate_candidates(
+            x[np.nanargmin(y)], n_candidates, y.size - n_initial, budget, rng
+        )
+        new = select_candidate(candidates, surrogate, x, weight)
+        if new is None:
+            # the search has converged to a point, restart from a random point
+            new = rng.random(dim)
+        x = np.vstack([x, new])
+        y = np.append(y, func(new))
+    return x, y
+
+
+def calibrate_by_surrogate(
+    basins,
+    p_and_e,
+    qobs,
+    dbname,
+    warmup_length=365,
+    model=None,
+    algorithm=None,
+    loss=None,
+    param_file=None,
+):
+    """
+    Function for calibrating model by surrogate-assisted optimization
+
+    The objective is the same as in calibrate_by_sceua (see SpotSetup), but only
+    algorithm["rep"] model runs are spent for each basin; all runs are saved in
+    a csv file with the same "like1" and "par..." columns as spotpy's,
+    so the results are read in the same way as SCE-UA's.
+
+    Parameters
+    ----------
+    basins
+        basin ids
+    p_and_e
+        inputs of model
+    qobs
+        observation data
+    dbname
+        where save the result file of sampler
+    warmup_length
+        the length of warmup period
+    model
+        parameters for hydro model, see calibrate_by_sceua
+    algorithm
+        calibrate algorithm, for example
+        {"name": "SURROGATE", "random_seed": 1234, "rep": 300},
+        with optional "n_initial" and "n_candidates" (see surrogate_optimize)
+    loss
+        loss configs, see calibrate_by_sceua
+    param_file
+        the file of the parameter range, yaml file
+
+    Returns
+    -------
+    pd.DataFrame
+        all runs of the last basin
+    """
+    if algorithm is None:
+        algorithm = {
+            "name": "SURROGATE",
+            "random_seed": 1234,
+            "rep": 300,
+        }
+    os.makedirs(dbname, exist_ok=True)
+    for i in range(len(basins)):
+        basin_loss = loss
+        if (
+            loss is not None
+            and isinstance(loss.get("events"), pd.DataFrame)
+            and "basin" in loss["events"]
+        ):
+            events = loss["events"]
+            basin_loss = {**loss, "events": events[events["basin"] == basins[i]]}
+        spot_setup = SpotSetup(
+            p_and_e[:, i : i + 1, :],
+            qobs[:, i : i + 1, :],
+            warmup_length=warmup_length,
+            model=model,
+            loss=basin_loss,
+            param_file=param_file,
+        )
+
+        def objective(x):
+            sim = spot_setup.simulation(x)
+            return spot_setup.objectivefunction(sim, spot_setup.evaluation())
+
+        x, y = surrogate_optimize(
+            objective,
+            len(spot_setup.parameter_names),
+            algorithm["rep"],
+            n_initial=algorithm.get("n_initial"),
+            n_candidates=algorithm.get("n_candidates"),
+            seed=algorithm["random_seed"],
+        )
+        results = pd.DataFrame(
+            x, columns=[f"par{name}" for name in spot_setup.parameter_names]
+        )
+        results.insert(0, "like1", y)
+        results.to_csv(os.path.join(dbname, f"{basins[i]}.csv"), index=False)
+        print("Calibrate Finished!")
+    return results
@@ -70,7 +70,7 @@ class Evaluator:
             qsim, qobs
         """
         model_info = self.model_info
-        p_and_e, _ = _get_pe_q_from_ts(ds)
+        p_and_e, _ = _get_pe_q_from_ts(ds, dtype=model_info.get("dtype"))
         basins = ds["basin"].data.astype(str)
         params = _read_all_basin_params(basins, self.params_dir)
         qsim, etsim = MODEL_DICT[model_info["name"]](
@@ -255,7 +255,8 @@ class Evaluator:
         ds["pet"] = obs_ds["pet"]
         ds["etsim"] = etsim["et"]
 
-        # 保存为 .nc 文件
+        # 保存为 .nc 文件, in the float precision of the model such as float32
+        ds = ds.astype(self.model_info.get("dtype", "float64"))
         file_path = os.path.join(result_dir, f"{model_name}_evaluation_results.nc")
         ds.to_netcdf(file_path)
 
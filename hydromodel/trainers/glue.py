@@ -0,0 +1,278 @@
+"""
+GLUE / Monte Carlo uncertainty of simulated streamflow with streaming quantiles
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from hydromodel.models.losses import MetricCalculator
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.simulation import simulate_param_sets
+
+
+class StreamingQuantiles:
+    def __init__(self, n_time, q_min, q_max, n_bins=1000):
+        """
+        Weighted quantiles of each time step from simulations added batch by batch
+
+        Weights of values are accumulated in log-spaced bins between q_min and q_max
+        for each time step, so memory is [time, n_bins] however many simulations are added;
+        quantiles are interpolated in a bin, so their relative error is below
+        the bin width (q_max / q_min) ** (1 / n_bins) - 1. Values below q_min
+        (such as 0) are counted in the first bin and values above q_max in the last one.
+
+        Parameters
+        ----------
+        n_time
+            the number of time steps
+        q_min
+            the lower edge of bins, larger than 0
+        q_max
+            the upper edge of bins
+        n_bins
+            the number of bins
+        """
+        self.n_time = n_time
+        self.n_bins = n_bins
+        self.log_edges = np.linspace(np.log(q_min), np.log(q_max), n_bins + 1)
+        self.weights = np.zeros((n_time, n_bins))
+        self.weighted_sum = np.zeros(n_time)
+        self.total_weight = 0.0
+
+    def update(self, values, weights):
+        """
+        Add simulations
+
+        Parameters
+        ----------
+        values
+            simulations, [time, n_sets]
+        weights
+            the weight of each simulation, [n_sets]
+        """
+        keep = weights > 0
+        values, weights = values[:, keep], weights[keep]
+        if weights.size == 0:
+            return
+        with np.errstate(divide="ignore"):
+            bins = np.searchsorted(self.log_edges, np.log(values), side="right") - 1
+        bins = np.clip(bins, 0, self.n_bins - 1)
+        flat = (np.arange(self.n_time)[:, None] * self.n_bins + bins).ravel()
+        self.weights += np.bincount(
+            flat,
+            weights=np.broadcast_to(weights, values.shape).ravel(),
+            minlength=self.weights.size,
+        ).reshape(self.weights.shape)
+        self.weighted_sum += values @ weights
+        self.total_weight += weights.sum()
+
+    def mean(self):
+        """The weighted mean of each time step, which is exact"""
+        return self.weighted_sum / self.total_weight
+
+    def quantiles(self, probs):
+        """
+        Weighted quantiles of each time step
+
+        Parameters
+        ----------
+        probs
+            probabilities in [0, 1]
+
+        Returns
+        -------
+        np.array
+            [n_probs, time]
+        """
+        cum = np.cumsum(self.weights, axis=1)
+        result = np.empty((len(probs), self.n_time))
+        rows = np.arange(self.n_time)
+        for i, prob in enumerate(probs):
+            target = prob * cum[:, -1]
+            k = np.minimum((cum < target[:, None]).sum(axis=1), self.n_bins - 1)
+            below = np.where(k > 0, cum[rows, np.maximum(k - 1, 0)], 0.0)
+            in_bin = self.weights[rows, k]
+            frac = np.clip(
+                np.divide(
+                    target - below,
+                    in_bin,
+                    out=np.zeros(self.n_time),
+                    where=in_bin > 0,
+                ),
+                0.0,
+                1.0,
+            )
+            log_q = self.log_edges[k] + frac * (
+                self.log_edges[k + 1] - self.log_edges[k]
+            )
+            result[i] = np.exp(log_q)
+        return result
+
+
+def glue_basin(
+    p_and_e,
+    qobs,
+    warmup_length,
+    model,
+    param_range,
+    obj_func="NSE",
+    threshold=0.5,
+    n_samples=10000,
+    probs=(0.05, 0.5, 0.95),
+    memory_mb=256,
+    n_bins=1000,
+    seed=1234,
+):
+    """
+    GLUE of one basin: Monte Carlo parameter sets weighted by their likelihood
+
+    Parameter sets are drawn uniformly in the normalized space and simulated in batches
+    sized to memory_mb; a set is behavioral if its loss is not larger than threshold,
+    and its likelihood weight is threshold - loss (for NSE, the NSE above 1 - threshold).
+    Only the weights in StreamingQuantiles are kept, never the simulations.
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of one basin, [time, 1, feature]
+    qobs
+        observation of the basin, [time, 1, 1]
+    warmup_length
+        the length of warmup period
+    model
+        model's config
+    param_range
+        the dict of model's parameters, see read_model_param_dict
+    obj_func
+        the loss, one of METRIC_NAMES, see MetricCalculator.loss
+    threshold
+        the max loss of behavioral sets, such as 0.5 for NSE >= 0.5
+    n_samples
+        the number of parameter sets
+    probs
+        probabilities of quantiles
+    memory_mb
+        the memory budget of a batch of simulations; a set is estimated as
+        20 float64 time series, for the intermediate variables of models
+    n_bins
+        the number of bins of StreamingQuantiles
+    seed
+        random seed
+
+    Returns
+    -------
+    tuple
+        quantiles [n_probs, time], weighted mean [time] of behavioral simulations and
+        a table of all sets with their parameters, "loss" and "weight"
+    """
+    param_names = param_range[model["name"]]["param_name"]
+    rng = np.random.default_rng(seed)
+    params = rng.random((n_samples, len(param_names)))
+    obs = qobs[warmup_length:]
+    metric_calculator = MetricCalculator(obs)
+    n_time = obs.shape[0]
+    batch_size = max(int(memory_mb * 2**20 // (20 * 8 * p_and_e.shape[0])), 1)
+    q_max = 10 * np.nanmax(obs)
+    # flows smaller than 1/1000 of mean flow are not distinguished
+    quantiles = StreamingQuantiles(
+        n_time, max(np.nanmean(obs) / 1000, 1e-6), q_max, n_bins
+    )
+    losses = np.empty(n_samples)
+    for start, q_sim in simulate_param_sets(
+        p_and_e, params, warmup_length, model, param_range, batch_size
+    ):
+        sim = q_sim[:, :, 0]
+        loss = np.atleast_1d(metric_calculator.loss(q_sim, obj_func))
+        losses[start : start + loss.size] = loss
+        quantiles.update(sim, np.maximum(threshold - loss, 0.0))
+    weights = np.maximum(threshold - losses, 0.0)
+    samples = pd.DataFrame(params, columns=param_names)
+    samples["loss"] = losses
+    samples["weight"] = weights / weights.sum() if weights.sum() > 0 else weights
+    if quantiles.total_weight == 0:
+        nan_time = np.full(n_time, np.nan)
+        return np.full((len(probs), n_time), np.nan), nan_time, samples
+    return quantiles.quantiles(probs), quantiles.mean(), samples
+
+
+def glue_uncertainty(
+    basins,
+    p_and_e,
+    qobs,
+    warmup_length=365,
+    model=None,
+    loss=None,
+    param_file=None,
+    threshold=0.5,
+    **kwargs,
+):
+    """
+    GLUE uncertainty bands of simulated streamflow for all basins
+
+    Parameters
+    ----------
+    basins
+        basin ids
+    p_and_e
+        inputs of model, [time, basin, feature]
+    qobs
+        observation data, [time, basin, 1]
+    warmup_length
+        the length of warmup period
+    model
+        parameters for hydro model, see calibrate_by_sceua
+    loss
+        loss configs of time_series with obj_func in METRIC_NAMES, typically NSE
+    param_file
+        the file of the parameter range, yaml file
+    threshold
+        the max loss of behavioral sets, see glue_basin
+    kwargs
+        other settings of glue_basin, such as n_samples, probs and memory_mb
+
+    Returns
+    -------
+    tuple
+        xr.Dataset of "qsim_quantile" [quantile, time, basin] and "qsim_mean" [time, basin]
+        with time as the index after warmup, and a table of parameter sets of all basins
+    """
+    if model is None:
+        model = {
+            "name": "xaj_mz",
+            "source_type": "sources5mm",
+            "source_book": "HF",
+            "kernel_size": 15,
+            "time_interval_hours": 24,
+        }
+    if loss is None:
+        loss = {"type": "time_series", "obj_func": "NSE", "events": None}
+    probs = kwargs.get("probs", (0.05, 0.5, 0.95))
+    param_range = read_model_param_dict(param_file)
+    bands, means, samples = [], [], []
+    for i, basin in enumerate(basins):
+        band, mean, basin_samples = glue_basin(
+            p_and_e[:, i : i + 1, :],
+            qobs[:, i : i + 1, :],
+            warmup_length,
+            model,
+            param_range,
+            loss["obj_func"],
+            threshold,
+            **kwargs,
+        )
+        bands.append(band)
+        means.append(mean)
+        samples.append(basin_samples.assign(basin=basin))
+    ds = xr.Dataset(
+        {
+            "qsim_quantile": (("quantile", "time", "basin"), np.stack(bands, axis=-1)),
+            "qsim_mean": (("time", "basin"), np.stack(means, axis=-1)),
+        },
+        coords={
+            "quantile": list(probs),
+            "time": np.arange(p_and_e.shape[0] - warmup_length),
+            "basin": list(basins),
+        },
+    )
+    return ds, pd.concat(samples, ignore_index=True)
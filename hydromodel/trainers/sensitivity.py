@@ -0,0 +1,318 @@
+"""
+Global sensitivity analysis of model parameters -- Morris and Sobol
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+from hydromodel.models.losses import MetricCalculator
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.simulation import simulate_param_sets
+
+
+def morris_sample(n_trajectories, n_params, n_levels=4, seed=1234):
+    """
+    Morris trajectories in the normalized [0, 1] parameter space
+
+    In a trajectory, parameters are moved one by one in random order by
+    delta = n_levels / (2 * (n_levels - 1)), up or down, from a random point on the grid.
+
+    Parameters
+    ----------
+    n_trajectories
+        the number of trajectories
+    n_params
+        the number of parameters
+    n_levels
+        the number of grid levels, an even number
+    seed
+        random seed
+
+    Returns
+    -------
+    np.array
+        points of trajectories, [n_trajectories, n_params + 1, n_params]
+    """
+    rng = np.random.default_rng(seed)
+    delta = n_levels / (2 * (n_levels - 1))
+    # base points on the grid which can be moved up by delta
+    base = rng.integers(n_levels // 2, size=(n_trajectories, n_params)) / (n_levels - 1)
+    up = rng.random((n_trajectories, n_params)) < 0.5
+    start = np.where(up, base, base + delta)
+    steps = np.where(up, delta, -delta)
+    x = np.repeat(start[:, None, :], n_params + 1, axis=1)
+    for t in range(n_trajectories):
+        for j, i in enumerate(rng.permutation(n_params)):
+            x[t, j + 1 :, i] += steps[t, i]
+    return x
+
+
+def saltelli_sample(n, n_params, seed=1234):
+    """
+    The two independent matrices A and B of Saltelli's scheme from a scrambled Sobol sequence
+
+    Parameters
+    ----------
+    n
+        the number of base samples, a power of 2 is best for the Sobol sequence
+    n_params
+        the number of parameters
+    seed
+        random seed
+
+    Returns
+    -------
+    tuple
+        A and B, both [n, n_params]
+    """
+    ab = qmc.Sobol(d=2 * n_params, scramble=True, seed=seed).random(n)
+    return ab[:, :n_params], ab[:, n_params:]
+
+
+def _losses(
+    p_and_e, params, warmup_length, model, param_range, metric_calculator, obj_func
+):
+    """Losses of all parameter sets of one basin, simulated in one batch"""
+    losses = np.empty(params.shape[0])
+    for start, q_sim in simulate_param_sets(
+        p_and_e, params, warmup_length, model, param_range, params.shape[0]
+    ):
+        losses[start : start + q_sim.shape[1]] = np.atleast_1d(
+            metric_calculator.loss(q_sim, obj_func)
+        )
+    return losses
+
+
+def morris_analysis(
+    p_and_e,
+    qobs,
+    warmup_length,
+    model,
+    param_range,
+    obj_func="RMSE",
+    n_trajectories=50,
+    n_levels=4,
+    batch_size=256,
+    seed=1234,
+):
+    """
+    Morris elementary effects of the loss of one basin
+
+    Trajectories are simulated batch by batch and their elementary effects are accumulated,
+    so only one batch of simulations is in memory at a time.
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of one basin, [time, 1, feature]
+    qobs
+        observation of the basin, [time, 1, 1]
+    warmup_length
+        the length of warmup period
+    model
+        model's config
+    param_range
+        the dict of model's parameters, see read_model_param_dict
+    obj_func
+        the loss, one of METRIC_NAMES
+    n_trajectories
+        the number of trajectories
+    n_levels
+        the number of grid levels
+    batch_size
+        the max number of parameter sets in one model call
+    seed
+        random seed
+
+    Returns
+    -------
+    pd.DataFrame
+        "mu", "mu_star" (mean of absolute effects) and "sigma" of each parameter
+    """
+    param_names = param_range[model["name"]]["param_name"]
+    n_params = len(param_names)
+    trajectories = morris_sample(n_trajectories, n_params, n_levels, seed)
+    metric_calculator = MetricCalculator(qobs[warmup_length:])
+    sum_ee, sum_abs_ee, sum_ee2 = np.zeros((3, n_params))
+    # whole trajectories in a batch
+    n_batch = max(batch_size // (n_params + 1), 1)
+    for start in range(0, n_trajectories, n_batch):
+        x = trajectories[start : start + n_batch]
+        losses = _losses(
+            p_and_e,
+            x.reshape(-1, n_params),
+            warmup_length,
+            model,
+            param_range,
+            metric_calculator,
+            obj_func,
+        ).reshape(x.shape[:2])
+        # in each step only one parameter changes
+        dx = np.diff(x, axis=1)
+        moved = np.argmax(np.abs(dx), axis=2)
+        step = np.take_along_axis(dx, moved[..., None], axis=2)[..., 0]
+        ee = np.diff(losses, axis=1) / step
+        for accumulator, values in zip(
+            (sum_ee, sum_abs_ee, sum_ee2), (ee, np.abs(ee), ee**2)
+        ):
+            np.add.at(accumulator, moved.ravel(), values.ravel())
+    mu = sum_ee / n_trajectories
+    sigma = np.sqrt(
+        np.maximum(sum_ee2 - n_trajectories * mu**2, 0.0) / max(n_trajectories - 1, 1)
+    )
+    return pd.DataFrame(
+        {"mu": mu, "mu_star": sum_abs_ee / n_trajectories, "sigma": sigma},
+        index=param_names,
+    )
+
+
+def sobol_analysis(
+    p_and_e,
+    qobs,
+    warmup_length,
+    model,
+    param_range,
+    obj_func="RMSE",
+    n=1024,
+    batch_size=256,
+    seed=1234,
+):
+    """
+    First-order and total Sobol indices of the loss of one basin
+
+    Saltelli's scheme evaluates A, B and A with its i-th column from B (AB_i);
+    rows are simulated batch by batch and only sums of the estimators are kept:
+    S1_i = mean(f(B) * (f(AB_i) - f(A))) / V (Saltelli 2010) and
+    ST_i = mean((f(A) - f(AB_i)) ** 2) / (2 * V) (Jansen 1999).
+
+    Parameters
+    ----------
+    p_and_e
+        inputs of one basin, [time, 1, feature]
+    qobs
+        observation of the basin, [time, 1, 1]
+    warmup_length
+        the length of warmup period
+    model
+        model's config
+    param_range
+        the dict of model's parameters, see read_model_param_dict
+    obj_func
+        the loss, one of METRIC_NAMES
+    n
+        the number of base samples; n * (n_params + 2) model runs are needed
+    batch_size
+        the max number of parameter sets in one model call
+    seed
+        random seed
+
+    Returns
+    -------
+    pd.DataFrame
+        "S1" and "ST" of each parameter
+    """
+    param_names = param_range[model["name"]]["param_name"]
+    n_params = len(param_names)
+    a, b = saltelli_sample(n, n_params, seed)
+    metric_calculator = MetricCalculator(qobs[warmup_length:])
+    sum_f, sum_f2 = 0.0, 0.0
+    sum_first, sum_total = np.zeros((2, n_params))
+    # rows of A, B and all AB_i of the same base samples in a batch
+    n_batch = max(batch_size // (n_params + 2), 1)
+    for start in range(0, n, n_batch):
+        a_rows, b_rows = a[start : start + n_batch], b[start : start + n_batch]
+        ab_rows = np.repeat(a_rows[:, None, :], n_params, axis=1)
+        ab_rows[:, np.arange(n_params), np.arange(n_params)] = b_rows
+        x = np.concatenate([a_rows[:, None, :], b_rows[:, None, :], ab_rows], axis=1)
+        losses = _losses(
+            p_and_e,
+            x.reshape(-1, n_params),
+            warmup_length,
+            model,
+            param_range,
+            metric_calculator,
+            obj_func,
+        ).reshape(x.shape[:2])
+        f_a, f_b, f_ab = losses[:, 0], losses[:, 1], losses[:, 2:]
+        sum_f += f_a.sum() + f_b.sum()
+        sum_f2 += (f_a**2).sum() + (f_b**2).sum()
+        sum_first += (f_b[:, None] * (f_ab - f_a[:, None])).sum(axis=0)
+        sum_total += ((f_a[:, None] - f_ab) ** 2).sum(axis=0)
+    variance = sum_f2 / (2 * n) - (sum_f / (2 * n)) ** 2
+    return pd.DataFrame(
+        {"S1": sum_first / n / variance, "ST": sum_total / (2 * n) / variance},
+        index=param_names,
+    )
+
+
+def sensitivity_analysis(
+    basins,
+    p_and_e,
+    qobs,
+    warmup_length=365,
+    model=None,
+    method="sobol",
+    loss=None,
+    param_file=None,
+    **kwargs,
+):
+    """
+    Global sensitivity analysis of the loss to model parameters for all basins
+
+    Parameters
+    ----------
+    basins
+        basin ids
+    p_and_e
+        inputs of model, [time, basin, feature]
+    qobs
+        observation data, [time, basin, 1]
+    warmup_length
+        the length of warmup period
+    model
+        parameters for hydro model, see calibrate_by_sceua
+    method
+        "morris" or "sobol"
+    loss
+        loss configs of time_series with obj_func in METRIC_NAMES, typically RMSE
+    param_file
+        the file of the parameter range, yaml file
+    kwargs
+        settings of morris_analysis or sobol_analysis, such as n, batch_size and seed
+
+    Returns
+    -------
+    pd.DataFrame
+        indices with (basin, parameter) as index
+    """
+    if model is None:
+        model = {
+            "name": "xaj_mz",
+            "source_type": "sources5mm",
+            "source_book": "HF",
+            "kernel_size": 15,
+            "time_interval_hours": 24,
+        }
+    if loss is None:
+        loss = {"type": "time_series", "obj_func": "RMSE", "events": None}
+    if method == "morris":
+        analysis = morris_analysis
+    elif method == "sobol":
+        analysis = sobol_analysis
+    else:
+        raise NotImplementedError(f"No sensitivity analysis method {method}")
+    param_range = read_model_param_dict(param_file)
+    results = [
+        analysis(
+            p_and_e[:, i : i + 1, :],
+            qobs[:, i : i + 1, :],
+            warmup_length,
+            model,
+            param_range,
+            loss["obj_func"],
+            **kwargs,
+        )
+        for i in range(len(basins))
+    ]
+    return pd.concat(results, keys=basins, names=["basin", "parameter"])
@@ -0,0 +1,141 @@
+"""
+Initial parameters of calibration from earlier results or donor basins
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def seed_size(n_population, random_fraction=0.5):
+    """The number of seeded individuals when random_fraction of the population is random"""
+    return int(round(n_population * (1 - random_fraction)))
+
+
+def read_best_runs(db_basin, n):
+    """
+    Read the normalized parameters of the n best distinct runs of a calibration
+
+    Parameters
+    ----------
+    db_basin
+        the result file of a basin without ".csv", such as os.path.join(dbname, basin)
+    n
+        the number of runs
+
+    Returns
+    -------
+    np.array
+        parameters sorted from the best, [n, n_params]
+    """
+    results = pd.read_csv(db_basin + ".csv")
+    par_cols = [col for col in results.columns if col.startswith("par")]
+    results = results.dropna(subset=["like1"]).sort_values("like1", kind="stable")
+    return results[par_cols].drop_duplicates().to_numpy()[:n]
+
+
+def read_norm_params(params_file):
+    """
+    Read normalized parameters of basins, such as basins_norm_params.csv of an evaluation
+
+    Returns
+    -------
+    pd.DataFrame
+        basin ids (str) as index and parameter names as columns
+    """
+    params = pd.read_csv(params_file, index_col=0)
+    params.index = params.index.astype(str)
+    return params
+
+
+def nearest_donor_basins(attributes, basin, candidates, k=5, attr_names=None):
+    """
+    Find the k basins most similar to a basin by their attributes
+
+    Attributes are standardized over all basins in the dataset, and the similarity is
+    the Euclidean distance; attributes missing in a pair of basins are ignored.
+
+    Parameters
+    ----------
+    attributes
+        xr.Dataset of basin attributes with one basin dimension, such as attributes.nc
+    basin
+        the target basin id
+    candidates
+        ids of basins which may be donors; the target basin itself is never a donor
+    k
+        the number of donors
+    attr_names
+        names of attributes used; None means all numeric attributes
+
+    Returns
+    -------
+    list
+        ids of donors from the nearest
+    """
+    attrs = attributes.to_dataframe()
+    attrs.index = attrs.index.astype(str)
+    attrs = attrs[attr_names] if attr_names is not None else attrs
+    attrs = attrs.select_dtypes(include="number")
+    attrs = (attrs - attrs.mean()) / attrs.std(ddof=0).replace(0, 1)
+    candidates = [c for c in attrs.index.intersection(candidates) if c != basin]
+    diff = attrs.loc[candidates].to_numpy() - attrs.loc[basin].to_numpy()
+    dist = np.sqrt(np.nansum(diff**2, axis=1))
+    order = np.argsort(dist, kind="stable")[:k]
+    return [candidates[i] for i in order]
+
+
+def get_warm_start_params(basin, warm_start, n_seed):
+    """
+    Collect normalized parameters to seed the initial population of a basin
+
+    Seeds come in this order: the basin's own parameters in params_file,
+    the best runs of the basin in runs_dir, and the parameters of donor basins in
+    params_file from the nearest; duplicates are removed.
+
+    Parameters
+    ----------
+    basin
+        the basin id
+    warm_start
+        a dict with any of the keys
+        "params_file" -- normalized parameters of basins, such as basins_norm_params.csv;
+        "runs_dir" -- the result directory of an earlier calibration, such as a previous fold,
+        in which <basin>.csv has the runs;
+        "attributes_file" -- attributes.nc of basins; if given, the parameters of
+        the "k_donors" (default 5) nearest basins in params_file are also seeds,
+        with "attr_names" selecting attributes;
+        "random_fraction" -- not used here, see seed_size
+    n_seed
+        the max number of seeds
+
+    Returns
+    -------
+    np.array
+        seeds, [n, n_params] with n <= n_seed; it may be empty
+    """
+    seeds = []
+    params = None
+    if warm_start.get("params_file") is not None:
+        params = read_norm_params(warm_start["params_file"])
+        if basin in params.index:
+            seeds.append(params.loc[[basin]].to_numpy())
+    if warm_start.get("runs_dir") is not None:
+        db_basin = os.path.join(warm_start["runs_dir"], basin)
+        if os.path.exists(db_basin + ".csv"):
+            seeds.append(read_best_runs(db_basin, n_seed))
+    if params is not None and warm_start.get("attributes_file") is not None:
+        with xr.open_dataset(warm_start["attributes_file"]) as attributes:
+            donors = nearest_donor_basins(
+                attributes,
+                basin,
+                params.index,
+                warm_start.get("k_donors", 5),
+                warm_start.get("attr_names"),
+            )
+        seeds.append(params.loc[donors].to_numpy())
+    if not seeds:
+        return np.empty((0, 0))
+    seeds = pd.DataFrame(np.concatenate(seeds)).drop_duplicates().to_numpy()
+    return seeds[:n_seed]
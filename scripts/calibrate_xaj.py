@@ -16,16 +16,30 @@ import os
 from pathlib import Path
 import yaml
 
-
 repo_path = os.path.dirname(Path(os.path.abspath(__file__)).parent)
 sys.path.append(repo_path)
 from hydromodel.datasets import *
 from hydromodel.datasets.data_preprocess import (
     _get_pe_q_from_ts,
-    cross_val_split_tsdata,
+    get_pe_q_cache_dir,
+    iter_ts_blocks,
+    load_pe_q_cache,
+    select_by_windows,
+    split_tsdata_windows,
 )
 from hydromodel.models.model_config import MODEL_PARAM_DICT
-from hydromodel.trainers.calibrate_sceua import calibrate_by_sceua
+from hydromodel.trainers.calibrate_sceua import (
+    calibrate_by_sceua,
+    calibrate_cv_by_sceua,
+    calibrate_multifidelity_by_sceua,
+)
+from hydromodel.trainers.calibrate_surrogate import calibrate_by_surrogate
+
+CALIBRATE_FUNCS = {
+    "SCE_UA": calibrate_by_sceua,
+    "SCE_UA_MF": calibrate_multifidelity_by_sceua,
+    "SURROGATE": calibrate_by_surrogate,
+}
 
 
 def calibrate(args):
@@ -43,52 +57,53 @@ def calibrate(args):
     algo_info = args.algorithm
     loss_info = args.loss
     param_range_file = args.param_range_file
+    basin_chunk_size = args.basin_chunk_size
+    calibrate_func = CALIBRATE_FUNCS[algo_info["name"]]
 
     where_save = Path(os.path.join(result_dir, exp))
     if os.path.exists(where_save) is False:
         os.makedirs(where_save)
 
-    train_and_test_data = cross_val_split_tsdata(
-        data_type,
-        data_dir,
-        cv_fold,
-        train_period,
-        test_period,
-        periods,
-        warmup,
-        basin_ids,
-    )
-
     print("Start to calibrate the model")
 
-    if cv_fold <= 1:
-        p_and_e, qobs = _get_pe_q_from_ts(train_and_test_data[0])
-        calibrate_by_sceua(
+    if basin_chunk_size > 0:
+        # out-of-core: only one block of basins is loaded at a time
+        for ts_data in iter_ts_blocks(
+            data_type, data_dir, periods, basin_ids, basin_chunk_size
+        ):
+            _calibrate_tsdata(
+                ts_data,
+                ts_data["basin"].values.astype(str).tolist(),
+                where_save,
+                cv_fold,
+                train_period,
+                test_period,
+                periods,
+                warmup,
+                model_info,
+                algo_info,
+                loss_info,
+                param_range_file,
+                calibrate_func,
+            )
+    else:
+        # the dataset is loaded once into the cache, and jobs of all folds share it
+        _, _, times, _, _ = load_pe_q_cache(data_type, data_dir, periods, basin_ids)
+        calibrate_cv_by_sceua(
+            get_pe_q_cache_dir(data_type, data_dir, periods, basin_ids),
             basin_ids,
-            p_and_e,
-            qobs,
-            os.path.join(where_save, "sceua_xaj"),
+            split_tsdata_windows(
+                times, cv_fold, train_period, test_period, periods, warmup
+            ),
+            where_save,
             warmup,
             model=model_info,
             algorithm=algo_info,
             loss=loss_info,
             param_file=param_range_file,
+            n_workers=args.n_workers,
+            calibrate_func=calibrate_func,
         )
-    else:
-        for i in range(cv_fold):
-            train_data, _ = train_and_test_data[i]
-            p_and_e_cv, qobs_cv = _get_pe_q_from_ts(train_data)
-            calibrate_by_sceua(
-                basin_ids,
-                p_and_e_cv,
-                qobs_cv,
-                os.path.join(where_save, f"sceua_xaj_cv{i+1}"),
-                warmup,
-                model=model_info,
-                algorithm=algo_info,
-                loss=loss_info,
-                param_file=param_range_file,
-            )
     # update the param_range_file path
     if param_range_file is None:
         param_range_file = os.path.join(where_save, "param_range.yaml")
@@ -107,6 +122,42 @@ def calibrate(args):
         yaml.dump(args_dict, f)
 
 
+def _calibrate_tsdata(
+    ts_data,
+    basin_ids,
+    where_save,
+    cv_fold,
+    train_period,
+    test_period,
+    periods,
+    warmup,
+    model_info,
+    algo_info,
+    loss_info,
+    param_range_file,
+    calibrate_func,
+):
+    # folds are index windows, so only the training data of one fold is selected at a time
+    fold_windows = split_tsdata_windows(
+        ts_data["time"].values, cv_fold, train_period, test_period, periods, warmup
+    )
+    for i, (train_windows, _) in enumerate(fold_windows):
+        p_and_e, qobs = _get_pe_q_from_ts(select_by_windows(ts_data, train_windows))
+        calibrate_func(
+            basin_ids,
+            p_and_e,
+            qobs,
+            os.path.join(
+                where_save, "sceua_xaj" if cv_fold <= 1 else f"sceua_xaj_cv{i+1}"
+            ),
+            warmup,
+            model=model_info,
+            algorithm=algo_info,
+            loss=loss_info,
+            param_file=param_range_file,
+        )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Run hydro-model-xaj models with the CAMELS dataset"
@@ -154,6 +205,22 @@ if __name__ == "__main__":
         default=1,
         type=int,
     )
+    parser.add_argument(
+        "--basin_chunk_size",
+        dest="basin_chunk_size",
+        help="the number of basins loaded at a time; 0 means loading all basins at once,"
+        + " for large datasets that don't fit in memory, set it to a positive number",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--n_workers",
+        dest="n_workers",
+        help="the number of processes running calibration jobs (one job is one basin in one fold)"
+        + " concurrently; 1 means running jobs one by one. It is not used with basin_chunk_size > 0",
+        default=1,
+        type=int,
+    )
     parser.add_argument(
         "--warmup",
         dest="warmup",
@@ -247,6 +314,24 @@ if __name__ == "__main__":
             "pcento": 0.1,
         },
         # default={
+        #     "name": "SCE_UA_MF",
+        #     "random_seed": 1234,
+        #     "rep": 1000,
+        #     "ngs": 20,
+        #     "kstop": 5,
+        #     "peps": 0.1,
+        #     "pcento": 0.1,
+        #     # calibrate with daily inputs of hourly data first
+        #     "coarse_factor": 24,
+        #     "coarse_rep": 5000,
+        # },
+        # default={
+        #     "name": "SURROGATE",
+        #     "random_seed": 1234,
+        #     # the number of model runs for each basin
+        #     "rep": 300,
+        # },
+        # default={
         #     "name": "GA",
         #     "random_seed": 1234,
         #     "run_counts": 2,
@@ -12,11 +12,16 @@ import argparse
 import os
 import sys
 from pathlib import Path
-
+import xarray as xr
 
 repo_path = os.path.dirname(Path(os.path.abspath(__file__)).parent)
 sys.path.append(repo_path)
-from hydromodel.datasets.data_preprocess import cross_val_split_tsdata
+from hydromodel.datasets.data_preprocess import (
+    get_ts_from_cache,
+    iter_ts_blocks,
+    select_by_windows,
+    split_tsdata_windows,
+)
 from hydromodel.datasets import *
 from hydromodel.trainers.evaluate import Evaluator, read_yaml_config
 
@@ -34,58 +39,76 @@ def evaluate(args):
     train_period = cali_config["calibrate_period"]
     test_period = cali_config["test_period"]
     periods = cali_config["period"]
-    train_and_test_data = cross_val_split_tsdata(
-        data_type,
-        data_dir,
-        kfold,
-        train_period,
-        test_period,
-        periods,
-        warmup,
-        basins,
-    )
+    basin_chunk_size = cali_config.get("basin_chunk_size", 0)
+    if basin_chunk_size > 0:
+        # out-of-core: blocks of basins are read from the store again for each fold
+        def ts_blocks():
+            return iter_ts_blocks(
+                data_type, data_dir, periods, basins, basin_chunk_size
+            )
+
+    else:
+        ts_data = get_ts_from_cache(data_type, data_dir, periods, basins)
+
+        def ts_blocks():
+            return [ts_data]
+
+    def train_test_blocks(fold=None):
+        for block in ts_blocks():
+            fold_windows = split_tsdata_windows(
+                block["time"].values, kfold, train_period, test_period, periods, warmup
+            )
+            train_windows, test_windows = fold_windows[0 if fold is None else fold]
+            yield select_by_windows(block, train_windows), select_by_windows(
+                block, test_windows
+            )
+
     if kfold <= 1:
-        _evaluate_1fold(train_and_test_data, cali_dir)
+        _evaluate_1fold(train_test_blocks(), cali_dir)
     else:
         for fold in range(kfold):
             print(f"Start to evaluate the {fold+1}-th fold")
             fold_dir = os.path.join(cali_dir, f"sceua_xaj_cv{fold+1}")
             # evaluate both train and test period for all basins
-            train_data = train_and_test_data[fold][0]
-            test_data = train_and_test_data[fold][1]
-            _evaluate(cali_dir, fold_dir, train_data, test_data)
+            _evaluate(cali_dir, fold_dir, train_test_blocks(fold))
             print(f"Finish evaluating the {fold}-th fold")
 
 
-def _evaluate_1fold(train_and_test_data, cali_dir):
+def _evaluate_1fold(train_test_blocks, cali_dir):
     print("Start to evaluate")
     # evaluate both train and test period for all basins
-    train_data = train_and_test_data[0]
-    test_data = train_and_test_data[1]
     param_dir = os.path.join(cali_dir, "sceua_xaj")
-    _evaluate(cali_dir, param_dir, train_data, test_data)
+    _evaluate(cali_dir, param_dir, train_test_blocks)
     print("Finish evaluating")
 
 
-def _evaluate(cali_dir, param_dir, train_data, test_data):
+def _evaluate(cali_dir, param_dir, train_test_blocks):
     eval_train_dir = os.path.join(param_dir, "train")
     eval_test_dir = os.path.join(param_dir, "test")
     train_eval = Evaluator(cali_dir, param_dir, eval_train_dir)
     test_eval = Evaluator(cali_dir, param_dir, eval_test_dir)
-    qsim_train, qobs_train, etsim_train = train_eval.predict(train_data)
-    qsim_test, qobs_test, etsim_test = test_eval.predict(test_data)
-    train_eval.save_results(
-        train_data,
-        qsim_train,
-        qobs_train,
-        etsim_train
-    )
-    test_eval.save_results(
-        test_data,
-        qsim_test,
-        qobs_test,
-        etsim_test
-    )
+    train_results = []
+    test_results = []
+    for train_data, test_data in train_test_blocks:
+        train_results.append(_predict(train_eval, train_data))
+        test_results.append(_predict(test_eval, test_data))
+    train_eval.save_results(*_concat_results(train_results))
+    test_eval.save_results(*_concat_results(test_results))
+
+
+def _predict(the_eval, the_data):
+    qsim, qobs, etsim = the_eval.predict(the_data)
+    # only keep the variables needed for saving results, so blocks' inputs can be released
+    prcp_pet = the_data[
+        [remove_unit_from_name(PRCP_NAME), remove_unit_from_name(PET_NAME)]
+    ]
+    return prcp_pet, qsim, qobs, etsim
+
+
+def _concat_results(results):
+    if len(results) == 1:
+        return results[0]
+    return tuple(xr.concat(list(result), dim="basin") for result in zip(*results))
 
 
 if __name__ == "__main__":
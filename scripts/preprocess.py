@@ -8,10 +8,12 @@ FilePath: \hydromodel\scripts\preprocess.py
 Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import sys
 import os
 import argparse
+import pandas as pd
 
 current_script_path = Path(os.path.realpath(__file__))
 repo_path = current_script_path.parent.parent
@@ -20,7 +22,7 @@ from hydromodel.datasets.data_visualize import plot_rr_events
 from hydromodel.datasets.data_preprocess import (
     get_basin_area,
     get_ts_from_diffsource,
-    get_rr_events,
+    get_rr_event_table,
 )
 
 
@@ -38,15 +40,36 @@ def main(args):
     if rr_event > 0:
         ts_data = get_ts_from_diffsource(data_type, data_path, periods, basin_ids)
         basin_area = get_basin_area(basin_ids, data_type, data_path)
-        rr_events = get_rr_events(ts_data["prcp"], ts_data["flow"], basin_area)
-        for basin, event in rr_events.items():
-            basin_rr_dir = os.path.join(where_save, f"{basin}_rr_events")
-            plot_rr_events(
-                event,
-                ts_data["prcp"].sel(basin=basin),
-                ts_data["flow"].sel(basin=basin),
-                basin_rr_dir,
-            )
+        rr_events = get_rr_event_table(
+            ts_data["prcp"],
+            ts_data["flow"],
+            basin_area,
+            n_workers=args.n_workers,
+            data_type=data_type,
+            data_dir=data_path,
+        )
+        rr_events.to_csv(os.path.join(where_save, "rr_events.csv"), index=False)
+        times = ts_data["time"].values
+        basins = basin_area.basin.values.astype(str)
+        plot_args = (
+            [
+                pd.DataFrame(
+                    {
+                        "BEGINNING_RAIN": times[events["start"].values],
+                        "END_FLOW": times[events["end"].values],
+                    }
+                )
+                for events in (rr_events[rr_events["basin"] == b] for b in basins)
+            ],
+            [ts_data["prcp"].sel(basin=basin) for basin in basins],
+            [ts_data["flow"].sel(basin=basin) for basin in basins],
+            [os.path.join(where_save, f"{basin}_rr_events") for basin in basins],
+        )
+        if args.n_workers <= 1:
+            list(map(plot_rr_events, *plot_args))
+        else:
+            with ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+                list(executor.map(plot_rr_events, *plot_args))
 
 
 if __name__ == "__main__":
@@ -112,5 +135,12 @@ if __name__ == "__main__":
         default=0,
         type=int,
     )
+    parser.add_argument(
+        "--n_workers",
+        dest="n_workers",
+        help="the number of processes for identifying and plotting basins' rr events concurrently",
+        default=1,
+        type=int,
+    )
     args = parser.parse_args()
     main(args)
@@ -17,6 +17,33 @@ from spotpy.examples.spot_setup_hymod_python import spot_setup
 from hydrodataset import Camels
 from hydromodel import SETTING
 
+# the models run on synthetic inputs in tests of states, simulations and forcing
+MODELS = [
+    {"name": "gr4j"},
+    {"name": "hymod"},
+    {"name": "xaj", "source_type": "sources", "source_book": "HF"},
+    {
+        "name": "xaj_mz",
+        "source_type": "sources5mm",
+        "source_book": "HF",
+        "kernel_size": 15,
+        "time_interval_hours": 24,
+    },
+]
+
+
+def synthetic_inputs(rng, shape):
+    """Gamma-distributed precipitation and a constant PET of the given leading shape"""
+    return np.concatenate(
+        [rng.gamma(0.5, 12, size=(*shape, 1)), np.full((*shape, 1), 3.0)], axis=-1
+    )
+
+
+@pytest.fixture()
+def inputs():
+    """Synthetic inputs of 100 periods and 3 basins"""
+    return synthetic_inputs(np.random.default_rng(0), (100, 3))
+
 
 @pytest.fixture()
 def warmup_length():
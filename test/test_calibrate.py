@@ -9,9 +9,31 @@ Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 """
 
 import os
+import pickle
+import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
+from hydroutils import hydro_file
+from hydromodel.datasets.data_preprocess import cross_valid_idx
 from hydromodel.trainers.calibrate_ga import calibrate_by_ga
-from hydromodel.trainers.calibrate_sceua import calibrate_by_sceua
+from hydromodel.models.gr4j import gr4j
+from hydromodel.models.losses import (
+    MetricCalculator,
+    event_peak_error,
+    event_rmse,
+    get_event_windows,
+)
+from hydromodel.trainers.calibrate_sceua import (
+    SpotSetup,
+    aggregate_pe_q,
+    calibrate_by_sceua,
+    calibrate_cv_by_sceua,
+    calibrate_multifidelity_by_sceua,
+    get_fold_events,
+)
+from hydromodel.trainers.calibrate_surrogate import calibrate_by_surrogate
+from hydromodel.trainers.warm_start import get_warm_start_params
 
 
 @pytest.fixture()
@@ -63,3 +85,432 @@ def test_calibrate_xaj_ga(p_and_e, qobs, warmup_length, db_dir):
         deap_dir=os.path.join(db_dir, "ga_xaj"),
         warmup_length=warmup_length,
     )
+
+
+def test_calibrate_cv_by_sceua_parallel(tmp_path):
+    # a synthetic cache with the layout of save_pe_q_cache
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2000-01-01", periods=120).values
+    basins = np.array(["b1", "b2"])
+    np.save(os.path.join(cache_dir, "p_and_e.npy"), rng.random((120, 2, 2)) * 10)
+    np.save(os.path.join(cache_dir, "qobs.npy"), rng.random((120, 2, 1)))
+    np.save(os.path.join(cache_dir, "time.npy"), times)
+    np.save(os.path.join(cache_dir, "basin.npy"), basins)
+    hydro_file.serialize_json({}, os.path.join(cache_dir, "meta.json"))
+    fold_windows = cross_valid_idx(times, ["2000-01-01", "2000-04-29"], 10, 2)
+    calibrate_cv_by_sceua(
+        cache_dir,
+        ["b2", "b1"],
+        fold_windows,
+        str(tmp_path / "result"),
+        10,
+        model={"name": "gr4j"},
+        algorithm={
+            "name": "SCE_UA",
+            "random_seed": 1234,
+            "rep": 5,
+            "ngs": 4,
+            "kstop": 1,
+            "peps": 0.1,
+            "pcento": 0.1,
+        },
+        loss={"type": "time_series", "obj_func": "RMSE", "events": None},
+        n_workers=2,
+    )
+    for fold in [1, 2]:
+        for basin in ["b1", "b2"]:
+            assert os.path.exists(
+                tmp_path / "result" / f"sceua_xaj_cv{fold}" / f"{basin}.csv"
+            )
+
+
+def test_calibrate_cv_events(tmp_path, mocker):
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2000-01-01", periods=120).values
+    qobs = rng.random((120, 2, 1))
+    np.save(os.path.join(cache_dir, "p_and_e.npy"), rng.random((120, 2, 2)) * 10)
+    np.save(os.path.join(cache_dir, "qobs.npy"), qobs)
+    np.save(os.path.join(cache_dir, "time.npy"), times)
+    np.save(os.path.join(cache_dir, "basin.npy"), np.array(["b1", "b2"]))
+    hydro_file.serialize_json({}, os.path.join(cache_dir, "meta.json"))
+    fold_windows = cross_valid_idx(times, ["2000-01-01", "2000-04-29"], 10, 2)
+    # indices on the whole record; training windows are [55, 120) and [0, 65),
+    # so [50, 70] is in neither of them
+    events = pd.DataFrame(
+        {
+            "basin": ["b1", "b1", "b1", "b2", "b2"],
+            "start": [20, 50, 90, 30, 100],
+            "end": [30, 70, 100, 40, 110],
+        }
+    )
+    calibrate = mocker.patch("hydromodel.trainers.calibrate_sceua.calibrate_by_sceua")
+    calibrate_cv_by_sceua(
+        cache_dir,
+        ["b1", "b2"],
+        fold_windows,
+        str(tmp_path / "result"),
+        10,
+        model={"name": "gr4j"},
+        loss={"type": "events", "obj_func": "RMSE", "events": events},
+    )
+    assert calibrate.call_count == 4
+    n_kept = {}
+    for call in calibrate.call_args_list:
+        (basin,), fold_qobs = call.args[0], call.args[2]
+        fold_events = call.kwargs["loss"]["events"]
+        i = ["b1", "b2"].index(basin)
+        assert (fold_events["basin"] == basin).all()
+        for _, event in fold_events.iterrows():
+            # the re-based event is the same part of the record as the original one
+            original = events[
+                (events["basin"] == basin)
+                & (events["end"] - events["start"] == event["end"] - event["start"])
+            ]
+            assert any(
+                np.array_equal(
+                    fold_qobs[event["start"] : event["end"] + 1, 0],
+                    qobs[row["start"] : row["end"] + 1, i],
+                )
+                for _, row in original.iterrows()
+            )
+        n_kept[basin] = n_kept.get(basin, 0) + len(fold_events)
+    # every event is in the training period of a fold, except [50, 70]
+    assert n_kept == {"b1": 2, "b2": 2}
+    # arrays of events are re-based the same way
+    np.testing.assert_array_equal(
+        get_fold_events(
+            np.array([[20, 30], [90, 100]]), [slice(0, 10), slice(60, 120)]
+        ),
+        [[40, 50]],
+    )
+
+
+def test_event_losses():
+    rng = np.random.default_rng(0)
+    obs = rng.random((100, 1, 1))
+    obs[15] = np.nan
+    sim = rng.random((100, 1, 1))
+    warmup = 10
+    # the first event is partly in the warmup period
+    events = pd.DataFrame({"start": [5, 20, 30, 70], "end": [25, 40, 35, 99]})
+    windows = get_event_windows(events, 90, warmup)
+    obs_, sim_ = obs[warmup:], sim[warmup:]
+    rmses, peak_errors = [], []
+    for start, end in [(0, 16), (10, 31), (20, 26), (60, 90)]:
+        rmses.append(np.sqrt(np.nanmean((sim_[start:end] - obs_[start:end]) ** 2)))
+        peak_obs = np.nanmax(obs_[start:end])
+        peak_errors.append(abs(sim_[start:end].max() - peak_obs) / peak_obs)
+    np.testing.assert_allclose(event_rmse(obs_, sim_, windows), np.mean(rmses))
+    np.testing.assert_allclose(
+        event_peak_error(obs_, sim_, windows), np.mean(peak_errors)
+    )
+
+
+def test_spotsetup_events_loss():
+    rng = np.random.default_rng(0)
+    p_and_e = rng.random((100, 1, 2)) * 10
+    qobs = rng.random((100, 1, 1))
+    spot_setup = SpotSetup(
+        p_and_e,
+        qobs,
+        warmup_length=10,
+        model={"name": "gr4j"},
+        loss={
+            "type": "events",
+            "obj_func": "RMSE",
+            "events": np.array([[20, 40], [60, 80]]),
+        },
+    )
+    sim = spot_setup.simulation([0.5] * 4)
+    like = spot_setup.objectivefunction(sim, spot_setup.evaluation())
+    expected = np.mean(
+        [
+            np.sqrt(np.mean((sim[s:e] - qobs[10:][s:e]) ** 2))
+            for s, e in [(10, 31), (50, 71)]
+        ]
+    )
+    np.testing.assert_allclose(like, expected)
+
+
+def test_bounded_sceua_same_as_sceua(tmp_path, mocker):
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(400, 1, 1)), np.full((400, 1, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((1, 4), 0.5), warmup_length=0)
+    qobs = qobs + rng.normal(0, 0.1, qobs.shape)
+    algorithm = {
+        "name": "SCE_UA",
+        "random_seed": 1234,
+        "rep": 200,
+        "ngs": 4,
+        "kstop": 2,
+        "peps": 0.001,
+        "pcento": 0.001,
+    }
+    loss = {"type": "time_series", "obj_func": "RMSE", "events": None}
+    calibrate_by_sceua(
+        ["b1"],
+        p_and_e,
+        qobs,
+        str(tmp_path / "plain"),
+        30,
+        model={"name": "gr4j"},
+        algorithm=algorithm,
+        loss=loss,
+    )
+    screen_spy = mocker.spy(MetricCalculator, "loss_lower_bound")
+    calibrate_by_sceua(
+        ["b1"],
+        p_and_e,
+        qobs,
+        str(tmp_path / "bounded"),
+        30,
+        model={"name": "gr4j"},
+        algorithm={**algorithm, "screen_fraction": 0.3},
+        loss=loss,
+    )
+    assert screen_spy.call_count > 0
+    plain = pd.read_csv(tmp_path / "plain" / "b1.csv")
+    bounded = pd.read_csv(tmp_path / "bounded" / "b1.csv")
+    # bounded evaluation only stops rejected points early, so the search is the same
+    pd.testing.assert_frame_equal(plain, bounded)
+
+
+def test_bounded_ga_same_as_ga(tmp_path, mocker):
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(400, 1, 1)), np.full((400, 1, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((1, 4), 0.5), warmup_length=0)
+    qobs = qobs + rng.normal(0, 0.1, qobs.shape)
+    ga_param = {
+        "random_seed": 1234,
+        "run_counts": 4,
+        "pop_num": 20,
+        "cross_prob": 0.5,
+        "mut_prob": 0.5,
+        "save_freq": 1,
+        "mu_plus_lambda": True,
+    }
+    with pytest.raises(ValueError):
+        calibrate_by_ga(
+            p_and_e,
+            qobs,
+            str(tmp_path / "generational"),
+            30,
+            model={"name": "gr4j"},
+            ga_param={**ga_param, "mu_plus_lambda": False, "screen_fraction": 0.3},
+        )
+    calibrate_by_ga(
+        p_and_e,
+        qobs,
+        str(tmp_path / "plain"),
+        30,
+        model={"name": "gr4j"},
+        ga_param=ga_param,
+    )
+    screen_spy = mocker.spy(MetricCalculator, "loss_lower_bound")
+    calibrate_by_ga(
+        p_and_e,
+        qobs,
+        str(tmp_path / "bounded"),
+        30,
+        model={"name": "gr4j"},
+        ga_param={**ga_param, "screen_fraction": 0.3},
+    )
+    assert screen_spy.call_count > 0
+    with open(tmp_path / "plain" / "epoch4.pkl", "rb") as f:
+        plain = pickle.load(f)
+    with open(tmp_path / "bounded" / "epoch4.pkl", "rb") as f:
+        bounded = pickle.load(f)
+    # rejected offspring could never be kept, so the search is the same
+    assert list(bounded["halloffame"][0]) == list(plain["halloffame"][0])
+    assert (
+        bounded["halloffame"][0].fitness.values == plain["halloffame"][0].fitness.values
+    )
+    assert list(bounded["logbook"]) == list(plain["logbook"])
+    assert [list(ind) for ind in bounded["population"]] == [
+        list(ind) for ind in plain["population"]
+    ]
+
+
+def test_calibrate_by_surrogate(tmp_path):
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(400, 1, 1)), np.full((400, 1, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.array([[0.3, 0.6, 0.4, 0.7]]), warmup_length=0)
+    results = calibrate_by_surrogate(
+        ["b1"],
+        p_and_e,
+        qobs,
+        str(tmp_path),
+        30,
+        model={"name": "gr4j"},
+        algorithm={"name": "SURROGATE", "random_seed": 1234, "rep": 40},
+        loss={"type": "time_series", "obj_func": "RMSE", "events": None},
+    )
+    saved = pd.read_csv(tmp_path / "b1.csv")
+    assert list(saved.columns) == ["like1", "parx1", "parx2", "parx3", "parx4"]
+    assert len(saved) == 40
+    np.testing.assert_allclose(saved["like1"], results["like1"])
+    # the points proposed by the surrogate improve the initial design
+    assert saved["like1"].min() < saved["like1"][:10].min()
+
+
+def test_aggregate_pe_q():
+    p_and_e = np.arange(20, dtype=float).reshape(5, 1, 4)
+    p_and_e = np.concatenate([p_and_e, p_and_e + 1], axis=1).transpose(2, 1, 0)
+    qobs = np.ones((4, 2, 1))
+    coarse_p_and_e, coarse_qobs = aggregate_pe_q(p_and_e, qobs, 3)
+    assert coarse_p_and_e.shape == (1, 2, 5)
+    np.testing.assert_array_equal(
+        coarse_p_and_e, p_and_e[:3].sum(axis=0, keepdims=True)
+    )
+    np.testing.assert_array_equal(coarse_qobs, np.full((1, 2, 1), 3.0))
+
+
+def test_calibrate_multifidelity_by_sceua(tmp_path):
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.1, 10, size=(960, 1, 1)), np.full((960, 1, 1), 0.1)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((1, 4), 0.5), warmup_length=0)
+    algorithm = {
+        "name": "SCE_UA_MF",
+        "random_seed": 1234,
+        "rep": 60,
+        "ngs": 2,
+        "kstop": 1,
+        "peps": 0.1,
+        "pcento": 0.1,
+        "coarse_factor": 4,
+        "coarse_rep": 100,
+    }
+    calibrate_multifidelity_by_sceua(
+        ["b1"],
+        p_and_e,
+        qobs,
+        str(tmp_path),
+        120,
+        model={"name": "gr4j"},
+        algorithm=algorithm,
+        loss={"type": "time_series", "obj_func": "RMSE", "events": None},
+    )
+    coarse = pd.read_csv(tmp_path / "coarse" / "b1.csv")
+    fine = pd.read_csv(tmp_path / "b1.csv")
+    par_cols = [col for col in fine.columns if col.startswith("par")]
+    # the initial population of the final stage is the best of the coarse stage
+    best_coarse = coarse.sort_values("like1", kind="stable")[par_cols].to_numpy()
+    np.testing.assert_allclose(fine[par_cols].to_numpy()[:2], best_coarse[:2])
+
+
+@pytest.fixture()
+def warm_start_files(tmp_path):
+    params = pd.DataFrame(
+        np.array([[0.1] * 4, [0.2] * 4, [0.3] * 4, [0.4] * 4]),
+        index=["b1", "b2", "b3", "b4"],
+        columns=["x1", "x2", "x3", "x4"],
+    )
+    params.to_csv(tmp_path / "basins_norm_params.csv")
+    attributes = xr.Dataset(
+        {
+            "area": ("id", [100.0, 120.0, 900.0, 105.0, 110.0]),
+            "slope": ("id", [1.0, 1.1, 5.0, 1.0, 1.2]),
+        },
+        coords={"id": ["b1", "b2", "b3", "b4", "b5"]},
+    )
+    attributes.to_netcdf(tmp_path / "attributes.nc")
+    return {
+        "params_file": str(tmp_path / "basins_norm_params.csv"),
+        "attributes_file": str(tmp_path / "attributes.nc"),
+        "k_donors": 2,
+    }
+
+
+def test_get_warm_start_params(warm_start_files):
+    # a basin's own parameters come first, then its nearest donors
+    np.testing.assert_array_equal(
+        get_warm_start_params("b1", warm_start_files, 10)[:, 0], [0.1, 0.4, 0.2]
+    )
+    # a new basin has only donors
+    np.testing.assert_array_equal(
+        get_warm_start_params("b5", warm_start_files, 1)[:, 0], [0.2]
+    )
+
+
+def test_calibrate_by_sceua_warm_start(tmp_path, warm_start_files):
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(200, 1, 1)), np.full((200, 1, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((1, 4), 0.5), warmup_length=0)
+    calibrate_by_sceua(
+        ["b5"],
+        p_and_e,
+        qobs,
+        str(tmp_path / "sceua"),
+        30,
+        model={"name": "gr4j"},
+        algorithm={
+            "name": "SCE_UA",
+            "random_seed": 1234,
+            "rep": 30,
+            "ngs": 2,
+            "kstop": 1,
+            "peps": 0.1,
+            "pcento": 0.1,
+            "warm_start": warm_start_files,
+        },
+        loss={"type": "time_series", "obj_func": "RMSE", "events": None},
+    )
+    results = pd.read_csv(tmp_path / "sceua" / "b5.csv")
+    par_cols = [col for col in results.columns if col.startswith("par")]
+    np.testing.assert_allclose(results[par_cols].to_numpy()[:2], [[0.2] * 4, [0.4] * 4])
+    # the rest of the initial population is random
+    assert results[par_cols].iloc[2:18].nunique().min() == 16
+
+
+def test_calibrate_by_ga_warm_start(tmp_path, warm_start_files):
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(200, 1, 1)), np.full((200, 1, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((1, 4), 0.5), warmup_length=0)
+    ga_param = {
+        "random_seed": 1234,
+        "run_counts": 1,
+        "pop_num": 10,
+        "cross_prob": 0.5,
+        "mut_prob": 0.5,
+        "save_freq": 1,
+        "warm_start": warm_start_files,
+    }
+    with pytest.raises(ValueError):
+        calibrate_by_ga(
+            p_and_e,
+            qobs,
+            str(tmp_path / "ga"),
+            30,
+            model={"name": "gr4j"},
+            ga_param=ga_param,
+        )
+    calibrate_by_ga(
+        p_and_e,
+        qobs,
+        str(tmp_path / "ga"),
+        30,
+        model={"name": "gr4j"},
+        ga_param=ga_param,
+        basin_id="b5",
+    )
+    with open(tmp_path / "ga" / "epoch0.pkl", "rb") as f:
+        population = pickle.load(f)["population"]
+    np.testing.assert_allclose(
+        [list(ind) for ind in population[:2]], [[0.2] * 4, [0.4] * 4]
+    )
@@ -5,6 +5,8 @@ import os
 import pandas as pd
 import xarray as xr
 
+import hydromodel.datasets.data_preprocess
+
 from hydromodel import SETTING
 from hydromodel.datasets import *
 from hydromodel.datasets.data_preprocess import (
@@ -14,6 +16,15 @@ from hydromodel.datasets.data_preprocess import (
     check_basin_attr_format,
     check_folder_contents,
     cross_valid_data,
+    cross_valid_idx,
+    select_by_windows,
+    read_folder_contents,
+    read_tsdata,
+    iter_ts_blocks,
+    get_ts_store_dir,
+    get_ts_from_cache,
+    load_pe_q_cache,
+    get_rr_event_table,
 )
 
 
@@ -225,6 +236,44 @@ def test_check_folder_contents_with_missing_basin_attributes_column(
     assert check_folder_contents(all_data_dir, basin_attrs_file) == False
 
 
+def test_read_tsdata_parses_time_once(all_data_dir):
+    file_path = os.path.join(all_data_dir, "basin_1.csv")
+    data, time_format = read_tsdata(file_path)
+    assert time_format == "%Y-%m-%d %H:%M:%S"
+    assert pd.api.types.is_datetime64_any_dtype(data[TIME_NAME])
+
+
+def test_read_tsdata_with_inconsistent_intervals(tmp_path):
+    file_path = os.path.join(str(tmp_path), "hydro_data.csv")
+    pd.DataFrame(
+        {
+            TIME_NAME: ["2022-01-01", "2022-01-02", "2022-01-04"],
+            PET_NAME: [1, 2, 3],
+            PRCP_NAME: [4, 5, 6],
+            FLOW_NAME: [7, 8, 9],
+        }
+    ).to_csv(file_path, index=False)
+    data, time_format = read_tsdata(file_path)
+    assert data is None and time_format is None
+
+
+def test_read_folder_contents_reads_each_file_once(
+    basin_attrs_file, all_data_dir, mocker
+):
+    read_csv = mocker.spy(pd, "read_csv")
+    basin_attrs, ts_data = read_folder_contents(all_data_dir, basin_attrs_file)
+    assert list(ts_data.keys()) == ["1", "2", "3"]
+    assert basin_attrs[ID_NAME].tolist() == ["1", "2", "3"]
+    # each basin's time series file is read only once
+    basin_files = [
+        call
+        for call in read_csv.call_args_list
+        if os.path.basename(str(call.args[0])).startswith("basin_")
+        and not str(call.args[0]).endswith("basin_attributes.csv")
+    ]
+    assert len(basin_files) == 3
+
+
 def test_process_and_save_data_as_nc_with_valid_data(all_data_dir, basin_attrs_file):
     # Create a temporary folder for testing
     folder_path = os.path.join(all_data_dir, "test_folder")
@@ -251,6 +300,142 @@ def test_process_and_save_data_as_nc_with_valid_data(all_data_dir, basin_attrs_f
     assert ds_ts is not None
 
 
+def test_iter_ts_blocks_owndata(all_data_dir, basin_attrs_file, tmp_path, mocker):
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.CACHE_DIR", str(tmp_path / "cache")
+    )
+    # unit conversion is not what we test here
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.streamflow_unit_conv",
+        side_effect=lambda qobs, basin_area, target_unit: qobs,
+    )
+    assert process_and_save_data_as_nc(all_data_dir, all_data_dir)
+    periods = ["2022-01-01", "2022-01-03"]
+    blocks = list(iter_ts_blocks("owndata", all_data_dir, periods, ["1", "2", "3"], 2))
+    assert [block["basin"].values.tolist() for block in blocks] == [
+        ["1", "2"],
+        ["3"],
+    ]
+    store_dir = get_ts_store_dir(all_data_dir)
+    assert sorted(os.listdir(store_dir)) == [
+        "chunk_00000.nc",
+        "chunk_00001.nc",
+        "store.json",
+    ]
+    np.testing.assert_array_equal(
+        blocks[1]["prcp"].sel(basin="3").values, np.array([4, 5, 6])
+    )
+
+
+def test_get_ts_from_cache_owndata(all_data_dir, basin_attrs_file, tmp_path, mocker):
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.CACHE_DIR", str(tmp_path / "cache")
+    )
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.streamflow_unit_conv",
+        side_effect=lambda qobs, basin_area, target_unit: qobs,
+    )
+    assert process_and_save_data_as_nc(all_data_dir, all_data_dir)
+    periods = ["2022-01-01", "2022-01-03"]
+    basin_ids = ["1", "2", "3"]
+    read_spy = mocker.spy(hydromodel.datasets.data_preprocess, "get_ts_from_diffsource")
+    ts_data = get_ts_from_cache("owndata", all_data_dir, periods, basin_ids)
+    ts_data_again = get_ts_from_cache("owndata", all_data_dir, periods, basin_ids)
+    # the source is only read for the first time
+    assert read_spy.call_count == 1
+    xr.testing.assert_equal(ts_data, ts_data_again)
+    np.testing.assert_array_equal(
+        ts_data["prcp"].sel(basin="3").values, np.array([4, 5, 6])
+    )
+    p_and_e, qobs, times, basins, _ = load_pe_q_cache(
+        "owndata", all_data_dir, periods, basin_ids
+    )
+    assert isinstance(p_and_e, np.memmap) and isinstance(qobs, np.memmap)
+    assert p_and_e.shape == (3, 3, 2) and qobs.shape == (3, 3, 1)
+    assert basins.tolist() == basin_ids
+
+
+@pytest.fixture()
+def rr_data():
+    times = pd.date_range("2020-01-01", periods=600, freq="h")
+    rain = np.zeros((600, 2))
+    for start in [50, 250, 450]:
+        rain[start : start + 6] = 5.0
+    # a linear reservoir response for the flow
+    flow = np.zeros_like(rain)
+    for t in range(1, 600):
+        flow[t] = 0.9 * flow[t - 1] + 0.1 * rain[t - 1]
+    flow += 0.01
+    basins = ["1", "2"]
+    coords = {"time": times, "basin": basins}
+    rain = xr.DataArray(rain, coords=coords, dims=["time", "basin"])
+    flow = xr.DataArray(flow, coords=coords, dims=["time", "basin"])
+    rain.attrs["units"] = flow.attrs["units"] = "mm/1h"
+    basin_area = xr.Dataset(
+        {"area": ("basin", [100.0, 200.0])}, coords={"basin": basins}
+    )
+    return rain, flow, basin_area
+
+
+def test_get_rr_event_table(rr_data, tmp_path, mocker):
+    rain, flow, basin_area = rr_data
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.CACHE_DIR", str(tmp_path / "cache")
+    )
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.streamflow_unit_conv",
+        return_value=np.array([0.5, 0.5]),
+    )
+
+    # DMCA-ESR itself is tested in hydrodatasource, here events simply start with rain
+    def identify(rain, flow, multiple, flow_threshold, rain_min):
+        starts = rain.index[(rain.values > rain_min) & (rain.shift(1).values == 0)]
+        return pd.DataFrame(
+            {"BEGINNING_RAIN": starts, "END_FLOW": starts + pd.Timedelta(hours=30)}
+        )
+
+    mocker.patch(
+        "hydromodel.datasets.data_preprocess.rainfall_runoff_event_identify",
+        side_effect=identify,
+    )
+    table = get_rr_event_table(rain, flow, basin_area, n_workers=2, use_cache=False)
+    assert table["start"].tolist() == [50, 250, 450] * 2
+    assert list(table.columns) == ["basin", "start", "end", "peak"]
+    assert set(table["basin"]) == {"1", "2"}
+    assert (table["start"] <= table["end"]).all()
+    for _, event in table.iterrows():
+        np.testing.assert_allclose(
+            event["peak"],
+            flow.sel(basin=event["basin"])
+            .values[event["start"] : event["end"] + 1]
+            .max(),
+        )
+    # the table is only cached for a given data source
+    assert not os.path.exists(tmp_path / "cache")
+    source = {"data_type": "camels_us", "data_dir": str(tmp_path / "camels_us")}
+    to_csv_spy = mocker.spy(pd.DataFrame, "to_csv")
+    serial_table = get_rr_event_table(rain, flow, basin_area, n_workers=1, **source)
+    # the rows of each basin are appended to the cache as soon as the basin is done
+    assert to_csv_spy.call_count == 2
+    assert len(os.listdir(tmp_path / "cache" / "rr_events")) == 1
+    pd.testing.assert_frame_equal(table, serial_table)
+    pd.testing.assert_frame_equal(
+        get_rr_event_table(
+            rain, flow, basin_area, n_workers=2, use_cache=False, **source
+        ),
+        serial_table,
+    )
+    # later calls read the cached table without reading the data
+    identify_spy = mocker.spy(
+        hydromodel.datasets.data_preprocess, "_identify_basin_rr_events"
+    )
+    inputs_spy = mocker.spy(hydromodel.datasets.data_preprocess, "_rr_event_inputs")
+    pd.testing.assert_frame_equal(
+        get_rr_event_table(rain, flow, basin_area, **source), serial_table
+    )
+    assert identify_spy.call_count == 0 and inputs_spy.call_count == 0
+
+
 def test_load_dataset():
     dataset_dir = SETTING["local_data_path"]["datasets-origin"]
     camels = Camels(os.path.join(dataset_dir, "camels", "camels_us"))
@@ -285,6 +470,23 @@ def test_cross_valid_data(ts_data_tmp):
     assert len(train_test_data) == cv_fold
 
 
+def test_cross_valid_idx(ts_data_tmp):
+    period = ("2022-01-01", "2022-01-10")
+    fold_windows = cross_valid_idx(ts_data_tmp["time"].values, period, 3, 3)
+    # the middle fold's training data has a gap where its testing data is
+    assert fold_windows[1] == ([slice(0, 6), slice(8, 10)], [slice(3, 8)])
+    train_data = select_by_windows(ts_data_tmp, fold_windows[1][0])
+    test_data = select_by_windows(ts_data_tmp, fold_windows[1][1])
+    assert train_data.time.size == 8
+    # a contiguous window is a view of the data, not a copy
+    assert np.shares_memory(test_data["flow"].values, ts_data_tmp["flow"].values)
+    for (train, test), (train_w, test_w) in zip(
+        cross_valid_data(ts_data_tmp, period, 3, 3), fold_windows
+    ):
+        xr.testing.assert_identical(train, select_by_windows(ts_data_tmp, train_w))
+        xr.testing.assert_identical(test, select_by_windows(ts_data_tmp, test_w))
+
+
 def test_split_train_test(ts_data_tmp):
     # Define the train and test periods
     train_period = ("2022-01-01", "2022-01-05")
@@ -0,0 +1,92 @@
+"""
+Test case for prepared inputs of models
+"""
+
+import numpy as np
+import pytest
+
+from hydromodel.models.forcing import PreparedForcing, prepare_forcing
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.model_dict import MODEL_DICT
+from hydromodel.models.model_state import step, warmup_state
+from test.conftest import MODELS
+
+
+@pytest.fixture()
+def dry_inputs(inputs):
+    # dry spells of all basins
+    inputs[30:50, :, 0] = 0.0
+    # a strided array, such as a transposed DataArray
+    return inputs[:, ::-1]
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+@pytest.mark.parametrize("model", MODELS)
+def test_prepared_forcing_same_as_array(model, dry_inputs, dtype):
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, n_params))
+    model = {**model, "dtype": dtype}
+    run = MODEL_DICT[model["name"]]
+    q, e = run(dry_inputs, params, warmup_length=20, **model, **param_range)
+    forcing = PreparedForcing(dry_inputs, dtype)
+    # the same forcing is used by many runs
+    for _ in range(2):
+        q_prepared, e_prepared = run(
+            forcing, params, warmup_length=20, **model, **param_range
+        )
+        np.testing.assert_array_equal(q_prepared, q)
+        np.testing.assert_array_equal(e_prepared, e)
+    # and by stepping over its slices
+    state = warmup_state(forcing[:20], params, model, param_range)
+    q_step, state = step(
+        state, forcing[20:], params, model, param_range, outputs=("q_sim",)
+    )
+    np.testing.assert_array_equal(q_step, q)
+
+
+@pytest.mark.parametrize("model", MODELS[1:])
+def test_prepared_forcing_negative_prcp(model, inputs):
+    # a little negative precipitation, as in some data
+    inputs[::7, :, 0] = -0.1
+    clipped = inputs.copy()
+    clipped[:, :, 0] = np.maximum(clipped[:, :, 0], 0.0)
+    forcing = PreparedForcing(inputs)
+    np.testing.assert_array_equal(forcing.series("prcp"), clipped[:, :, 0])
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, n_params))
+    run = MODEL_DICT[model["name"]]
+    # the precipitation clipped once for the prepared inputs is the same as clipping
+    # the array before the run
+    q, e = run(clipped, params, warmup_length=20, **model, **param_range)
+    q_prepared, e_prepared = run(
+        forcing, params, warmup_length=20, **model, **param_range
+    )
+    np.testing.assert_array_equal(q_prepared, q)
+    np.testing.assert_array_equal(e_prepared, e)
+
+
+def test_prepared_forcing_slices(dry_inputs):
+    forcing = PreparedForcing(dry_inputs)
+    assert forcing.p_and_e.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(
+        forcing.series("wet_periods"),
+        np.flatnonzero((dry_inputs[:, :, 0] > 0).any(axis=1)),
+    )
+    # slices share the inputs and series of the whole period
+    sliced = forcing[25:60, :, :]
+    assert sliced.shape == (35, 3, 2)
+    assert np.shares_memory(sliced.p_and_e, forcing.p_and_e)
+    assert np.shares_memory(sliced.series("precip_net"), forcing.series("precip_net"))
+    np.testing.assert_array_equal(
+        sliced.series("precip_net"),
+        np.maximum(dry_inputs[25:60, :, 0] - dry_inputs[25:60, :, 1], 0.0),
+    )
+    np.testing.assert_array_equal(sliced.series("wet_periods"), np.r_[0:5, 25:35])
+    assert prepare_forcing(forcing) is forcing
+    assert prepare_forcing(forcing, "float32").dtype == np.float32
+    with pytest.raises(IndexError):
+        forcing[:, 0]
+    with pytest.raises(IndexError):
+        forcing[::2]
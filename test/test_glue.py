@@ -0,0 +1,65 @@
+"""
+Test case for GLUE uncertainty
+"""
+
+import numpy as np
+
+from hydromodel.models.gr4j import gr4j
+from hydromodel.trainers.glue import StreamingQuantiles, glue_uncertainty
+
+
+def _weighted_quantile(values, weights, prob):
+    order = np.argsort(values)
+    cum = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cum, prob * cum[-1])]
+
+
+def test_streaming_quantiles():
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(0, 1, size=(3, 20000))
+    weights = rng.random(20000)
+    quantiles = StreamingQuantiles(3, 1e-3, 1e3, n_bins=2000)
+    for start in range(0, 20000, 3000):
+        quantiles.update(values[:, start : start + 3000], weights[start : start + 3000])
+    result = quantiles.quantiles([0.05, 0.5, 0.95])
+    expected = [
+        [_weighted_quantile(values[t], weights, p) for t in range(3)]
+        for p in [0.05, 0.5, 0.95]
+    ]
+    np.testing.assert_allclose(result, expected, rtol=0.02)
+    np.testing.assert_allclose(quantiles.mean(), values @ weights / weights.sum())
+
+
+def test_glue_uncertainty():
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(300, 2, 1)), np.full((300, 2, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((2, 4), 0.5), warmup_length=0)
+    ds, samples = glue_uncertainty(
+        ["b1", "b2"],
+        p_and_e,
+        qobs,
+        30,
+        model={"name": "gr4j"},
+        n_samples=200,
+        memory_mb=0.1,
+    )
+    assert ds["qsim_quantile"].shape == (3, 270, 2)
+    assert len(samples) == 400
+    behavioral = samples[samples["loss"] <= 0.5]
+    assert len(behavioral) > 0
+    np.testing.assert_allclose(samples.groupby("basin")["weight"].sum(), 1.0)
+    # quantile bands are ordered
+    band = ds["qsim_quantile"].values
+    assert (band[0] <= band[1] + 1e-12).all() and (band[1] <= band[2] + 1e-12).all()
+    # the weighted mean of behavioral simulations is exact
+    b1 = behavioral[behavioral["basin"] == "b1"]
+    q_sim, _ = gr4j(
+        np.repeat(p_and_e[:, :1], len(b1), axis=1),
+        b1[["x1", "x2", "x3", "x4"]].to_numpy(),
+        warmup_length=30,
+    )
+    np.testing.assert_allclose(
+        ds["qsim_mean"].sel(basin="b1"), q_sim[:, :, 0] @ b1["weight"].to_numpy()
+    )
@@ -0,0 +1,100 @@
+"""
+Test cases for loss functions
+"""
+
+import numpy as np
+import pytest
+from spotpy.objectivefunctions import rmse
+
+from hydromodel.models.losses import MetricCalculator
+from hydromodel.models.model_dict import LOSS_DICT, rmse43darr
+
+
+@pytest.fixture()
+def obs_sim():
+    rng = np.random.default_rng(1234)
+    obs = rng.gamma(2.0, 1.0, size=(200, 2, 1))
+    obs[[3, 50, 120], 0, 0] = np.nan
+    sim = obs * rng.uniform(0.7, 1.3, size=obs.shape) + 0.1
+    sim[[3, 50, 120], 0, 0] = 1.0
+    return obs, sim
+
+
+def _reference_metrics(obs, sim):
+    mask = ~np.isnan(obs)
+    o, s = obs[mask], sim[mask]
+    eps = max(o.mean() / 100, 1e-6)
+    lo, ls = np.log(o + eps), np.log(np.maximum(s, 0) + eps)
+    r = np.corrcoef(o, s)[0, 1]
+    return {
+        "RMSE": np.sqrt(np.mean((s - o) ** 2)),
+        "NSE": 1 - np.sum((s - o) ** 2) / np.sum((o - o.mean()) ** 2),
+        "KGE": 1
+        - np.sqrt(
+            (r - 1) ** 2 + (s.std() / o.std() - 1) ** 2 + (s.mean() / o.mean() - 1) ** 2
+        ),
+        "logNSE": 1 - np.sum((ls - lo) ** 2) / np.sum((lo - lo.mean()) ** 2),
+        "peak_error": abs(s.max() - o.max()) / o.max(),
+    }
+
+
+def test_metrics_of_each_basin(obs_sim):
+    obs, sim = obs_sim
+    metrics = MetricCalculator(obs)(sim)
+    for b in range(2):
+        expected = _reference_metrics(obs[:, b, 0], sim[:, b, 0])
+        for name, value in expected.items():
+            np.testing.assert_allclose(metrics[name][b], value, rtol=1e-10)
+
+
+def test_float32_metrics(obs_sim):
+    obs, sim = obs_sim
+    obs32, sim32 = obs.astype(np.float32), sim.astype(np.float32)
+    metrics = MetricCalculator(obs32)(sim32)
+    for b in range(2):
+        # sums are accumulated in float64, so only the rounding of data matters
+        expected = _reference_metrics(
+            obs32[:, b, 0].astype(float), sim32[:, b, 0].astype(float)
+        )
+        for name, value in expected.items():
+            np.testing.assert_allclose(metrics[name][b], value, rtol=1e-6)
+
+
+def test_batched_simulations(obs_sim):
+    obs, sim = obs_sim
+    sims = np.stack([sim[:, 0, 0], sim[:, 0, 0] * 2, obs[:, 1, 0]], axis=1)
+    calculator = MetricCalculator(obs[:, 0:1, :])
+    losses = calculator.loss(sims, "NSE")
+    assert losses.shape == (3,)
+    for j in range(3):
+        np.testing.assert_allclose(
+            losses[j],
+            1 - _reference_metrics(obs[:, 0, 0], sims[:, j])["NSE"],
+            rtol=1e-10,
+        )
+
+
+def test_rmse43darr(obs_sim):
+    obs, sim = obs_sim
+    rmses = np.sqrt(np.nanmean((sim - obs) ** 2, axis=0))
+    np.testing.assert_allclose(rmse43darr(obs, sim), rmses.mean())
+    assert isinstance(LOSS_DICT["KGE"](obs[:, :1])(sim[:, :1]), float)
+    sim[10, 1, 0] = np.nan
+    with pytest.raises(ValueError):
+        rmse43darr(obs, sim)
+
+
+def test_loss_dict_binds_obs(obs_sim, mocker):
+    obs, sim = obs_sim
+    init = mocker.spy(MetricCalculator, "__init__")
+    loss = LOSS_DICT["NSE"](obs)
+    losses = [loss(sim * scale) for scale in [0.5, 1.0, 2.0]]
+    # observation is prepared once for all simulations
+    assert init.call_count == 1
+    for scale, value in zip([0.5, 1.0, 2.0], losses):
+        np.testing.assert_allclose(
+            value, MetricCalculator(obs).loss(sim * scale, "NSE")
+        )
+    np.testing.assert_allclose(LOSS_DICT["RMSE"](obs)(sim), rmse43darr(obs, sim))
+    obs1, sim1 = obs[:, 1, 0], sim[:, 1, 0]
+    assert LOSS_DICT["spotpy_rmse"](obs1)(sim1) == rmse(obs1, sim1)
@@ -0,0 +1,145 @@
+"""
+Test case for model states and stepwise simulation
+"""
+
+import numpy as np
+import pytest
+
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.model_dict import MODEL_DICT
+from hydromodel.models.model_state import ModelState, step
+from test.conftest import MODELS
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_step_chunks_same_as_whole_run(model, inputs):
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    # long lags and unit hydrographs, so that chunks are shorter than the routing memory
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, n_params))
+    q, _ = MODEL_DICT[model["name"]](
+        inputs, params, warmup_length=0, **model, **param_range
+    )
+    state = None
+    q_steps = []
+    start = 0
+    for length in [1, 2, 7, 40, 50]:
+        q_chunk, _, new_state = step(
+            state, inputs[start : start + length], params, model, param_range
+        )
+        if state is not None:
+            # the given state is not changed
+            np.testing.assert_array_equal(state.values, before)
+        before = new_state.values.copy()
+        state = new_state
+        q_steps.append(q_chunk)
+        start += length
+    np.testing.assert_allclose(np.concatenate(q_steps), q, atol=1e-10)
+    # the last state is the same as that returned by the model
+    _, _, *states = MODEL_DICT[model["name"]](
+        inputs, params, warmup_length=0, return_state=True, **model, **param_range
+    )
+    np.testing.assert_allclose(
+        state.values, ModelState.from_tuple(model["name"], states).values
+    )
+
+
+def test_model_state_variables():
+    x_quick = np.arange(6.0).reshape(2, 3)
+    state = ModelState.from_tuple("hymod", (np.zeros(2), x_quick, np.ones(2)))
+    assert state.values.shape == (5, 2)
+    assert state.n_basin == 2
+    np.testing.assert_array_equal(state["x_quick"], x_quick)
+    np.testing.assert_array_equal(state.to_tuple()[2], np.ones(2))
+    with pytest.raises(KeyError):
+        state["s"]
+    with pytest.raises(AttributeError):
+        state.other = 1
+    copied = state.copy()
+    copied.values[:] = 0.0
+    np.testing.assert_array_equal(state["x_quick"], x_quick)
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_model_state_save_load(model, inputs, tmp_path):
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, n_params))
+    _, _, state = step(None, inputs[:60], params, model)
+    state.save(tmp_path / "state", time_step=np.array(60))
+    loaded, metadata = ModelState.load(tmp_path / "state.npz")
+    assert loaded.name == model["name"]
+    assert metadata["time_step"] == 60
+    # the loaded state continues the same as the saved one
+    q, _, _ = step(state, inputs[60:], params, model)
+    q_loaded, _, _ = step(loaded, inputs[60:], params, model)
+    np.testing.assert_array_equal(q_loaded, q)
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_outputs_chosen(model, inputs):
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, n_params))
+    run = MODEL_DICT[model["name"]]
+    q, e = run(inputs, params, warmup_length=10, **model, **param_range)
+    (q_only,) = run(
+        inputs, params, warmup_length=10, outputs=("q_sim",), **model, **param_range
+    )
+    np.testing.assert_array_equal(q_only, q)
+    # only states are returned when no series is chosen
+    states = run(
+        inputs, params, warmup_length=0, return_state=True, outputs=(), **model
+    )
+    assert len(states) == len(ModelState.from_tuple(model["name"], states).to_tuple())
+    with pytest.raises(ValueError):
+        run(inputs, params, 0, outputs=("q_sim", "other"), **model)
+
+
+def test_xaj_component_outputs(inputs):
+    model = MODELS[3]
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, 15))
+    q, rim, rs, ri, rg, qi, qg, s = MODEL_DICT["xaj_mz"](
+        inputs,
+        params,
+        warmup_length=0,
+        outputs=("q_sim", "rim", "rs", "ri", "rg", "qi", "qg", "s"),
+        **model,
+    )
+    assert q.shape == s.shape == (100, 3, 1)
+    assert np.all(s >= 0.0)
+    # runoff is split into surface, interflow and groundwater
+    assert np.all(rim >= 0.0) and np.all(rs >= 0.0) and np.all(ri >= 0.0)
+    # the last states are those of the last period
+    *_, state = step(None, inputs, params, model, outputs=())
+    np.testing.assert_allclose(s[-1, :, 0], state["s"])
+    np.testing.assert_allclose(qi[-1, :, 0], state["qi"])
+    np.testing.assert_allclose(qg[-1, :, 0], state["qg"])
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_float32_models(model, inputs):
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = np.random.default_rng(1).uniform(0.5, 1.0, (3, n_params))
+    run = MODEL_DICT[model["name"]]
+    q, *states = run(
+        inputs, params, warmup_length=10, return_state=True, **model, **param_range
+    )
+    q32, *states32 = run(
+        inputs,
+        params,
+        warmup_length=10,
+        return_state=True,
+        outputs=("q_sim",),
+        **{**model, "dtype": "float32"},
+        **param_range,
+    )
+    assert q32.dtype == np.float32
+    assert all(state.dtype == np.float32 for state in states32)
+    np.testing.assert_allclose(q32, q, rtol=0, atol=1e-4 * np.abs(q).max())
+    # states and routing memory stay float32 when stepping
+    *_, state = step(None, inputs[:30], params, {**model, "dtype": "float32"})
+    assert state.values.dtype == np.float32
+    q_step, _, _ = step(state, inputs[30:], params, {**model, "dtype": "float32"})
+    assert q_step.dtype == np.float32
@@ -0,0 +1,74 @@
+"""
+Test case for sensitivity analysis
+"""
+
+import numpy as np
+import pytest
+
+from hydromodel.models.hymod import hymod
+from hydromodel.models.gr4j import gr4j
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.simulation import simulate_param_sets
+from hydromodel.trainers.sensitivity import (
+    morris_sample,
+    sensitivity_analysis,
+    sobol_analysis,
+)
+
+
+@pytest.fixture()
+def basin_data():
+    rng = np.random.default_rng(0)
+    p_and_e = np.concatenate(
+        [rng.gamma(0.5, 8, size=(300, 2, 1)), np.full((300, 2, 1), 3.0)], axis=2
+    )
+    qobs, _ = gr4j(p_and_e, np.full((2, 4), 0.5), warmup_length=0)
+    return p_and_e, qobs
+
+
+def test_morris_sample():
+    x = morris_sample(10, 5, n_levels=4)
+    assert x.shape == (10, 6, 5)
+    assert x.min() >= 0 and x.max() <= 1
+    dx = np.diff(x, axis=1)
+    # every parameter moves once by delta in each trajectory
+    assert (np.count_nonzero(dx, axis=2) == 1).all()
+    np.testing.assert_allclose(np.abs(dx).sum(axis=1), 2 / 3)
+
+
+def test_simulate_param_sets_hymod(basin_data):
+    p_and_e = basin_data[0][:, :1, :]
+    params = np.random.default_rng(1).random((5, 5))
+    batches = list(simulate_param_sets(p_and_e, params, 30, {"name": "hymod"}, {}, 2))
+    assert [start for start, _ in batches] == [0, 2, 4]
+    q_sim = np.concatenate([q for _, q in batches], axis=1)
+    for i in range(5):
+        q, _ = hymod(p_and_e, params[i : i + 1], warmup_length=30)
+        np.testing.assert_allclose(q_sim[:, i], q[:, 0])
+
+
+def test_sobol_analysis_batches(basin_data):
+    p_and_e, qobs = basin_data
+    param_range = read_model_param_dict(None)
+    args = (p_and_e[:, :1], qobs[:, :1], 30, {"name": "gr4j"}, param_range, "RMSE")
+    small = sobol_analysis(*args, n=64, batch_size=20)
+    large = sobol_analysis(*args, n=64, batch_size=1000)
+    assert list(small.columns) == ["S1", "ST"]
+    np.testing.assert_allclose(small.to_numpy(), large.to_numpy())
+    assert np.isfinite(small.to_numpy()).all()
+
+
+def test_sensitivity_analysis_morris(basin_data):
+    p_and_e, qobs = basin_data
+    indices = sensitivity_analysis(
+        ["b1", "b2"],
+        p_and_e,
+        qobs,
+        30,
+        model={"name": "gr4j"},
+        method="morris",
+        n_trajectories=8,
+    )
+    assert indices.index.names == ["basin", "parameter"]
+    assert indices.loc["b2"].index.tolist() == ["x1", "x2", "x3", "x4"]
+    assert (indices["mu_star"] >= np.abs(indices["mu"]) - 1e-12).all()
@@ -0,0 +1,92 @@
+"""
+Test case for ensemble simulations
+"""
+
+import numpy as np
+import pytest
+
+from hydromodel.models.model_config import read_model_param_dict
+from hydromodel.models.model_dict import MODEL_DICT
+from hydromodel.models.simulation import ensemble_simulate, simulate_in_chunks
+from test.conftest import MODELS, synthetic_inputs
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_ensemble_simulate_same_as_members(model):
+    rng = np.random.default_rng(0)
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = rng.random((2, n_params))
+    p_and_e_warmup = synthetic_inputs(rng, (60, 2))
+    p_and_e_ens = synthetic_inputs(rng, (40, 4, 2))
+    q_ens = ensemble_simulate(
+        p_and_e_ens, params, model, param_range, p_and_e_warmup=p_and_e_warmup
+    )
+    assert q_ens.shape == (40, 4, 2)
+    for member in range(4):
+        for basin in range(2):
+            # each member of each basin is the same as running it alone with warmup
+            q, _ = MODEL_DICT[model["name"]](
+                np.concatenate(
+                    [
+                        p_and_e_warmup[:, basin : basin + 1],
+                        p_and_e_ens[:, member, basin : basin + 1],
+                    ]
+                ),
+                params[basin : basin + 1],
+                warmup_length=60,
+                **model,
+                **param_range,
+            )
+            np.testing.assert_allclose(q_ens[:, member, basin], q[:, 0, 0], atol=1e-10)
+    bands = ensemble_simulate(
+        p_and_e_ens,
+        params,
+        model,
+        param_range,
+        p_and_e_warmup=p_and_e_warmup,
+        probs=[0.1, 0.9],
+    )
+    np.testing.assert_allclose(bands, np.quantile(q_ens, [0.1, 0.9], axis=1))
+
+
+@pytest.mark.parametrize("model", MODELS)
+def test_simulate_in_chunks_same_as_whole_run(model, tmp_path):
+    rng = np.random.default_rng(0)
+    param_range = read_model_param_dict(None)
+    n_params = len(param_range[model["name"]]["param_name"])
+    params = rng.uniform(0.5, 1.0, (2, n_params))
+    p_and_e = synthetic_inputs(rng, (300, 2))
+    q, _ = MODEL_DICT[model["name"]](
+        p_and_e, params, warmup_length=50, **model, **param_range
+    )
+    # blocks shorter than the warmup and the routing memory
+    q_chunks, state = simulate_in_chunks(
+        p_and_e, params, 50, model, param_range, chunk_length=7
+    )
+    np.testing.assert_allclose(q_chunks, q, atol=1e-10)
+    assert state.n_basin == 2
+    # the record read from and written to memmaps
+    np.save(tmp_path / "p_and_e.npy", p_and_e)
+    q_file, _ = simulate_in_chunks(
+        np.load(tmp_path / "p_and_e.npy", mmap_mode="r"),
+        params,
+        50,
+        model,
+        param_range,
+        chunk_length=64,
+        sink=str(tmp_path / "q.npy"),
+    )
+    np.testing.assert_allclose(np.load(tmp_path / "q.npy"), q, atol=1e-10)
+    # a callable sink gets each block
+    starts = []
+    simulate_in_chunks(
+        p_and_e,
+        params,
+        50,
+        model,
+        param_range,
+        chunk_length=100,
+        sink=lambda start, q_sim, e_sim: starts.append((start, q_sim.shape[0])),
+    )
+    assert starts == [(0, 100), (100, 100), (200, 50)]
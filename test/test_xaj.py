@@ -1,7 +1,17 @@
 import numpy as np
 import pytest
 
-from hydromodel.models.xaj import xaj, uh_gamma, uh_conv
+from hydromodel.models.xaj import (
+    dry_periods,
+    generation,
+    piece_coefficients,
+    sources,
+    sources5mm,
+    xaj,
+    uh_gamma,
+    uh_conv,
+    uh_conv_with_memory,
+)
 
 
 @pytest.fixture()
@@ -65,6 +75,88 @@ def test_uh():
     )
 
 
+def test_uh_streaming():
+    rng = np.random.default_rng(0)
+    runoff = rng.random((50, 3))
+    uh = rng.random((7, 3))
+    batch, _ = uh_conv_with_memory(runoff, uh)
+    for i in range(3):
+        np.testing.assert_allclose(
+            batch[:, i], np.convolve(runoff[:, i], uh[:, i])[:50]
+        )
+    # one period, then chunks, from the ring buffers
+    memory = None
+    streamed = []
+    for start, end in [(0, 1), (1, 2), (2, 5), (5, 50)]:
+        routed, memory = uh_conv_with_memory(runoff[start:end], uh, memory)
+        streamed.append(routed)
+    np.testing.assert_allclose(np.concatenate(streamed), batch)
+    assert memory[0].shape == (3, 7)
+
+
+@pytest.mark.parametrize("source_type", ["sources", "sources5mm"])
+@pytest.mark.parametrize("book", ["HF", "EH"])
+def test_dry_periods_same_as_each_period(source_type, book):
+    rng = np.random.default_rng(0)
+    n_basin = 4
+    k, b, im, c, ex = rng.uniform(0.1, 0.9, (5, n_basin))
+    um, lm, dm, sm = rng.uniform(10.0, 80.0, (4, n_basin))
+    ki, kg = rng.uniform(0.1, 0.4, (2, n_basin))
+    w = (0.5 * um, 0.3 * lm, 0.8 * dm)
+    s, fr = 0.7 * sm, rng.uniform(0.1, 0.5, n_basin)
+    # no precipitation, and a little negative value as in some data
+    p_and_e = np.stack([np.zeros((30, n_basin)), rng.uniform(0, 6, (30, n_basin))], 2)
+    p_and_e[5, 0, 0] = -0.1
+    if source_type == "sources5mm":
+        ki_dry, kg_dry = piece_coefficients(ki, kg, 1, np.ones(n_basin))
+    else:
+        ki_dry, kg_dry = ki, kg
+    (e, ri, rg), (wu, wl, wd, s_dry) = dry_periods(
+        p_and_e, k, um, lm, dm, c, sm, ex, ki_dry, kg_dry, w, s, fr, book=book
+    )
+    for i in range(30):
+        (r, rim, e_i, pe), w = generation(p_and_e[i], k, b, im, um, lm, dm, c, *w)
+        if source_type == "sources":
+            (rs, ri_i, rg_i), (s, fr) = sources(pe, r, sm, ex, ki, kg, s, fr, book)
+        else:
+            (rs, ri_i, rg_i), (s, fr) = sources5mm(
+                pe, r, sm, ex, ki, kg, s, fr, time_interval_hours=1, book=book
+            )
+        assert not r.any() and not rim.any() and not rs.any()
+        np.testing.assert_array_equal(e[i], e_i)
+        np.testing.assert_array_equal(ri[i], ri_i)
+        np.testing.assert_array_equal(rg[i], rg_i)
+        np.testing.assert_array_equal(np.stack([wu[i], wl[i], wd[i]]), np.stack(w))
+        np.testing.assert_array_equal(s_dry[i], s)
+
+
+def test_xaj_dry_spells():
+    rng = np.random.default_rng(0)
+    # storms between long dry spells, such as hourly records
+    prcp = np.where(rng.random((500, 2)) < 0.1, rng.gamma(0.6, 4, (500, 2)), 0.0)
+    p_and_e = np.stack([prcp, np.full((500, 2), 0.2)], 2)
+    params = rng.uniform(0.2, 0.8, (2, 15))
+    model = {
+        "name": "xaj_mz",
+        "source_type": "sources5mm",
+        "source_book": "HF",
+        "time_interval_hours": 1,
+    }
+    q, s = xaj(p_and_e, params, warmup_length=0, outputs=("q_sim", "s"), **model)
+    # each basin alone has more dry spells but the same result
+    for j in range(2):
+        q_j, s_j = xaj(
+            p_and_e[:, j : j + 1],
+            params[j : j + 1],
+            warmup_length=0,
+            outputs=("q_sim", "s"),
+            **model,
+        )
+        np.testing.assert_allclose(q_j[:, 0], q[:, j], rtol=1e-12)
+        np.testing.assert_allclose(s_j[:, 0], s[:, j], rtol=1e-12)
+    assert (s > 0).all() and np.isfinite(q).all()
+
+
 def test_xaj(p_and_e, params, warmup_length):
     qsim, e = xaj(
         p_and_e,
@@ -0,0 +1,158 @@
+"""
+Test case for the BMI interface of XAJ
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from hydromodel.models.model_state import step, warmup_state
+from hydromodel.models.xaj import xaj
+from hydromodel.models.xaj_bmi import xajBmi
+
+MODEL = {
+    "name": "xaj_mz",
+    "source_type": "sources5mm",
+    "source_book": "HF",
+    "kernel_size": 15,
+    "time_interval_hours": 24,
+}
+
+
+@pytest.fixture()
+def bmi_config(tmp_path):
+    rng = np.random.default_rng(0)
+    forcing = pd.DataFrame(
+        {
+            "time": pd.date_range("2000-01-01", periods=130),
+            "prcp(mm/day)": rng.gamma(0.5, 12, 130),
+            "pet(mm/day)": np.full(130, 3.0),
+        }
+    )
+    forcing.to_csv(tmp_path / "basin.csv", index=False)
+    config = {
+        "forcing_file": str(tmp_path / "basin.csv"),
+        "warmup_length": 30,
+        "time_units": "days",
+        "model": MODEL,
+        "params": rng.random(15).tolist(),
+    }
+    config_file = tmp_path / "config.yaml"
+    with open(config_file, "w") as file:
+        yaml.dump(config, file)
+    p_and_e = forcing[["prcp(mm/day)", "pet(mm/day)"]].to_numpy()[:, None, :]
+    return str(config_file), p_and_e, np.array(config["params"]).reshape(1, -1)
+
+
+def test_bmi_updates_same_as_whole_run(bmi_config):
+    config_file, p_and_e, params = bmi_config
+    q, es = xaj(p_and_e, params, warmup_length=30, **MODEL)
+    model = xajBmi()
+    model.initialize(config_file)
+    assert model.get_end_time() == 100.0
+    discharge = []
+    for _ in range(20):
+        model.update()
+        discharge.append(model.get_value("discharge", np.empty(1))[0])
+    np.testing.assert_allclose(discharge, q[:20, 0, 0])
+    assert model.get_current_time() == 20.0
+    # the rest periods in one call
+    model.update_until(model.get_end_time())
+    assert model.get_current_time() == 100.0
+    np.testing.assert_allclose(model.get_value_ptr("discharge"), q[-1, 0])
+    np.testing.assert_allclose(model.get_value_ptr("ET"), es[-1, 0])
+    model.finalize()
+
+
+def test_bmi_set_input(bmi_config):
+    config_file, p_and_e, params = bmi_config
+    model = xajBmi()
+    model.initialize(config_file)
+    model.update()
+    # a heavy storm set by a coupled model for the next period
+    model.set_value("precipitation", np.array([200.0]))
+    model.update()
+    p_and_e[31, 0, 0] = 200.0
+    q, _ = xaj(p_and_e[:32], params, warmup_length=30, **MODEL)
+    np.testing.assert_allclose(model.get_value_ptr("discharge"), q[-1, 0])
+
+
+def test_bmi_many_basins_buffers(tmp_path, bmi_config):
+    config_file, p_and_e, _ = bmi_config
+    with open(config_file) as file:
+        config = yaml.safe_load(file)
+    basin_ids = ["b1", "b2", "b3"]
+    params = np.random.default_rng(2).random((3, 15))
+    pd.DataFrame(params, index=basin_ids).to_csv(tmp_path / "params.csv")
+    config.pop("forcing_file")
+    config.pop("params")
+    config.update(
+        {
+            "basin_ids": basin_ids,
+            "forcing_files": [str(tmp_path / "basin.csv")] * 3,
+            "params_file": str(tmp_path / "params.csv"),
+        }
+    )
+    with open(config_file, "w") as file:
+        yaml.dump(config, file)
+    model = xajBmi()
+    model.initialize(config_file)
+    assert model.get_grid_size(model.get_var_grid("discharge")) == 3
+    assert "wu" in model.get_output_var_names()
+    discharge = model.get_value_ptr("discharge")
+    soil_moisture = model.get_value_ptr("s")
+    model.update()
+    # buffers are updated in place
+    assert model.get_value_ptr("discharge") is discharge
+    assert np.shares_memory(model.get_value_ptr("s"), soil_moisture)
+    q, _ = xaj(np.repeat(p_and_e[:31], 3, axis=1), params, warmup_length=30, **MODEL)
+    np.testing.assert_allclose(discharge, q[-1, :, 0])
+    dest = np.empty(2)
+    model.get_value_at_indices("discharge", dest, np.array([2, 0]))
+    np.testing.assert_allclose(dest, q[-1, [2, 0], 0])
+    # assimilate the free water storage of the second basin
+    inputs = np.repeat(p_and_e, 3, axis=1)
+    state = warmup_state(inputs[:30], params, MODEL)
+    _, _, state = step(state, inputs[30:31], params, MODEL)
+    model.set_value_at_indices("s", np.array([1]), np.array([0.0]))
+    state.values[3, 1] = 0.0
+    model.update()
+    q, _, _ = step(state, inputs[31:32], params, MODEL)
+    np.testing.assert_allclose(discharge, q[0, :, 0])
+    assert discharge[1] != discharge[0]
+
+
+def test_bmi_checkpoint_hot_start(tmp_path, bmi_config):
+    config_file, p_and_e, params = bmi_config
+    model = xajBmi()
+    model.initialize(config_file)
+    model.update_until(50)
+    model.save_checkpoint(tmp_path / "checkpoint.npz")
+    model.update_until(model.get_end_time())
+    # a restarted service only has the forcing after the checkpoint
+    with open(config_file) as file:
+        config = yaml.safe_load(file)
+    forcing = pd.read_csv(config["forcing_file"])
+    forcing.iloc[80:].to_csv(tmp_path / "forcing_after.csv", index=False)
+    config.update(
+        {
+            "forcing_file": str(tmp_path / "forcing_after.csv"),
+            "checkpoint": str(tmp_path / "checkpoint.npz"),
+        }
+    )
+    with open(tmp_path / "hot_start.yaml", "w") as file:
+        yaml.dump(config, file)
+    restarted = xajBmi()
+    restarted.initialize(str(tmp_path / "hot_start.yaml"))
+    assert restarted.get_end_time() == 50.0
+    restarted.update_until(restarted.get_end_time())
+    np.testing.assert_allclose(
+        restarted.get_value_ptr("discharge"), model.get_value_ptr("discharge")
+    )
+    # a checkpoint of other basins is refused
+    config["basin_ids"] = ["other"]
+    with open(tmp_path / "hot_start.yaml", "w") as file:
+        yaml.dump(config, file)
+    with pytest.raises(ValueError):
+        xajBmi().initialize(str(tmp_path / "hot_start.yaml"))